@@ -938,6 +938,7 @@ def main():
         sys.exit(result)
     # Force a prefs refresh, in case preflight modified the prefs file.
     prefs.reload_prefs()
+    munkilog.reset_prefs()
 
     # create needed directories if necessary
     if not initMunkiDirs():
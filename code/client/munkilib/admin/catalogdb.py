@@ -0,0 +1,366 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogdb
+
+Lookup tables of the items in a repo's catalogs/all, used by munkiimport to
+find existing items that match one being imported.
+
+make_catalog_db() builds the tables in memory. CatalogDB keeps them in a
+SQLite database in the user's cache directory, along with the hash of the
+catalogs/all they were built from, so they are reused until the catalog
+changes, and are then updated in place: only items that were added or
+changed are stored again.
+"""
+# This code is largely still compatible with Python 2, so for now, turn off
+# Python 3 style warnings
+# pylint: disable=consider-using-f-string
+# pylint: disable=redundant-u-string-prefix
+
+from __future__ import absolute_import, print_function
+
+import hashlib
+import os
+import sqlite3
+import sys
+
+from .. import munkirepo
+from .. import pkgutils
+from ..wrappers import (readPlistFromString, writePlistToString,
+                        PlistReadError)
+from .common import repo_cache_key
+
+
+CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.munkiimport')
+
+# bump this when the database layout or item_lookup_keys change
+SCHEMA_VERSION = '1'
+
+# the lookup tables; 'hashes' entries have no version
+TABLES = ('hashes', 'receipts', 'applications', 'installer_items',
+          'profiles')
+
+
+class CatalogDBException(Exception):
+    '''Exception to throw if we can't make a pkginfo DB'''
+    #pass
+
+
+class CatalogReadException(CatalogDBException):
+    '''Exception to throw if we can't read the all catalog'''
+    #pass
+
+
+class CatalogDecodeException(CatalogDBException):
+    '''Exception to throw if we can't decode the all catalog'''
+    #pass
+
+
+def get_all_catalog(repo):
+    """Returns the contents of catalogs/all"""
+    try:
+        return repo.get('catalogs/all')
+    except munkirepo.RepoError as err:
+        raise CatalogReadException(err) from err
+
+
+def decode_catalog(plist):
+    """Returns the list of items in the catalog plist"""
+    try:
+        return readPlistFromString(plist)
+    except PlistReadError as err:
+        raise CatalogDecodeException(err) from err
+
+
+def item_lookup_keys(item):
+    """Yields (table, key, version) for each way an item can be looked up
+    in the catalog db"""
+    name = item.get('name', 'NO NAME')
+    vers = item.get('version', 'NO VERSION')
+
+    if name == 'NO NAME' or vers == 'NO VERSION':
+        print('WARNING: Bad pkginfo: %s' % item, file=sys.stderr)
+
+    # hash table
+    if 'installer_item_hash' in item:
+        yield ('hashes', item['installer_item_hash'], None)
+
+    # installer item table
+    if 'installer_item_location' in item:
+        installer_item_name = os.path.basename(
+            item['installer_item_location'])
+        (name, ext) = os.path.splitext(installer_item_name)
+        if '-' in name:
+            (name, vers) = pkgutils.nameAndVersion(name)
+        yield ('installer_items', name + ext, vers)
+
+    # table of receipts
+    for receipt in item.get('receipts', []):
+        try:
+            if 'packageid' in receipt and 'version' in receipt:
+                yield ('receipts', receipt['packageid'], receipt['version'])
+        except (TypeError, AttributeError):
+            print('Bad receipt data for %s-%s: %s' % (name, vers, receipt),
+                  file=sys.stderr)
+
+    # table of installed applications
+    for install in item.get('installs', []):
+        try:
+            if install.get('type') == 'application':
+                if 'path' in install:
+                    yield ('applications', install['path'], vers)
+        except (TypeError, AttributeError):
+            print('Bad install data for %s-%s: %s' % (name, vers, install),
+                  file=sys.stderr)
+
+    # table of PayloadIdentifiers
+    if 'PayloadIdentifier' in item:
+        yield ('profiles', item['PayloadIdentifier'], vers)
+
+
+def make_catalog_db(repo):
+    """Returns a dict we can use like a database"""
+    return catalog_db_from_items(decode_catalog(get_all_catalog(repo)))
+
+
+def catalog_db_from_items(catalogitems):
+    """Returns a dict we can use like a database of catalogitems"""
+    pkgdb = dict((table, {}) for table in TABLES)
+    pkgdb['items'] = []
+    for item in catalogitems:
+        add_to_catalog_db(pkgdb, item)
+    return pkgdb
+
+
+def add_to_catalog_db(pkgdb, item):
+    """Adds an item to a dict made by make_catalog_db"""
+    itemindex = len(pkgdb['items'])
+    pkgdb['items'].append(item)
+    for (table, key, vers) in item_lookup_keys(item):
+        if table == 'hashes':
+            pkgdb[table].setdefault(key, []).append(itemindex)
+        else:
+            pkgdb[table].setdefault(key, {}).setdefault(
+                vers, []).append(itemindex)
+
+
+class _LookupTable(object):
+    """Read-only view of one lookup table, like the dicts in the db
+    make_catalog_db() returns"""
+
+    def __init__(self, catdb, table):
+        self.catdb = catdb
+        self.table = table
+
+    def get(self, key, default=None):
+        """Returns {version: [item keys]}, or for the hashes table, a list of
+        item keys, for key"""
+        rows = self.catdb.conn.execute(
+            'SELECT lookups.version, lookups.item_key FROM lookups '
+            'JOIN items ON items.item_key = lookups.item_key '
+            'WHERE lookups.tbl = ? AND lookups.key = ? '
+            'ORDER BY items.position', (self.table, key)).fetchall()
+        if not rows:
+            return default
+        if self.table == 'hashes':
+            return [item_key for (dummy_vers, item_key) in rows]
+        result = {}
+        for (vers, item_key) in rows:
+            result.setdefault(vers, []).append(item_key)
+        return result
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+
+class _Items(object):
+    """Read-only view of the catalog items, by item key"""
+
+    def __init__(self, catdb):
+        self.catdb = catdb
+
+    def __getitem__(self, item_key):
+        row = self.catdb.conn.execute(
+            'SELECT plist FROM items WHERE item_key = ?',
+            (item_key, )).fetchone()
+        if row is None:
+            raise KeyError(item_key)
+        return readPlistFromString(bytes(row[0]))
+
+
+class CatalogDB(object):
+    """Catalog lookup tables stored in a SQLite database at path. Supports
+    the same lookups as the dict make_catalog_db() returns:
+    catdb['receipts'].get(pkgid), catdb['items'][item_key] and so on."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        stored_version = None
+        try:
+            stored_version = self.get_meta('schema_version')
+        except sqlite3.OperationalError:
+            pass
+        if stored_version != SCHEMA_VERSION:
+            self._create_tables()
+
+    def __getitem__(self, name):
+        if name == 'items':
+            return _Items(self)
+        if name in TABLES:
+            return _LookupTable(self, name)
+        raise KeyError(name)
+
+    def close(self):
+        """Closes the database"""
+        self.conn.close()
+
+    def _create_tables(self):
+        """Creates empty tables, dropping any from an older layout"""
+        with self.conn:
+            for table in ('meta', 'items', 'lookups'):
+                self.conn.execute('DROP TABLE IF EXISTS %s' % table)
+            self.conn.execute(
+                'CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(
+                'CREATE TABLE items (item_key INTEGER PRIMARY KEY, '
+                'item_hash TEXT, position INTEGER, plist BLOB)')
+            self.conn.execute(
+                'CREATE TABLE lookups (tbl TEXT, key TEXT, version TEXT, '
+                'item_key INTEGER)')
+            self.conn.execute(
+                'CREATE INDEX items_item_hash ON items (item_hash)')
+            self.conn.execute(
+                'CREATE INDEX lookups_tbl_key ON lookups (tbl, key)')
+            self.conn.execute(
+                'CREATE INDEX lookups_item_key ON lookups (item_key)')
+            self._set_meta('schema_version', SCHEMA_VERSION)
+
+    def get_meta(self, name):
+        """Returns a value from the meta table, or None"""
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE name = ?', (name, )).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def _set_meta(self, name, value):
+        """Sets a value in the meta table"""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+            (name, value))
+
+    def _insert_item(self, item, plist, item_hash, position):
+        """Stores an item and its lookup keys"""
+        curs = self.conn.execute(
+            'INSERT INTO items (item_hash, position, plist) VALUES (?, ?, ?)',
+            (item_hash, position, sqlite3.Binary(plist)))
+        item_key = curs.lastrowid
+        self.conn.executemany(
+            'INSERT INTO lookups (tbl, key, version, item_key) '
+            'VALUES (?, ?, ?, ?)',
+            [(table, key, vers, item_key)
+             for (table, key, vers) in item_lookup_keys(item)])
+
+    def sync(self, catalog_data):
+        """Brings the tables up to date with catalog_data, the contents of
+        catalogs/all. Does nothing if they were built from the same data;
+        otherwise stores only the items that changed."""
+        catalog_hash = hashlib.sha256(catalog_data).hexdigest()
+        if self.get_meta('catalog_hash') == catalog_hash:
+            return
+        catalogitems = decode_catalog(catalog_data)
+
+        existing = {}
+        for (item_key, item_hash) in self.conn.execute(
+                'SELECT item_key, item_hash FROM items'):
+            existing.setdefault(item_hash, []).append(item_key)
+
+        with self.conn:
+            positions = []
+            for (position, item) in enumerate(catalogitems):
+                plist = writePlistToString(item)
+                item_hash = hashlib.sha256(plist).hexdigest()
+                if existing.get(item_hash):
+                    positions.append((position, existing[item_hash].pop()))
+                else:
+                    self._insert_item(item, plist, item_hash, position)
+            self.conn.executemany(
+                'UPDATE items SET position = ? WHERE item_key = ?', positions)
+            # whatever is left is no longer in the catalog
+            removed = [(item_key, ) for item_keys in existing.values()
+                       for item_key in item_keys]
+            self.conn.executemany(
+                'DELETE FROM lookups WHERE item_key = ?', removed)
+            self.conn.executemany(
+                'DELETE FROM items WHERE item_key = ?', removed)
+            self._set_meta('catalog_hash', catalog_hash)
+
+    def add_item(self, item):
+        """Adds an item that was just imported, so it can be matched before
+        the catalogs are rebuilt"""
+        plist = writePlistToString(item)
+        with self.conn:
+            (position, ) = self.conn.execute(
+                'SELECT COALESCE(MAX(position), -1) + 1 FROM items').fetchone()
+            self._insert_item(
+                item, plist, hashlib.sha256(plist).hexdigest(), position)
+
+
+def cache_path(repo):
+    """Returns the path of the catalog db for repo, or None if repo can't
+    be told apart from others between runs"""
+    cache_key = repo_cache_key(repo)
+    if not cache_key:
+        return None
+    return os.path.join(CACHE_DIR, 'catalogdb-%s.sqlite' % cache_key)
+
+
+def open_catalog_db(repo):
+    """Returns a CatalogDB for repo that's up to date with its
+    catalogs/all, or None if there's no cache for repo. Raises
+    CatalogDBException subclasses if catalogs/all can't be read, and
+    sqlite3.Error or OSError if the cache can't be used."""
+    path = cache_path(repo)
+    if not path:
+        return None
+    catalog_data = get_all_catalog(repo)
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    catdb = CatalogDB(path)
+    try:
+        catdb.sync(catalog_data)
+    except BaseException:
+        catdb.close()
+        raise
+    return catdb
+
+
+def add_imported_item(repo, item):
+    """Adds a just-imported item to repo's cached catalog db, if there is
+    one"""
+    path = cache_path(repo)
+    if path and os.path.exists(path):
+        catdb = CatalogDB(path)
+        try:
+            catdb.add_item(item)
+        finally:
+            catdb.close()
@@ -21,6 +21,7 @@ Common code used by the admin libs
 """
 from __future__ import absolute_import
 
+import hashlib
 import os
 
 class AttributeDict(dict):
@@ -41,3 +42,16 @@ def list_items_of_kind(repo, kind):
     '''Returns a list of items of kind. Relative pathnames are prepended
     with kind. (example: ['icons/Bar.png', 'icons/Foo.png'])'''
     return [os.path.join(kind, item) for item in repo.itemlist(kind)]
+
+
+def repo_cache_key(repo):
+    '''Returns a short string that names repo the same way from one run to
+    the next, made from its plugin name and URL, for naming files cached
+    for the repo. Returns None if the repo has no URL, in which case
+    nothing should be cached for it.'''
+    repo_url = getattr(repo, 'baseurl', None)
+    if not repo_url:
+        return None
+    return hashlib.sha256(
+        (u'%s %s' % (repo.__class__.__name__, repo_url)).encode('UTF-8')
+    ).hexdigest()[:16]
@@ -0,0 +1,274 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+iconpipeline
+
+Runs iconimporter's work for many items at once. Each item goes through
+three stages:
+
+  - fetch: copy the installer item from the repo to a work directory
+  - extract: get the application icons out of it
+  - convert: make pngs of the icons and upload them to the repo
+
+Each stage has its own limit on how many items can be in it at once, so
+downloads, disk image mounts and icon conversions overlap without any one
+of them swamping the machine. How an icon is extracted depends on the
+item's installer_type, and is up to an IconExtractor for that type.
+
+The installer_item_hash each icon was made from is remembered in the
+user's cache directory, so an existing icon is only made again if the
+installer item has changed since.
+"""
+# This code is largely still compatible with Python 2, so for now, turn off
+# Python 3 style warnings
+# pylint: disable=consider-using-f-string
+# pylint: disable=redundant-u-string-prefix
+
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .. import munkirepo
+from ..wrappers import (readPlist, writePlist, unicode_or_str,
+                        PlistReadError, PlistWriteError)
+from .common import repo_cache_key
+
+
+CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.iconimporter')
+
+
+class IconJob(object):
+    '''One item's trip through the pipeline'''
+
+    def __init__(self, item):
+        self.item = item
+        self.name = item['name']
+        self.workdir = None
+        self.installer_path = None
+        self.icon_paths = []
+        self.uploaded = []
+        self.messages = []
+
+    def log(self, message):
+        '''Notes a message to print when the item is done'''
+        self.messages.append(message)
+
+
+class IconExtractor(object):
+    '''Gets application icons out of one kind of installer item.
+    Subclasses override extract(); fetch() downloads the installer item to
+    the job's work directory.'''
+
+    def fetch(self, repo, job):
+        '''Copies the item's installer to job.installer_path. Returns True
+        if it did.'''
+        if not job.item.get('installer_item_location'):
+            job.log(u'No installer item.')
+            return False
+        item_ref = os.path.join(
+            'pkgs', job.item['installer_item_location'])
+        job.installer_path = os.path.join(
+            job.workdir, os.path.basename(item_ref))
+        try:
+            # for a file repo on APFS this is a clone, not a copy
+            repo.get_to_local_file(item_ref, job.installer_path)
+        except munkirepo.RepoError as err:
+            job.log(u'Can\'t download %s from repo: %s'
+                    % (item_ref, unicode_or_str(err)))
+            return False
+        return True
+
+    def extract(self, job):
+        '''Returns a list of paths of the icons for job's installer. Icons
+        inside a disk image must be copied out with keep_icon() before it's
+        unmounted. This one finds none.'''
+        # pylint: disable=unused-argument,no-self-use
+        return []
+
+    @staticmethod
+    def keep_icon(job, icon_path):
+        '''Copies icon_path into job.workdir and returns the copy's path'''
+        kept_path = os.path.join(job.workdir, u'%s_%s' % (
+            len(os.listdir(job.workdir)), os.path.basename(icon_path)))
+        shutil.copyfile(icon_path, kept_path)
+        return kept_path
+
+
+def icon_name_for_item(item):
+    '''Returns the name of the icon the repo would use for item'''
+    icon_name = item.get('icon_name') or item['name']
+    if not os.path.splitext(icon_name)[1]:
+        icon_name += u'.png'
+    return icon_name
+
+
+def needs_icon(item, icons_list, source_hashes, force=False):
+    '''Returns True if we should make an icon for item: if forced, if it
+    has none, or if the icon was made from an installer item that has
+    since changed. An icon we have no record of, which might have been
+    made by hand, is left alone.'''
+    if force:
+        return True
+    icon_name = icon_name_for_item(item)
+    if icon_name not in icons_list:
+        return True
+    source_hash = source_hashes.get(icon_name)
+    return bool(source_hash and item.get('installer_item_hash') and
+                source_hash != item['installer_item_hash'])
+
+
+def cache_path(repo):
+    '''Returns the path of the file recording icon sources for repo, or
+    None if repo can't be told apart from others between runs'''
+    cache_key = repo_cache_key(repo)
+    if not cache_key:
+        return None
+    return os.path.join(CACHE_DIR, 'icon_sources-%s.plist' % cache_key)
+
+
+def load_source_hashes(repo):
+    '''Returns {icon name: installer_item_hash it was made from}'''
+    path = cache_path(repo)
+    if not path:
+        return {}
+    try:
+        return readPlist(path)
+    except (PlistReadError, IOError, OSError):
+        return {}
+
+
+def save_source_hashes(repo, source_hashes):
+    '''Saves the record of what icons were made from'''
+    path = cache_path(repo)
+    if not path:
+        return
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        writePlist(source_hashes, path)
+    except (PlistWriteError, IOError, OSError) as err:
+        print(u'Could not save icon sources: %s' % unicode_or_str(err))
+
+
+def print_job(job):
+    '''Prints what happened to job'''
+    print(u'Processing %s...' % job.name)
+    for message in job.messages:
+        print(u'\t%s' % message)
+
+
+class IconPipeline(object):
+    '''Makes icons for items with a pool of workers, limiting how many are
+    in each stage at once.
+
+    extractors maps installer_type to an IconExtractor; converter is a
+    function(icon_path, png_path) that returns True if it made a png.'''
+
+    def __init__(self, repo, extractors, converter,
+                 fetch_jobs=4, extract_jobs=2, convert_jobs=4):
+        self.repo = repo
+        self.extractors = extractors
+        self.converter = converter
+        self.fetch_slots = threading.BoundedSemaphore(fetch_jobs)
+        self.extract_slots = threading.BoundedSemaphore(extract_jobs)
+        self.convert_slots = threading.BoundedSemaphore(convert_jobs)
+        # enough workers to fill every stage; more would only hold
+        # downloaded installers waiting for a turn
+        self.max_workers = fetch_jobs + extract_jobs + convert_jobs
+
+    def extractor_for(self, item):
+        '''Returns the IconExtractor for item, or None'''
+        return self.extractors.get(item.get('installer_type') or '')
+
+    def convert_and_upload(self, job):
+        '''Makes pngs of job's icons and uploads them as icons/<name>.png,
+        or <name>_1.png, <name>_2.png and so on if there are several'''
+        for (index, icon_path) in enumerate(job.icon_paths):
+            if len(job.icon_paths) == 1:
+                icon_name = job.name
+            else:
+                icon_name = u'%s_%s' % (job.name, index + 1)
+            png_path = os.path.join(job.workdir, icon_name + u'.png')
+            if not self.converter(icon_path, png_path):
+                job.log(u'Error converting %s to png.' % icon_path)
+                continue
+            icon_ref = os.path.join(u'icons', icon_name + u'.png')
+            try:
+                self.repo.put_from_local_file(icon_ref, png_path)
+                job.uploaded.append(icon_ref)
+                job.log(u'Wrote: %s' % icon_ref)
+            except munkirepo.RepoError as err:
+                job.log(u'Error uploading %s: %s'
+                        % (icon_ref, unicode_or_str(err)))
+
+    def process(self, job):
+        '''Takes job through each stage, waiting for a free slot in each'''
+        extractor = self.extractor_for(job.item)
+        job.workdir = tempfile.mkdtemp(prefix='iconimporter.')
+        try:
+            with self.fetch_slots:
+                if not extractor.fetch(self.repo, job):
+                    return job
+            with self.extract_slots:
+                job.icon_paths = extractor.extract(job)
+                # the installer isn't needed any more
+                if job.installer_path and os.path.isfile(job.installer_path):
+                    os.unlink(job.installer_path)
+            if not job.icon_paths:
+                job.log(u'No application icons found.')
+                return job
+            with self.convert_slots:
+                self.convert_and_upload(job)
+        except (OSError, IOError) as err:
+            job.log(u'Error: %s' % unicode_or_str(err))
+        except Exception as err:
+            # an extractor or converter failing in some other way mustn't
+            # stop the run before the icon sources are saved
+            job.log(u'Unexpected error: %s' % unicode_or_str(err))
+        finally:
+            shutil.rmtree(job.workdir, ignore_errors=True)
+        return job
+
+    def run(self, items, source_hashes=None, report=None):
+        '''Makes icons for items. Updates source_hashes for each item that
+        got an icon, and calls report(job) as each item finishes. Returns
+        the list of IconJobs.'''
+        report = report or print_job
+        jobs = []
+        for item in items:
+            job = IconJob(item)
+            if self.extractor_for(item) is None:
+                job.log(u'Can\'t process installer_type: %s'
+                        % item.get('installer_type'))
+                report(job)
+            else:
+                jobs.append(job)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.process, job) for job in jobs]
+            for future in as_completed(futures):
+                job = future.result()
+                if (job.uploaded and source_hashes is not None and
+                        job.item.get('installer_item_hash')):
+                    source_hashes[icon_name_for_item(job.item)] = (
+                        job.item['installer_item_hash'])
+                report(job)
+        return jobs
@@ -22,15 +22,19 @@ Routines used by makecatalogs
 from __future__ import absolute_import, print_function
 
 # std libs
+import gzip
 import hashlib
 import os
 
 # our libs
 from .common import list_items_of_kind, AttributeDict
 
+from .. import catalogdeltas
+from .. import catalogshards
 from .. import munkirepo
 
-from ..wrappers import readPlistFromString, writePlistToString
+from ..wrappers import (readPlistFromString, writePlistToString,
+                        PlistReadError)
 
 
 class MakeCatalogsError(Exception):
@@ -38,6 +42,58 @@ class MakeCatalogsError(Exception):
     pass
 
 
+# what makecatalogs publishes besides the catalogs themselves is kept in the
+# repo, so runs that don't say (munkiimport, repoclean) publish the same
+SETTINGS_NAME = '_settings.plist'
+PUBLISHING_OPTIONS = ('delta_history', 'gzip', 'shards')
+# suffixes of the files makecatalogs --gzip publishes beside each catalog:
+# the compressed catalog, and the SHA-256 of the uncompressed catalog that
+# clients check it against
+COMPRESSED_SUFFIXES = ('.gz', '.sha256')
+
+
+def is_catalog_artifact(catalog_name, compressed=True):
+    '''Returns True if catalog_name, as listed by repo.itemlist('catalogs'),
+    is something makecatalogs publishes beside the catalogs rather than a
+    catalog itself: the publishing settings, revision history and deltas,
+    shards, and unless compressed is False, compressed catalogs and their
+    hashes'''
+    if catalog_name == SETTINGS_NAME:
+        return True
+    if (catalog_name.startswith(catalogdeltas.DELTAS_DIR + '/') or
+            catalog_name.startswith(catalogshards.SHARDS_DIR + '/')):
+        return True
+    return compressed and catalog_name.endswith(COMPRESSED_SUFFIXES)
+
+
+def publishing_settings(repo, options, errors):
+    '''Returns an AttributeDict of the PUBLISHING_OPTIONS for this run: as
+    given in options, or as last given if not. Options that were given are
+    saved in the repo for later runs. A setting that has never been given is
+    missing from the result.'''
+    settings_ref = os.path.join('catalogs', SETTINGS_NAME)
+    settings = AttributeDict()
+    try:
+        settings.update(readPlistFromString(repo.get(settings_ref)))
+    except munkirepo.RepoError:
+        # none saved yet
+        pass
+    except PlistReadError as err:
+        errors.append(u'WARNING: Ignoring unreadable %s: %s'
+                      % (settings_ref, err))
+    given = dict((key, getattr(options, key, None))
+                 for key in PUBLISHING_OPTIONS)
+    given = dict((key, value) for (key, value) in given.items()
+                 if value is not None)
+    if any(settings.get(key) != value for (key, value) in given.items()):
+        settings.update(given)
+        try:
+            repo.put(settings_ref, writePlistToString(dict(settings)))
+        except munkirepo.RepoError as err:
+            errors.append(u'Failed to save %s: %s' % (settings_ref, err))
+    return settings
+
+
 def hash_icons(repo, output_fn=None):
     '''Builds a dictionary containing hashes for all our repo icons'''
     errors = []
@@ -166,7 +222,8 @@ def process_pkgsinfo(repo, options, output_fn=None):
     if output_fn:
         output_fn("Getting list of pkgsinfo...")
     try:
-        pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
+        # sort so that identical pkgsinfo always produce identical catalogs
+        pkgsinfo_list = sorted(list_items_of_kind(repo, 'pkgsinfo'))
     except munkirepo.RepoError as err:
         raise MakeCatalogsError(
             u"Error getting list of pkgsinfo items: %s" % err)
@@ -244,6 +301,204 @@ def process_pkgsinfo(repo, options, output_fn=None):
     return catalogs, errors
 
 
+def _delta_ref(catalogname, name):
+    '''Returns the repo identifier for a delta artifact of catalogname'''
+    return os.path.join(
+        'catalogs', catalogdeltas.DELTAS_DIR, catalogname, name)
+
+
+def _shard_ref(catalogname, name):
+    '''Returns the repo identifier for a shard of catalogname'''
+    return os.path.join(
+        'catalogs', catalogshards.SHARDS_DIR, catalogname, name)
+
+
+def _remove_catalog_artifacts(repo, subdir, catalogname, catalog_list,
+                              keep=None):
+    '''Deletes the items under catalogs/<subdir>/<catalogname>/ found in
+    catalog_list, except for names in keep. Returns a list of errors.'''
+    errors = []
+    prefix = os.path.join(subdir, catalogname) + '/'
+    for item in catalog_list:
+        if not item.startswith(prefix):
+            continue
+        name = item[len(prefix):]
+        if keep and name in keep:
+            continue
+        try:
+            repo.delete(os.path.join('catalogs', item))
+        except munkirepo.RepoError as err:
+            errors.append(u'Could not delete %s: %s' % (item, err))
+    return errors
+
+
+def remove_catalog_deltas(repo, catalogname, catalog_list, keep=None):
+    '''Deletes the delta artifacts for catalogname found in catalog_list,
+    except for names in keep. Returns a list of errors.'''
+    return _remove_catalog_artifacts(
+        repo, catalogdeltas.DELTAS_DIR, catalogname, catalog_list, keep=keep)
+
+
+def remove_catalog_shards(repo, catalogname, catalog_list, keep=None):
+    '''Deletes the shards of catalogname found in catalog_list, except for
+    names in keep. Returns a list of errors.'''
+    return _remove_catalog_artifacts(
+        repo, catalogshards.SHARDS_DIR, catalogname, catalog_list, keep=keep)
+
+
+def update_catalog_deltas(repo, catalogname, items, item_hashes,
+                          catalog_data, history_count, catalog_list,
+                          output_fn=None):
+    '''Records a new revision of catalogname in its revision history, and
+    publishes deltas from the previous history_count revisions to the new
+    one, plus an index clients use to find them. Returns a list of
+    errors.'''
+    errors = []
+    current_hash = catalogdeltas.catalog_hash(catalog_data)
+    history_ref = _delta_ref(catalogname, catalogdeltas.HISTORY_NAME)
+    revisions = []
+    try:
+        history = readPlistFromString(repo.get(history_ref))
+        revisions = history['revisions']
+        for revision in revisions:
+            if (not isinstance(revision['revision'], int) or
+                    'catalog_hash' not in revision or
+                    'item_hashes' not in revision):
+                raise ValueError('incomplete revision %s' % revision)
+    except munkirepo.RepoError:
+        # no history yet
+        pass
+    except (PlistReadError, KeyError, TypeError, ValueError) as err:
+        revisions = []
+        errors.append(u'WARNING: Discarding unreadable revision history '
+                      u'for catalog %s: %s' % (catalogname, err))
+
+    if revisions and revisions[-1]['catalog_hash'] == current_hash:
+        current = revisions[-1]
+    else:
+        next_revision = revisions[-1]['revision'] + 1 if revisions else 1
+        current = {'revision': next_revision,
+                   'catalog_hash': current_hash,
+                   'item_hashes': item_hashes}
+        revisions.append(current)
+    revisions = revisions[-(history_count + 1):]
+
+    index = {'catalog': catalogname,
+             'revision': current['revision'],
+             'catalog_hash': current_hash,
+             'deltas': []}
+    for revision in revisions[:-1]:
+        name = catalogdeltas.delta_name(
+            revision['revision'], current['revision'])
+        delta = catalogdeltas.make_delta(
+            revision['item_hashes'], item_hashes, items)
+        delta.update({'from_revision': revision['revision'],
+                      'from_hash': revision['catalog_hash'],
+                      'to_revision': current['revision'],
+                      'to_hash': current_hash})
+        try:
+            repo.put(_delta_ref(catalogname, name), writePlistToString(delta))
+        except munkirepo.RepoError as err:
+            errors.append(u'Failed to create delta %s for catalog %s: %s'
+                          % (name, catalogname, err))
+            continue
+        index['deltas'].append({'from_revision': revision['revision'],
+                                'from_hash': revision['catalog_hash'],
+                                'name': name})
+        if output_fn:
+            output_fn("Created delta %s for %s: %s added, %s removed..."
+                      % (name, catalogname, len(delta['added']),
+                         len(delta['removed'])))
+
+    try:
+        repo.put(history_ref, writePlistToString({'revisions': revisions}))
+        repo.put(_delta_ref(catalogname, catalogdeltas.INDEX_NAME),
+                 writePlistToString(index))
+    except munkirepo.RepoError as err:
+        errors.append(u'Failed to update revision history for catalog %s: %s'
+                      % (catalogname, err))
+
+    # remove deltas that don't lead to the current revision
+    keep = [catalogdeltas.HISTORY_NAME, catalogdeltas.INDEX_NAME]
+    keep.extend(delta['name'] for delta in index['deltas'])
+    errors.extend(
+        remove_catalog_deltas(repo, catalogname, catalog_list, keep=keep))
+    return errors
+
+
+def update_catalog_shards(repo, catalogname, items, catalog_list,
+                          output_fn=None):
+    '''Splits catalogname into one shard per item name, plus an index
+    clients use to find the shards they need. Unchanged shards are left
+    alone; shards for names no longer in the catalog are deleted. Returns a
+    list of errors.'''
+    errors = []
+    (index, shards) = catalogshards.make_shards(items)
+    index['catalog'] = catalogname
+    written_count = 0
+    for (file_name, shard_data) in sorted(shards.items()):
+        try:
+            if put_if_changed(repo, _shard_ref(catalogname, file_name),
+                              shard_data):
+                written_count += 1
+        except munkirepo.RepoError as err:
+            errors.append(u'Failed to create shard %s for catalog %s: %s'
+                          % (file_name, catalogname, err))
+    try:
+        put_if_changed(repo, _shard_ref(catalogname, catalogshards.INDEX_NAME),
+                       writePlistToString(index))
+    except munkirepo.RepoError as err:
+        errors.append(u'Failed to create shard index for catalog %s: %s'
+                      % (catalogname, err))
+    if output_fn:
+        output_fn("Sharded %s: %s shards, %s changed..."
+                  % (catalogname, len(shards), written_count))
+
+    keep = set(shards)
+    keep.add(catalogshards.INDEX_NAME)
+    errors.extend(
+        remove_catalog_shards(repo, catalogname, catalog_list, keep=keep))
+    return errors
+
+
+def update_compressed_catalog(repo, catalogpath, catalog_data,
+                              output_fn=None):
+    '''Publishes a gzip-compressed copy of the catalog at catalogpath, and
+    the SHA-256 of catalog_data for clients to check it against. Returns a
+    list of errors.'''
+    # mtime=0 keeps the compressed bytes stable for unchanged catalogs
+    compressed_data = gzip.compress(catalog_data, mtime=0)
+    hash_data = (hashlib.sha256(catalog_data).hexdigest() + '\n').encode(
+        'UTF-8')
+    try:
+        # the hash goes first, so a client never sees a new compressed
+        # catalog with the old hash
+        put_if_changed(repo, catalogpath + '.sha256', hash_data)
+        if put_if_changed(repo, catalogpath + '.gz', compressed_data):
+            if output_fn:
+                output_fn("Created %s.gz..." % catalogpath)
+    except munkirepo.RepoError as err:
+        return [u'Failed to create compressed catalog %s: %s'
+                % (catalogpath, err)]
+    return []
+
+
+def put_if_changed(repo, resource_identifier, data):
+    '''Stores data in the repo at resource_identifier unless the repo
+    already has identical content there, so unchanged items keep their
+    modification dates and ETags. Returns True if data was written.'''
+    try:
+        existing_data = repo.get(resource_identifier)
+    except munkirepo.RepoError:
+        existing_data = None
+    if (existing_data is not None and
+            hashlib.sha256(existing_data).digest() ==
+            hashlib.sha256(data).digest()):
+        return False
+    repo.put(resource_identifier, data)
+    return True
+
+
 def makecatalogs(repo, options, output_fn=None):
     '''Assembles all pkginfo files into catalogs.
     User calling this needs to be able to write to the repo/catalogs
@@ -259,41 +514,107 @@ def makecatalogs(repo, options, output_fn=None):
 
     errors.extend(catalog_errors)
 
+    settings = publishing_settings(repo, options, errors)
+
     # clear out old catalogs
     try:
         catalog_list = repo.itemlist('catalogs')
     except munkirepo.RepoError:
         catalog_list = []
+    expected_catalogs = set(catalogs)
+    if settings.gzip is not False:
+        # compressed catalogs are only removed when turned off
+        expected_catalogs.update(key + suffix for key in catalogs
+                                 for suffix in COMPRESSED_SUFFIXES)
     for catalog_name in catalog_list:
-        if catalog_name not in list(catalogs.keys()):
+        if is_catalog_artifact(catalog_name, compressed=False):
+            # revision history, deltas and shards are handled below
+            continue
+        if catalog_name not in expected_catalogs:
             catalog_ref = os.path.join('catalogs', catalog_name)
             try:
                 repo.delete(catalog_ref)
             except munkirepo.RepoError:
                 errors.append('Could not delete catalog %s' % catalog_name)
 
+    # remove revision history and deltas for catalogs that no longer exist,
+    # or for all catalogs if deltas have been turned off
+    delta_history = settings.delta_history or 0
+    delta_catalogs = set(
+        item.split('/')[1] for item in catalog_list
+        if item.startswith(catalogdeltas.DELTAS_DIR + '/')
+        and item.count('/') > 1)
+    for catalog_name in delta_catalogs:
+        if ((settings.delta_history is not None and not delta_history) or
+                catalog_name not in catalogs):
+            errors.extend(
+                remove_catalog_deltas(repo, catalog_name, catalog_list))
+
+    # likewise for shards
+    shard_catalogs = set(
+        item.split('/')[1] for item in catalog_list
+        if item.startswith(catalogshards.SHARDS_DIR + '/')
+        and item.count('/') > 1)
+    for catalog_name in shard_catalogs:
+        if settings.shards is False or catalog_name not in catalogs:
+            errors.extend(
+                remove_catalog_shards(repo, catalog_name, catalog_list))
+
+    item_hashes = {}
+    if delta_history:
+        # items are shared between catalogs, so hash each one only once
+        for pkginfo in catalogs['all']:
+            item_hashes[id(pkginfo)] = catalogdeltas.item_hash(pkginfo)
+
     # write the new catalogs
-    for key in catalogs:
+    written_count = unchanged_count = 0
+    for key in sorted(catalogs):
         catalogpath = os.path.join("catalogs", key)
         if catalogs[key] != "":
             catalog_data = writePlistToString(catalogs[key])
             try:
-                repo.put(catalogpath, catalog_data)
-                if output_fn:
-                    output_fn("Created %s..." % catalogpath)
+                written = put_if_changed(repo, catalogpath, catalog_data)
             except munkirepo.RepoError as err:
                 errors.append(
                     u'Failed to create catalog %s: %s' % (key, err))
+                continue
+            if written:
+                written_count += 1
+                if output_fn:
+                    output_fn("Created %s..." % catalogpath)
+            else:
+                unchanged_count += 1
+                if output_fn:
+                    output_fn("Skipped unchanged %s..." % catalogpath)
+            if settings.gzip:
+                errors.extend(update_compressed_catalog(
+                    repo, catalogpath, catalog_data, output_fn=output_fn))
+            index_ref = os.path.join(
+                catalogdeltas.DELTAS_DIR, key, catalogdeltas.INDEX_NAME)
+            if delta_history and (written or index_ref not in catalog_list):
+                errors.extend(update_catalog_deltas(
+                    repo, key, catalogs[key],
+                    [item_hashes[id(item)] for item in catalogs[key]],
+                    catalog_data, delta_history, catalog_list,
+                    output_fn=output_fn))
+            if settings.shards:
+                errors.extend(update_catalog_shards(
+                    repo, key, catalogs[key], catalog_list,
+                    output_fn=output_fn))
         else:
             errors.append(
                 "WARNING: Did not create catalog %s because it is empty" % key)
 
+    if output_fn:
+        output_fn("Catalogs written: %s, unchanged: %s"
+                  % (written_count, unchanged_count))
+
     if icons:
         icon_hashes_plist = os.path.join("icons", "_icon_hashes.plist")
         icon_hashes = writePlistToString(icons)
         try:
-            repo.put(icon_hashes_plist, icon_hashes)
-            print("Created %s..." % (icon_hashes_plist))
+            if put_if_changed(repo, icon_hashes_plist, icon_hashes):
+                print("Created %s..." % (icon_hashes_plist))
         except munkirepo.RepoError as err:
             errors.append(
                 u'Failed to create %s: %s' % (icon_hashes_plist, err))
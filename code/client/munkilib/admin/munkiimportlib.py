@@ -28,9 +28,15 @@ from __future__ import absolute_import, print_function
 
 # std lib imports
 import os
-import sys
+import sqlite3
 
 # our lib imports
+from . import catalogdb
+# these used to be defined here
+# pylint: disable=unused-import
+from .catalogdb import (CatalogDBException, CatalogReadException,
+                        CatalogDecodeException, make_catalog_db)
+# pylint: enable=unused-import
 from .common import list_items_of_kind
 from .. import iconutils
 from .. import dmgutils
@@ -41,6 +47,7 @@ from .. import osutils
 from .. import pkgutils
 from .. import FoundationPlist
 from ..cliutils import pref
+from ..wrappers import PlistWriteError
 
 
 class RepoCopyError(Exception):
@@ -56,25 +63,15 @@ def determine_arch(pkginfo) -> str:
     return ""
 
 
-def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
-    """Copies an item to the appropriate place in the repo.
-    If itempath is a path within the repo/pkgs directory, copies nothing.
-    Renames the item if an item already exists with that name.
-    Returns the relative path to the item."""
-
+def item_repo_path(repo, itempath, vers, subdirectory='', pkgs_list=None):
+    """Returns the relative path in the repo that copy_item_to_repo copies
+    the item at itempath to: its name with the version added, and a number
+    too if an item with that name is in pkgs_list. pkgs_list defaults to
+    the items in the repo now."""
     destination_path = os.path.join('pkgs', subdirectory)
     item_name = os.path.basename(itempath)
     destination_path_name = os.path.join(destination_path, item_name)
 
-    # don't copy if the file is already in the repo
-    try:
-        if os.path.normpath(repo.local_path(destination_path_name)) == os.path.normpath(itempath):
-            # source item is a repo item!
-            return destination_path_name
-    except AttributeError:
-        # no guarantee all repo plugins have the local_path method
-        pass
-
     name, ext = os.path.splitext(item_name)
     if vers:
         if not name.endswith(vers):
@@ -83,24 +80,69 @@ def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
             destination_path_name = os.path.join(destination_path, item_name)
 
     index = 0
-    try:
-        pkgs_list = list_items_of_kind(repo, 'pkgs')
-    except munkirepo.RepoError as err:
-        raise RepoCopyError(u'Unable to get list of current pkgs: %s' % err) from err
+    if pkgs_list is None:
+        try:
+            pkgs_list = list_items_of_kind(repo, 'pkgs')
+        except munkirepo.RepoError as err:
+            raise RepoCopyError(u'Unable to get list of current pkgs: %s' % err) from err
     while destination_path_name in pkgs_list:
         #print 'File %s already exists...' % destination_path_name
         # try appending numbers until we have a unique name
         index += 1
         item_name = '%s__%s%s' % (name, index, ext)
         destination_path_name = os.path.join(destination_path, item_name)
+    return destination_path_name
+
+
+def copy_item_to_repo(repo, itempath, vers, subdirectory='',
+                      destination_path_name=None):
+    """Copies an item to the appropriate place in the repo.
+    If itempath is a path within the repo/pkgs directory, copies nothing.
+    Renames the item if an item already exists with that name, unless
+    destination_path_name, as returned by item_repo_path, is given.
+    Returns the relative path to the item."""
+    return copy_item_to_repo_with_hashes(
+        repo, itempath, vers, (), subdirectory=subdirectory,
+        destination_path_name=destination_path_name)[0]
+
+
+def copy_item_to_repo_with_hashes(repo, itempath, vers, algorithms,
+                                  subdirectory='', destination_path_name=None):
+    """Like copy_item_to_repo, but returns a tuple of the relative path to
+    the item and a dict mapping each of algorithms, a sequence of hashlib
+    algorithm names, to the hex digest of the item, where the repo plugin
+    could work them out while copying. The dict is missing algorithms the
+    plugin couldn't do, or is empty."""
+
+    repo_path_name = os.path.join(
+        'pkgs', subdirectory, os.path.basename(itempath))
+
+    # don't copy if the file is already in the repo
+    try:
+        if os.path.normpath(repo.local_path(repo_path_name)) == os.path.normpath(itempath):
+            # source item is a repo item!
+            return (repo_path_name, {})
+    except AttributeError:
+        # no guarantee all repo plugins have the local_path method
+        pass
+
+    if destination_path_name is None:
+        destination_path_name = item_repo_path(
+            repo, itempath, vers, subdirectory)
 
     try:
-        repo.put_from_local_file(destination_path_name, itempath)
+        if algorithms and hasattr(repo, 'put_from_local_file_with_hashes'):
+            hashes = repo.put_from_local_file_with_hashes(
+                destination_path_name, itempath, algorithms)
+        else:
+            # no guarantee all repo plugins can hash what they copy
+            repo.put_from_local_file(destination_path_name, itempath)
+            hashes = {}
     except munkirepo.RepoError as err:
         raise RepoCopyError(u'Unable to copy %s to %s: %s'
                             % (itempath, destination_path_name, err)) from err
     else:
-        return destination_path_name
+        return (destination_path_name, hashes or {})
 
 
 def copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
@@ -134,121 +176,27 @@ def copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
         raise RepoCopyError(err) from err
     try:
         repo.put(pkginfo_path, pkginfo_str)
-        return pkginfo_path
     except munkirepo.RepoError as err:
         raise RepoCopyError(u'Unable to save pkginfo to %s: %s'
                             % (pkginfo_path, err)) from err
+    # so it's matched by later imports, even before catalogs are rebuilt
+    try:
+        catalogdb.add_imported_item(repo, pkginfo)
+    except (sqlite3.Error, OSError, IOError, PlistWriteError):
+        pass
+    return pkginfo_path
 
 
-class CatalogDBException(Exception):
-    '''Exception to throw if we can't make a pkginfo DB'''
-    #pass
-
-
-class CatalogReadException(CatalogDBException):
-    '''Exception to throw if we can't read the all catalog'''
-    #pass
-
-
-class CatalogDecodeException(CatalogDBException):
-    '''Exception to throw if we can't decode the all catalog'''
-    #pass
-
-
-def make_catalog_db(repo):
-    """Returns a dict we can use like a database"""
-
+def get_catalog_db(repo):
+    """Returns the catalog db for repo: the cached one if we can use it,
+    otherwise one built in memory"""
     try:
-        plist = repo.get('catalogs/all')
-    except munkirepo.RepoError as err:
-        raise CatalogReadException(err) from err
-
-    try:
-        catalogitems = FoundationPlist.readPlistFromString(plist)
-    except FoundationPlist.NSPropertyListSerializationException as err:
-        raise CatalogDecodeException(err) from err
-
-    pkgid_table = {}
-    app_table = {}
-    installer_item_table = {}
-    hash_table = {}
-    profile_table = {}
-
-    itemindex = -1
-    for item in catalogitems:
-        itemindex = itemindex + 1
-        name = item.get('name', 'NO NAME')
-        vers = item.get('version', 'NO VERSION')
-
-        if name == 'NO NAME' or vers == 'NO VERSION':
-            print('WARNING: Bad pkginfo: %s' % item, file=sys.stderr)
-
-        # add to hash table
-        if 'installer_item_hash' in item:
-            if not item['installer_item_hash'] in hash_table:
-                hash_table[item['installer_item_hash']] = []
-            hash_table[item['installer_item_hash']].append(itemindex)
-
-        # add to installer item table
-        if 'installer_item_location' in item:
-            installer_item_name = os.path.basename(
-                item['installer_item_location'])
-            (name, ext) = os.path.splitext(installer_item_name)
-            if '-' in name:
-                (name, vers) = pkgutils.nameAndVersion(name)
-            installer_item_name = name + ext
-            if not installer_item_name in installer_item_table:
-                installer_item_table[installer_item_name] = {}
-            if not vers in installer_item_table[installer_item_name]:
-                installer_item_table[installer_item_name][vers] = []
-            installer_item_table[installer_item_name][vers].append(itemindex)
-
-        # add to table of receipts
-        for receipt in item.get('receipts', []):
-            try:
-                if 'packageid' in receipt and 'version' in receipt:
-                    pkgid = receipt['packageid']
-                    pkgvers = receipt['version']
-                    if not pkgid in pkgid_table:
-                        pkgid_table[pkgid] = {}
-                    if not pkgvers in pkgid_table[pkgid]:
-                        pkgid_table[pkgid][pkgvers] = []
-                    pkgid_table[pkgid][pkgvers].append(itemindex)
-            except (TypeError, AttributeError):
-                print('Bad receipt data for %s-%s: %s' % (name, vers, receipt),
-                      file=sys.stderr)
-
-        # add to table of installed applications
-        for install in item.get('installs', []):
-            try:
-                if install.get('type') == 'application':
-                    if 'path' in install:
-                        if not install['path'] in app_table:
-                            app_table[install['path']] = {}
-                        if not vers in app_table[install['path']]:
-                            app_table[install['path']][vers] = []
-                        app_table[install['path']][vers].append(itemindex)
-            except (TypeError, AttributeError):
-                print('Bad install data for %s-%s: %s' % (name, vers, install),
-                      file=sys.stderr)
-
-        # add to table of PayloadIdentifiers
-        if 'PayloadIdentifier' in item:
-            if not item['PayloadIdentifier'] in profile_table:
-                profile_table[item['PayloadIdentifier']] = {}
-            if not vers in profile_table[item['PayloadIdentifier']]:
-                profile_table[item['PayloadIdentifier']][vers] = []
-            profile_table[item['PayloadIdentifier']][vers].append(itemindex)
-
-    pkgdb = {}
-    pkgdb['hashes'] = hash_table
-    pkgdb['receipts'] = pkgid_table
-    pkgdb['applications'] = app_table
-    pkgdb['installer_items'] = installer_item_table
-    pkgdb['profiles'] = profile_table
-    pkgdb['items'] = catalogitems
-
-    return pkgdb
+        catdb = catalogdb.open_catalog_db(repo)
+    except (sqlite3.Error, OSError, IOError):
+        catdb = None
+    if catdb is None:
+        return make_catalog_db(repo)
+    return catdb
 
 
 def find_matching_pkginfo(repo, pkginfo):
@@ -256,7 +204,7 @@ def find_matching_pkginfo(repo, pkginfo):
     Returns a pkginfo dictionary, or an empty dict"""
 
     try:
-        catdb = make_catalog_db(repo)
+        catdb = get_catalog_db(repo)
     except CatalogReadException as err:
         # could not retrieve catalogs/all
         # do we have any existing pkgsinfo items?
@@ -273,6 +221,16 @@ def find_matching_pkginfo(repo, pkginfo):
                % err)
         return {}
 
+    try:
+        return match_pkginfo_in_catalog_db(catdb, pkginfo)
+    finally:
+        if isinstance(catdb, catalogdb.CatalogDB):
+            catdb.close()
+
+
+def match_pkginfo_in_catalog_db(catdb, pkginfo):
+    """Looks up pkginfo in a catalog db
+    Returns a pkginfo dictionary, or an empty dict"""
     if 'installer_item_hash' in pkginfo:
         matchingindexes = catdb['hashes'].get(
             pkginfo['installer_item_hash'])
@@ -0,0 +1,284 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+pkgdedup
+
+Finds byte-identical installer items in a repo's pkgs directory, for
+repoclean.
+
+Items are grouped by size first, so only items that share a size with
+another are ever hashed. For those, the installer_item_hash or
+uninstaller_item_hash from a pkginfo is used where there is one; otherwise
+the item is hashed, and the result kept in a SQLite cache in the user's
+cache directory, valid as long as the file's size and modification time
+don't change.
+
+For a file repo, duplicates can then be replaced with hardlinks to one
+canonical copy, or the pkginfo referring to them can be pointed at the
+canonical copy and the duplicates deleted.
+"""
+# This code is largely still compatible with Python 2, so for now, turn off
+# Python 3 style warnings
+# pylint: disable=consider-using-f-string
+# pylint: disable=redundant-u-string-prefix
+
+from __future__ import absolute_import, print_function
+
+import os
+import sqlite3
+
+from .. import munkihash
+from .. import munkirepo
+from ..wrappers import (readPlistFromString, writePlistToString,
+                        PlistReadError)
+from .common import repo_cache_key
+
+
+CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.repoclean')
+
+# the pkginfo keys that refer to items in pkgs/
+LOCATION_KEYS = ('installer_item_location', 'uninstaller_item_location')
+
+
+class PkgDedupError(Exception):
+    '''Exception to throw if we can't deduplicate a repo's pkgs'''
+    #pass
+
+
+class HashCache(object):
+    """SHA-256 hashes of files, stored in a SQLite database at path. A
+    cached hash is used only while the file's size and modification time
+    are those it was stored with."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+            'size INTEGER, mtime REAL, sha256 TEXT)')
+
+    def close(self):
+        """Closes the database"""
+        self.conn.close()
+
+    def get(self, path, size, mtime):
+        """Returns the cached hash for path, or None"""
+        row = self.conn.execute(
+            'SELECT sha256 FROM hashes WHERE path = ? AND size = ? '
+            'AND mtime = ?', (path, size, mtime)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def set_many(self, entries):
+        """Stores (path, size, mtime, sha256) entries"""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO hashes (path, size, mtime, sha256) '
+                'VALUES (?, ?, ?, ?)', entries)
+
+
+def cache_path(repo):
+    """Returns the path of the hash cache for repo, or None if repo can't
+    be told apart from others between runs"""
+    cache_key = repo_cache_key(repo)
+    if not cache_key:
+        return None
+    return os.path.join(CACHE_DIR, 'pkghashes-%s.sqlite' % cache_key)
+
+
+def open_hash_cache(repo):
+    """Returns a HashCache for repo, or None if there's no cache for repo.
+    Raises sqlite3.Error or OSError if the cache can't be used."""
+    path = cache_path(repo)
+    if not path:
+        return None
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    return HashCache(path)
+
+
+def pkg_local_path(repo, pkg):
+    """Returns the local path of pkgs/pkg, or None if repo isn't local"""
+    try:
+        return repo.local_path(os.path.join('pkgs', pkg))
+    except AttributeError:
+        # no guarantee all repo plugins have the local_path method
+        return None
+
+
+def _pkg_stats(repo, pkgs_list, pkginfo_pkgs):
+    """Returns {pkg: {'size', 'mtime', 'file_id'}} for the pkgs we can size.
+    Local files are sized with stat, and the file_id tells hardlinks apart
+    from copies; other repos can only use the size and hash in pkginfo."""
+    stats = {}
+    for pkg in pkgs_list:
+        path = pkg_local_path(repo, pkg)
+        if path:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[pkg] = {'size': stat.st_size,
+                          'mtime': stat.st_mtime,
+                          'file_id': (stat.st_dev, stat.st_ino)}
+        elif pkginfo_pkgs.get(pkg, {}).get('hash'):
+            stats[pkg] = {'size': pkginfo_pkgs[pkg]['size'],
+                          'mtime': None,
+                          'file_id': pkg}
+    return stats
+
+
+def _canonical_sort_key(pkg, pkginfo_pkgs):
+    """Sorts the most referenced pkg first, then the shortest path"""
+    references = len(pkginfo_pkgs.get(pkg, {}).get('references', []))
+    return (-references, len(pkg), pkg)
+
+
+def find_duplicates(repo, pkgs_list, pkginfo_pkgs, hash_cache=None,
+                    verify=False, max_workers=None):
+    """Finds sets of identical pkgs.
+
+    Args:
+      repo: the repo the pkgs are in.
+      pkgs_list: the items in the repo's pkgs directory.
+      pkginfo_pkgs: {pkg: {'hash': sha256 or None, 'size': bytes,
+          'references': [(pkginfo resource_identifier, location key)]}}
+          for the pkgs referred to by pkginfo.
+      hash_cache: an optional HashCache for hashes we compute.
+      verify: if True, don't trust the hashes in pkginfo; hash the files.
+      max_workers: the number of threads to hash files with.
+
+    Returns:
+      A list of duplicate sets, most reclaimable space first. Each is a
+      dict with the 'sha256' and 'size' of the pkgs, the 'pkgs' themselves
+      with the 'canonical' one first, the 'file_ids' of each pkg, and the
+      'reclaimable' space in bytes. Pkgs that are already hardlinked to each
+      other share a file_id, and count as one copy.
+    """
+    stats = _pkg_stats(repo, pkgs_list, pkginfo_pkgs)
+
+    by_size = {}
+    for pkg in sorted(stats):
+        by_size.setdefault(stats[pkg]['size'], []).append(pkg)
+
+    hashes = {}
+    to_hash = {}
+    for (size, pkgs) in by_size.items():
+        if len(set(stats[pkg]['file_id'] for pkg in pkgs)) < 2:
+            continue
+        for pkg in pkgs:
+            sha256 = None
+            if not verify or stats[pkg]['mtime'] is None:
+                sha256 = pkginfo_pkgs.get(pkg, {}).get('hash')
+            if not sha256 and hash_cache and stats[pkg]['mtime'] is not None:
+                sha256 = hash_cache.get(pkg, size, stats[pkg]['mtime'])
+            if sha256:
+                hashes[pkg] = sha256
+            elif stats[pkg]['mtime'] is not None:
+                to_hash[pkg_local_path(repo, pkg)] = pkg
+
+    new_entries = []
+    for (path, sha256) in munkihash.getsha256hashes(
+            list(to_hash), max_workers=max_workers).items():
+        if sha256 in ('NOT A FILE', 'HASH_ERROR'):
+            continue
+        pkg = to_hash[path]
+        hashes[pkg] = sha256
+        new_entries.append(
+            (pkg, stats[pkg]['size'], stats[pkg]['mtime'], sha256))
+    if hash_cache and new_entries:
+        hash_cache.set_many(new_entries)
+
+    by_hash = {}
+    for pkg in hashes:
+        by_hash.setdefault(
+            (stats[pkg]['size'], hashes[pkg]), []).append(pkg)
+
+    duplicates = []
+    for ((size, sha256), pkgs) in by_hash.items():
+        file_ids = dict((pkg, stats[pkg]['file_id']) for pkg in pkgs)
+        copies = len(set(file_ids.values()))
+        if copies < 2:
+            continue
+        pkgs.sort(key=lambda pkg: _canonical_sort_key(pkg, pkginfo_pkgs))
+        duplicates.append({'sha256': sha256,
+                           'size': size,
+                           'pkgs': pkgs,
+                           'canonical': pkgs[0],
+                           'file_ids': file_ids,
+                           'reclaimable': size * (copies - 1)})
+    duplicates.sort(key=lambda item: (-item['reclaimable'], item['canonical']))
+    return duplicates
+
+
+def hardlink_duplicates(repo, duplicate_set):
+    """Replaces each pkg in duplicate_set with a hardlink to the canonical
+    one. Returns a list of (pkg, error message) for those that failed."""
+    canonical = duplicate_set['canonical']
+    canonical_path = pkg_local_path(repo, canonical)
+    if not canonical_path:
+        raise PkgDedupError('Hardlinking requires a file repo')
+    errors = []
+    for pkg in duplicate_set['pkgs'][1:]:
+        if (duplicate_set['file_ids'][pkg] ==
+                duplicate_set['file_ids'][canonical]):
+            # already the same file
+            continue
+        path = pkg_local_path(repo, pkg)
+        tmp_path = path + '.repoclean-link'
+        try:
+            # link beside the duplicate, then rename over it, so the pkg is
+            # never missing
+            os.link(canonical_path, tmp_path)
+            os.rename(tmp_path, path)
+        except OSError as err:
+            errors.append((pkg, str(err)))
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+    return errors
+
+
+def consolidate_duplicates(repo, duplicate_set, pkginfo_pkgs):
+    """Points every pkginfo that refers to a pkg in duplicate_set at the
+    canonical one, then deletes the other pkgs. A pkg is only deleted once
+    every pkginfo referring to it has been updated. Returns a list of (item,
+    error message) for anything that failed."""
+    canonical = duplicate_set['canonical']
+    if not pkg_local_path(repo, canonical):
+        raise PkgDedupError('Consolidating duplicates requires a file repo')
+    errors = []
+    for pkg in duplicate_set['pkgs'][1:]:
+        updated_all = True
+        for (resource_identifier, key) in pkginfo_pkgs.get(
+                pkg, {}).get('references', []):
+            try:
+                pkginfo = readPlistFromString(repo.get(resource_identifier))
+                if pkginfo.get(key) == pkg:
+                    pkginfo[key] = canonical
+                    repo.put(resource_identifier, writePlistToString(pkginfo))
+            except (munkirepo.RepoError, PlistReadError) as err:
+                errors.append((resource_identifier, str(err)))
+                updated_all = False
+        if not updated_all:
+            continue
+        try:
+            repo.delete(os.path.join('pkgs', pkg))
+        except munkirepo.RepoError as err:
+            errors.append((pkg, str(err)))
+    return errors
@@ -26,9 +26,11 @@ Much code lifted from the application_usage scripts created by Google MacOps:
 from __future__ import absolute_import, print_function
 
 # standard Python libs
+import atexit
 import logging
 import os
 import sqlite3
+import threading
 import time
 
 # our libs
@@ -39,6 +41,11 @@ from . import prefs
 # SQLite db to store application usage data
 APPLICATION_USAGE_DB = os.path.join(
     prefs.pref('ManagedInstallDir'), 'application_usage.sqlite')
+# how long, in seconds, recorded events may wait in memory before they are
+# written to the database
+FLUSH_INTERVAL = 2.0
+# write pending events as soon as this many distinct events are waiting
+FLUSH_THRESHOLD = 100
 # SQL to detect existence of application usage table
 APPLICATION_USAGE_TABLE_DETECT = 'SELECT * FROM application_usage LIMIT 1'
 # This table creates ~64 bytes of disk data per event.
@@ -71,13 +78,15 @@ APPLICATION_USAGE_TABLE_SELECT = (
     'FROM application_usage'
     )
 
-APPLICATION_USAGE_TABLE_UPDATE = (
-    'UPDATE application_usage SET '
-    'app_version=?,'
-    'app_path=?,'
-    'last_time=?,'
-    'number_times=number_times+1 '
-    'WHERE event=? and bundle_id=?'
+# insert a row, or if there already is one for this event and bundle_id,
+# update it and add to its count. Relies on the primary key's index.
+APPLICATION_USAGE_TABLE_UPSERT = (
+    APPLICATION_USAGE_TABLE_INSERT + ' '
+    'ON CONFLICT(event, bundle_id) DO UPDATE SET '
+    'app_version=excluded.app_version,'
+    'app_path=excluded.app_path,'
+    'last_time=excluded.last_time,'
+    'number_times=number_times+excluded.number_times'
     )
 
 INSTALL_REQUEST_TABLE_DETECT = 'SELECT * FROM install_requests LIMIT 1'
@@ -109,29 +118,58 @@ INSTALL_REQUEST_TABLE_SELECT = (
     'FROM install_requests'
     )
 
-INSTALL_REQUEST_TABLE_UPDATE = (
-    'UPDATE install_requests SET '
-    'item_version=?,'
-    'last_time=?,'
-    'number_times=number_times+1 '
-    'WHERE event=? and item_name=?'
+# insert a row, or if there already is one for this event and item_name,
+# update it and add to its count. Relies on the primary key's index.
+INSTALL_REQUEST_TABLE_UPSERT = (
+    INSTALL_REQUEST_TABLE_INSERT + ' '
+    'ON CONFLICT(event, item_name) DO UPDATE SET '
+    'item_version=excluded.item_version,'
+    'last_time=excluded.last_time,'
+    'number_times=number_times+excluded.number_times'
     )
 
 
 class ApplicationUsageRecorder(object):
     """Tracks application launches, activations, and quits.
-    Also tracks Munki selfservice install and removal requests."""
+    Also tracks Munki selfservice install and removal requests.
+
+    Events are coalesced in memory and written to the database in a single
+    transaction once FLUSH_INTERVAL seconds have passed since the first
+    pending event, when FLUSH_THRESHOLD distinct events are pending, when
+    flush() is called, or when the process exits. The database connection is
+    kept open between writes and uses write-ahead logging, so readers don't
+    block the recorder."""
+
+    def __init__(self, database_name=None, flush_interval=FLUSH_INTERVAL,
+                 flush_threshold=FLUSH_THRESHOLD):
+        """Args:
+          database_name: str, default APPLICATION_USAGE_DB
+          flush_interval: float seconds; 0 writes every event immediately
+          flush_threshold: int number of distinct pending events
+        """
+        self.database_name = database_name or APPLICATION_USAGE_DB
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._conn = None
+        self._lock = threading.RLock()
+        self._timer = None
+        # (event, bundle_id) -> [app_version, app_path, last_time, count]
+        self._pending_usage = {}
+        # (event, item_name) -> [item_version, last_time, count]
+        self._pending_requests = {}
+        # whether flush is registered to run at exit; it is while events
+        # might be pending, and close() unregisters it
+        self._flush_at_exit = False
 
     def _connect(self, database_name=None):
         """Connect to database.
         Args:
-          database_name: str, default APPLICATION_USAGE_DB
+          database_name: str, default self.database_name
         Returns:
           sqlite3.Connection instance
         """
-        # pylint: disable=no-self-use
         if database_name is None:
-            database_name = APPLICATION_USAGE_DB
+            database_name = self.database_name
 
         conn = sqlite3.connect(database_name)
         return conn
@@ -200,32 +238,6 @@ class ApplicationUsageRecorder(object):
         # pylint: disable=no-self-use
         conn.execute(APPLICATION_USAGE_TABLE_CREATE)
 
-    def _insert_application_usage(self, conn, event, app_dict):
-        """Insert usage data into application usage table.
-        Args:
-          conn: sqlite3.Connection object
-          event: str
-          app_dict: {bundle_id: str,
-                     version: str,
-                     path: str}
-        """
-        # pylint: disable=no-self-use
-        # this looks weird, but it's the simplest way to do an update or insert
-        # operation in sqlite, and atomically update number_times, that I could
-        # figure out.  plus we avoid using transactions and multiple SQL
-        # statements in most cases.
-
-        now = int(time.time())
-        bundle_id = app_dict.get('bundle_id', 'UNKNOWN_APP')
-        app_version = app_dict.get('version', '0')
-        app_path = app_dict.get('path', '')
-        data = (app_version, app_path, now, event, bundle_id)
-        query = conn.execute(APPLICATION_USAGE_TABLE_UPDATE, data)
-        if query.rowcount == 0:
-            number_times = 1
-            data = (event, bundle_id, app_version, app_path, now, number_times)
-            conn.execute(APPLICATION_USAGE_TABLE_INSERT, data)
-
     def _create_install_request_table(self, conn):
         """Create install request table when it does not exist.
         Args:
@@ -236,31 +248,6 @@ class ApplicationUsageRecorder(object):
         # pylint: disable=no-self-use
         conn.execute(INSTALL_REQUEST_TABLE_CREATE)
 
-    def _insert_install_request(self, conn, request_dict):
-        """Insert usage data into application usage table.
-        Args:
-          conn: sqlite3.Connection object
-          event: str
-          request_dict: {name: str,
-                         version: str}
-        """
-        # pylint: disable=no-self-use
-        # this looks weird, but it's the simplest way to do an update or insert
-        # operation in sqlite, and atomically update number_times, that I could
-        # figure out.  plus we avoid using transactions and multiple SQL
-        # statements in most cases.
-
-        now = int(time.time())
-        event = request_dict.get('event', 'UNKNOWN_EVENT')
-        item_name = request_dict.get('name', 'UNKNOWN_ITEM')
-        item_version = request_dict.get('version', '0')
-        data = (item_version, now, event, item_name)
-        query = conn.execute(INSTALL_REQUEST_TABLE_UPDATE, data)
-        if query.rowcount == 0:
-            number_times = 1
-            data = (event, item_name, item_version, now, number_times)
-            conn.execute(INSTALL_REQUEST_TABLE_INSERT, data)
-
     def _recreate_database(self):
         """Recreate a database.
         Returns:
@@ -296,7 +283,7 @@ class ApplicationUsageRecorder(object):
             logging.error('Unhandled error reading existing db: %s', str(err))
             return recovered
 
-        usage_db_tmp = '%s.tmp.%d' % (APPLICATION_USAGE_DB, os.getpid())
+        usage_db_tmp = '%s.tmp.%d' % (self.database_name, os.getpid())
 
         recovered = 0
         try:
@@ -315,8 +302,8 @@ class ApplicationUsageRecorder(object):
                         logging.error(
                             'Ignored error: %s: %s', str(err), str(row))
             self._close(conn)
-            os.unlink(APPLICATION_USAGE_DB)
-            os.rename(usage_db_tmp, APPLICATION_USAGE_DB)
+            os.unlink(self.database_name)
+            os.rename(usage_db_tmp, self.database_name)
         except sqlite3.Error as err:
             logging.error('Unhandled error: %s', str(err))
             recovered = 0
@@ -338,6 +325,7 @@ class ApplicationUsageRecorder(object):
         if not query_ok:
             if fix:
                 logging.warning('Recreating database.')
+                self._reset_connection()
                 logging.warning(
                     'Recovered %d rows.', self._recreate_database())
             else:
@@ -345,6 +333,97 @@ class ApplicationUsageRecorder(object):
         else:
             logging.info('Database is OK.')
 
+    def _connection(self):
+        """Returns our long-lived database connection, opening it and
+        making sure our tables exist if needed.
+        Raises:
+          sqlite3.Error: if error occurs
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.database_name, check_same_thread=False)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                if not self._detect_application_usage_table(conn):
+                    self._create_application_usage_table(conn)
+                if not self._detect_install_request_table(conn):
+                    self._create_install_request_table(conn)
+                conn.commit()
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _reset_connection(self):
+        """Closes our long-lived database connection, if open"""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+
+    def _schedule_flush(self):
+        """Flushes pending events now if there are enough of them, otherwise
+        makes sure a flush is scheduled. Call with self._lock held."""
+        if not self._flush_at_exit:
+            atexit.register(self.flush)
+            self._flush_at_exit = True
+        pending_count = len(self._pending_usage) + len(self._pending_requests)
+        if not self.flush_interval or pending_count >= self.flush_threshold:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes all pending events to the database in one transaction."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending_usage and not self._pending_requests:
+                return
+            usage_rows = [
+                (event, bundle_id, app_version, app_path, last_time, count)
+                for ((event, bundle_id),
+                     (app_version, app_path, last_time, count))
+                in self._pending_usage.items()]
+            request_rows = [
+                (event, item_name, item_version, last_time, count)
+                for ((event, item_name),
+                     (item_version, last_time, count))
+                in self._pending_requests.items()]
+            self._pending_usage = {}
+            self._pending_requests = {}
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.executemany(
+                        APPLICATION_USAGE_TABLE_UPSERT, usage_rows)
+                    conn.executemany(
+                        INSTALL_REQUEST_TABLE_UPSERT, request_rows)
+            except sqlite3.OperationalError as err:
+                logging.error('Error writing %d events to database: %s',
+                              len(usage_rows) + len(request_rows), err)
+            except sqlite3.DatabaseError as err:
+                if err.args[0] == 'database disk image is malformed':
+                    self._reset_connection()
+                    self._recreate_database()
+                logging.error('Database error: %s', err)
+
+    def close(self):
+        """Writes any pending events and closes the database connection."""
+        with self._lock:
+            self.flush()
+            self._reset_connection()
+            if self._flush_at_exit:
+                atexit.unregister(self.flush)
+                self._flush_at_exit = False
+
     def log_application_usage(self, event, app_dict):
         """Log application usage.
         Args:
@@ -360,19 +439,15 @@ class ApplicationUsageRecorder(object):
                       app_dict.get('bundle_id'),
                       app_dict.get('version'),
                       app_dict.get('path'))
-        try:
-            conn = self._connect()
-            if not self._detect_application_usage_table(conn):
-                self._create_application_usage_table(conn)
-            self._insert_application_usage(conn, event, app_dict)
-            conn.commit()
-        except sqlite3.OperationalError as err:
-            logging.error('Error writing %s event to database: %s', event, err)
-        except sqlite3.DatabaseError as err:
-            if err.args[0] == 'database disk image is malformed':
-                self._recreate_database()
-            logging.error('Database error: %s', err)
-        self._close(conn)
+        key = (event, app_dict.get('bundle_id', 'UNKNOWN_APP'))
+        with self._lock:
+            pending = self._pending_usage.get(key)
+            self._pending_usage[key] = [
+                app_dict.get('version', '0'),
+                app_dict.get('path', ''),
+                int(time.time()),
+                pending[3] + 1 if pending else 1]
+            self._schedule_flush()
 
     def log_install_request(self, request_dict):
         """Log install request.
@@ -392,20 +467,20 @@ class ApplicationUsageRecorder(object):
                       request_dict.get('event'),
                       request_dict.get('name'),
                       request_dict.get('version'))
+        key = (request_dict.get('event', 'UNKNOWN_EVENT'),
+               request_dict.get('name', 'UNKNOWN_ITEM'))
+        with self._lock:
+            pending = self._pending_requests.get(key)
+            self._pending_requests[key] = [
+                request_dict.get('version', '0'),
+                int(time.time()),
+                pending[2] + 1 if pending else 1]
+            self._schedule_flush()
 
-        try:
-            conn = self._connect()
-            if not self._detect_install_request_table(conn):
-                self._create_install_request_table(conn)
-            self._insert_install_request(conn, request_dict)
-            conn.commit()
-        except sqlite3.OperationalError as err:
-            logging.error('Error writing install request to database: %s', err)
-        except sqlite3.DatabaseError as err:
-            if err.args[0] == 'database is malformed':
-                self._recreate_database()
-            logging.error('Database error: %s', err)
-        self._close(conn)
+
+# SQLite's default limit on the number of ? parameters in one statement has
+# been as low as 999; stay under it
+MAX_QUERY_PARAMETERS = 900
 
 
 class ApplicationUsageQuery(object):
@@ -507,6 +582,85 @@ class ApplicationUsageQuery(object):
                 'Error querying %s: %s', self.database, str(err))
             return None
 
+    def _has_install_requests_table(self):
+        '''Returns True if the database has an install_requests table,
+        which is only made the first time an install request is logged.
+        Raises sqlite3.Error if the database can't be queried.'''
+        try:
+            self.conn.execute(INSTALL_REQUEST_TABLE_DETECT)
+        except sqlite3.OperationalError as err:
+            if err.args[0].startswith('no such table'):
+                return False
+            raise
+        return True
+
+    def days_since_last_events(self, bundle_ids, item_names,
+                               usage_event='activate',
+                               install_event='install'):
+        '''Looks up, in a single query, how many days of data we have, the
+        days since the last usage_event for each of bundle_ids, and the days
+        since the last install_event request for each of item_names. (Very
+        long lists are split across several queries.)
+        Returns None if database is missing or broken; otherwise a dict:
+            {'days_of_data': int, or None if there is no usage data,
+             'usage': {bundle_id: days},
+             'install': {item_name: days}}
+        bundle_ids and item_names with no matching record are left out.'''
+        if not self.conn:
+            return None
+        bundle_ids = sorted(set(bundle_ids))
+        item_names = sorted(set(item_names))
+        now = int(time.time())
+        result = {'days_of_data': None, 'usage': {}, 'install': {}}
+        chunk_size = MAX_QUERY_PARAMETERS
+        first = True
+        try:
+            if item_names and not self._has_install_requests_table():
+                # no install requests have ever been logged
+                item_names = []
+            while first or bundle_ids or item_names:
+                usage_chunk = bundle_ids[:chunk_size]
+                bundle_ids = bundle_ids[chunk_size:]
+                install_chunk = item_names[:chunk_size - len(usage_chunk)]
+                item_names = item_names[len(install_chunk):]
+                statements = []
+                parameters = []
+                if first:
+                    statements.append(
+                        "SELECT 'oldest', '', MIN(last_time) "
+                        "FROM application_usage")
+                if usage_chunk:
+                    statements.append(
+                        "SELECT 'usage', bundle_id, last_time "
+                        "FROM application_usage "
+                        "WHERE event=? AND bundle_id IN (%s)"
+                        % ','.join('?' * len(usage_chunk)))
+                    parameters.append(usage_event)
+                    parameters.extend(usage_chunk)
+                if install_chunk:
+                    statements.append(
+                        "SELECT 'install', item_name, last_time "
+                        "FROM install_requests "
+                        "WHERE event=? AND item_name IN (%s)"
+                        % ','.join('?' * len(install_chunk)))
+                    parameters.append(install_event)
+                    parameters.extend(install_chunk)
+                first = False
+                for (kind, key, last_time) in self.conn.execute(
+                        ' UNION ALL '.join(statements), parameters):
+                    if last_time is None:
+                        continue
+                    days = int((now - int(last_time))/self.day_in_seconds)
+                    if kind == 'oldest':
+                        result['days_of_data'] = days
+                    else:
+                        result[kind][key] = days
+        except sqlite3.Error as err:
+            logging.error(
+                'Error querying %s: %s', self.database, str(err))
+            return None
+        return result
+
 
 if __name__ == '__main__':
     print('This is a library of support tools for the Munki Suite.')
@@ -0,0 +1,290 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bomutils.py
+
+Reads Apple bill of materials (BOM) files, as found in package receipts and
+bundle packages, without running /usr/bin/lsbom.
+
+A BOM file is a "BOMStore": a header, a table of blocks (offset and length
+pairs) and a list of named variables, each naming a block. The "Paths"
+variable names a B+ tree whose leaves list, in order, every path in the
+BOM. Each leaf entry points to a block holding the item's parent id and
+name, and to a block holding its id, which in turn points to a block with
+its type, mode, owner, size, checksum and link target. All integers are
+big-endian.
+
+Layout details follow the format as documented by the bomutils project.
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import struct
+import subprocess
+
+
+BOM_MAGIC = b'BOMStore'
+TREE_MAGIC = b'tree'
+
+# item types
+TYPE_FILE = 1
+TYPE_DIR = 2
+TYPE_LINK = 3
+TYPE_DEV = 4
+
+_HEADER = struct.Struct('>8sIIIIII')
+_COUNT = struct.Struct('>I')
+_VARIABLE = struct.Struct('>IB')
+_POINTER = struct.Struct('>II')
+_TREE = struct.Struct('>4sIIII')
+_PATHS = struct.Struct('>HHII')
+_PATH_INDICES = struct.Struct('>II')
+_PATH_INFO1 = struct.Struct('>II')
+# type, unknown, architecture, mode, user, group, modtime, size, unknown,
+# checksum (or device type), link name length
+_PATH_INFO2 = struct.Struct('>BBHHIIIIBII')
+
+
+class BomError(Exception):
+    '''Error to raise when a BOM file can't be read'''
+    pass
+
+
+class BomReader(object):
+    '''Random access to the blocks and variables of a BOM file. Blocks are
+    read from the open file as they're needed, so a large BOM is never held
+    in memory.'''
+
+    def __init__(self, fileref):
+        self.fileref = fileref
+        try:
+            self.size = os.fstat(fileref.fileno()).st_size
+        except (OSError, IOError) as err:
+            raise BomError('Could not read BOM: %s' % err)
+        (magic, dummy_version, dummy_block_count, index_offset,
+         dummy_index_length, vars_offset,
+         dummy_vars_length) = self.unpack(_HEADER, 0)
+        if magic != BOM_MAGIC:
+            raise BomError('Not a BOM file')
+        (pointer_count, ) = self.unpack(_COUNT, index_offset)
+        data = self.read(index_offset + 4, pointer_count * _POINTER.size)
+        self.pointers = [_POINTER.unpack_from(data, n * _POINTER.size)
+                         for n in range(pointer_count)]
+        self.variables = {}
+        (var_count, ) = self.unpack(_COUNT, vars_offset)
+        offset = vars_offset + 4
+        for dummy_n in range(var_count):
+            (block_index, name_length) = self.unpack(_VARIABLE, offset)
+            offset += _VARIABLE.size
+            try:
+                name = self.read(offset, name_length).decode('UTF-8')
+            except UnicodeDecodeError as err:
+                raise BomError('Invalid BOM variable name: %s' % err)
+            offset += name_length
+            self.variables[name] = block_index
+
+    def read(self, offset, length):
+        '''Returns length bytes from offset in the file'''
+        if offset < 0 or offset + length > self.size:
+            raise BomError('BOM is truncated at offset %s' % offset)
+        try:
+            self.fileref.seek(offset)
+            data = self.fileref.read(length)
+        except (OSError, IOError) as err:
+            raise BomError('Could not read BOM: %s' % err)
+        if len(data) != length:
+            raise BomError('BOM is truncated at offset %s' % offset)
+        return data
+
+    def unpack(self, fmt, offset):
+        '''Unpacks a struct.Struct from offset in the file'''
+        return fmt.unpack(self.read(offset, fmt.size))
+
+    def block(self, index):
+        '''Returns the bytes of a block'''
+        if not 0 < index < len(self.pointers):
+            raise BomError('Invalid BOM block index %s' % index)
+        (offset, length) = self.pointers[index]
+        if offset + length > self.size:
+            raise BomError('BOM block %s is out of range' % index)
+        return self.read(offset, length)
+
+    def unpack_block(self, fmt, index):
+        '''Unpacks a struct.Struct from the start of a block'''
+        data = self.block(index)
+        if len(data) < fmt.size:
+            raise BomError('BOM block %s is too short' % index)
+        return fmt.unpack_from(data, 0)
+
+    def leaves(self, variable):
+        '''Yields the (index0, index1) pairs of every entry of the leaves of
+        the B+ tree named by variable, in order'''
+        if variable not in self.variables:
+            raise BomError('BOM has no %s tree' % variable)
+        (magic, dummy_version, node_index, dummy_block_size,
+         dummy_count) = self.unpack_block(_TREE, self.variables[variable])
+        if magic != TREE_MAGIC:
+            raise BomError('BOM %s is not a tree' % variable)
+        # descend to the leftmost leaf
+        seen = set()
+        while True:
+            data = self.block(node_index)
+            if len(data) < _PATHS.size:
+                raise BomError('BOM tree node %s is too short' % node_index)
+            (is_leaf, count, forward,
+             dummy_backward) = _PATHS.unpack_from(data, 0)
+            if is_leaf:
+                break
+            if (not count or node_index in seen or
+                    len(data) < _PATHS.size + _PATH_INDICES.size):
+                raise BomError('Invalid BOM tree node %s' % node_index)
+            seen.add(node_index)
+            (node_index, dummy_index1) = _PATH_INDICES.unpack_from(
+                data, _PATHS.size)
+        # then follow the chain of leaves, reading one leaf at a time
+        while node_index:
+            if node_index in seen:
+                raise BomError('Loop in BOM tree at node %s' % node_index)
+            seen.add(node_index)
+            data = self.block(node_index)
+            if len(data) < _PATHS.size:
+                raise BomError('BOM tree node %s is too short' % node_index)
+            (is_leaf, count, forward,
+             dummy_backward) = _PATHS.unpack_from(data, 0)
+            if _PATHS.size + count * _PATH_INDICES.size > len(data):
+                raise BomError('BOM tree node %s is too short' % node_index)
+            for n in range(count):
+                yield _PATH_INDICES.unpack_from(
+                    data, _PATHS.size + n * _PATH_INDICES.size)
+            node_index = forward
+
+    def file_name(self, index):
+        '''Returns (parent id, name) from a BOMFile block'''
+        data = self.block(index)
+        if len(data) < 5:
+            raise BomError('BOM file block %s is too short' % index)
+        (parent, ) = _COUNT.unpack_from(data, 0)
+        name = data[4:].split(b'\0', 1)[0]
+        return (parent, name.decode('UTF-8', 'surrogateescape'))
+
+    def path_info(self, index):
+        '''Returns (id, type, mode, uid, gid, size, checksum, linkname) from
+        a BOMPathInfo1 block and the BOMPathInfo2 block it points to'''
+        (item_id, info_index) = self.unpack_block(_PATH_INFO1, index)
+        data = self.block(info_index)
+        if len(data) < _PATH_INFO2.size:
+            raise BomError('BOM path info block %s is too short' % info_index)
+        (item_type, dummy_unknown0, dummy_arch, mode, uid, gid,
+         dummy_modtime, size, dummy_unknown1, checksum,
+         link_length) = _PATH_INFO2.unpack_from(data, 0)
+        linkname = ''
+        if item_type == TYPE_LINK and link_length:
+            start = _PATH_INFO2.size
+            linkname = data[start:start + link_length].split(
+                b'\0', 1)[0].decode('UTF-8', 'surrogateescape')
+        return (item_id, item_type, mode, uid, gid, size, checksum, linkname)
+
+
+def bom_items(bompath):
+    '''Yields a tuple for every item in the BOM file at bompath, in BOM
+    order: (path, type, mode, uid, gid, size, checksum, linkname). Paths
+    are as lsbom prints them: '.', './Applications', ...
+    The file is read a block at a time as items are yielded.
+    Raises BomError if the file can't be read or isn't a valid BOM.'''
+    try:
+        fileref = open(bompath, 'rb')
+    except (OSError, IOError) as err:
+        raise BomError('Could not read %s: %s' % (bompath, err))
+    with fileref:
+        reader = BomReader(fileref)
+        # paths of the directories seen so far, by item id
+        paths = {}
+        # items whose parent we haven't seen yet, by parent id
+        waiting = {}
+        for (info_index, file_index) in reader.leaves('Paths'):
+            (parent, name) = reader.file_name(file_index)
+            info = reader.path_info(info_index)
+            if parent and parent not in paths:
+                waiting.setdefault(parent, []).append((name, info))
+                continue
+            ready = [(parent, name, info)]
+            while ready:
+                (parent, name, info) = ready.pop(0)
+                if parent:
+                    path = paths[parent] + '/' + name
+                else:
+                    path = name
+                if info[1] == TYPE_DIR:
+                    paths[info[0]] = path
+                yield (path, ) + info[1:]
+                for (child_name, child_info) in waiting.pop(info[0], []):
+                    ready.append((info[0], child_name, child_info))
+        if waiting:
+            raise BomError('BOM items refer to missing parent ids %s'
+                           % sorted(waiting))
+
+
+def bom_entries(bompath):
+    '''Yields (path, mode, uid, gid) for every item in the BOM file at
+    bompath. Raises BomError if the file can't be read.'''
+    for item in bom_items(bompath):
+        yield (item[0], item[2], item[3], item[4])
+
+
+def bom_paths(bompath):
+    '''Returns a list of all paths in the BOM file at bompath, like
+    lsbom -s. Raises BomError if the file can't be read.'''
+    return [item[0] for item in bom_items(bompath)]
+
+
+def lsbom_line(item):
+    '''Formats an item from bom_items() the way lsbom does by default'''
+    (path, item_type, mode, uid, gid, size, checksum, linkname) = item
+    fields = [path, '%o' % mode, '%s/%s' % (uid, gid)]
+    if item_type == TYPE_FILE:
+        fields.extend([str(size), str(checksum)])
+    elif item_type == TYPE_LINK:
+        fields.extend([str(size), str(checksum), linkname])
+    elif item_type == TYPE_DEV:
+        fields.append(str(checksum))
+    return '\t'.join(fields)
+
+
+def lsbom(bompath):
+    '''Returns (path, mode, uid, gid) for every item in the BOM file at
+    bompath, as reported by /usr/bin/lsbom. For comparison with
+    bom_entries(), and as a fallback for BOMs it can't read.
+    Raises BomError if lsbom fails.'''
+    proc = subprocess.Popen(['/usr/bin/lsbom', bompath],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, error) = proc.communicate()
+    if proc.returncode:
+        raise BomError('lsbom %s failed: %s'
+                       % (bompath, error.decode('UTF-8', 'replace')))
+    entries = []
+    for line in output.decode('UTF-8', 'surrogateescape').splitlines():
+        fields = line.split('\t')
+        try:
+            (uid, gid) = fields[2].split('/')
+            entries.append((fields[0], int(fields[1], 8), int(uid), int(gid)))
+        except (IndexError, ValueError):
+            # we really only care about the path
+            entries.append((fields[0], 0, 0, 0))
+    return entries
+
+
+if __name__ == '__main__':
+    print('This is a library of support tools for the Munki Suite.')
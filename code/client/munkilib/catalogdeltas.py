@@ -0,0 +1,136 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogdeltas.py
+
+Support for delta catalog updates, shared by makecatalogs and
+managedsoftwareupdate.
+
+makecatalogs keeps a short history of each catalog's revisions under
+catalogs/_deltas/<catalogname>/ and publishes, for each recent revision, a
+delta that transforms that revision into the current one. Items are keyed by
+the SHA-256 hash of their serialized plist, so a delta only carries the
+items that were added or changed, plus a list of copy/insert operations that
+rebuilds the current item order from the old one.
+
+Layout of catalogs/_deltas/<catalogname>/:
+    history.plist   -- used only by makecatalogs: item hashes for each of the
+                       recent revisions
+    index.plist     -- current revision and hash, plus the available deltas
+    <from>-<to>.plist  -- a delta from revision <from> to revision <to>
+
+Clients identify their cached revision by the SHA-256 of the cached catalog
+file, and verify a patched catalog against the SHA-256 of the current full
+catalog before using it.
+"""
+from __future__ import absolute_import, print_function
+
+import difflib
+import hashlib
+
+from .wrappers import writePlistToString
+
+
+# subdirectory of catalogs/ that holds revision history and deltas
+DELTAS_DIR = '_deltas'
+HISTORY_NAME = 'history.plist'
+INDEX_NAME = 'index.plist'
+
+
+class CatalogDeltaError(Exception):
+    '''Error to raise when a catalog delta can't be made or applied'''
+    pass
+
+
+def catalog_hash(data):
+    '''Returns the SHA-256 hex digest of serialized catalog data'''
+    return hashlib.sha256(data).hexdigest()
+
+
+def item_hash(item):
+    '''Returns the SHA-256 hex digest of the serialized form of a single
+    catalog item'''
+    return hashlib.sha256(writePlistToString(item)).hexdigest()
+
+
+def delta_name(from_revision, to_revision):
+    '''Returns the file name of a delta between two revisions'''
+    return '%s-%s.plist' % (from_revision, to_revision)
+
+
+def make_delta(old_hashes, new_hashes, new_items):
+    '''Builds a delta that transforms a catalog whose items have old_hashes
+    into one whose items are new_items (with item hashes new_hashes).
+
+    Returns a dictionary with:
+        ops: list of {'copy': [start, count]} (copy items from the old
+             catalog) and {'insert': [hash, ...]} (insert items from 'added')
+        added: dictionary of item hash -> item for items not in the old
+             catalog
+        removed: list of item hashes no longer in the catalog'''
+    old_set = set(old_hashes)
+    new_set = set(new_hashes)
+    added = {}
+    for (hash_value, item) in zip(new_hashes, new_items):
+        if hash_value not in old_set:
+            added[hash_value] = item
+    removed = sorted(old_set - new_set)
+
+    ops = []
+    matcher = difflib.SequenceMatcher(
+        None, old_hashes, new_hashes, autojunk=False)
+    for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append({'copy': [i1, i2 - i1]})
+        elif tag in ('replace', 'insert'):
+            inserted = list(new_hashes[j1:j2])
+            # an item we insert might exist in the old catalog at another
+            # position; make sure we carry it
+            for (offset, hash_value) in enumerate(inserted):
+                if hash_value not in added:
+                    added[hash_value] = new_items[j1 + offset]
+            if ops and 'insert' in ops[-1]:
+                ops[-1]['insert'].extend(inserted)
+            else:
+                ops.append({'insert': inserted})
+        # 'delete' needs no operation; those items simply aren't copied
+    return {'ops': ops, 'added': added, 'removed': removed}
+
+
+def apply_delta(old_items, delta):
+    '''Applies a delta made by make_delta to the list of old catalog items.
+    Returns the new list of items. Raises CatalogDeltaError if the delta
+    doesn't fit old_items.'''
+    added = delta.get('added', {})
+    new_items = []
+    try:
+        for operation in delta['ops']:
+            if 'copy' in operation:
+                start, count = operation['copy']
+                if start < 0 or start + count > len(old_items):
+                    raise CatalogDeltaError(
+                        'Copy of %s items at %s is out of range'
+                        % (count, start))
+                new_items.extend(old_items[start:start + count])
+            elif 'insert' in operation:
+                for hash_value in operation['insert']:
+                    new_items.append(added[hash_value])
+            else:
+                raise CatalogDeltaError(
+                    'Unknown delta operation: %s' % operation)
+    except (KeyError, TypeError, ValueError) as err:
+        raise CatalogDeltaError('Invalid delta: %s' % err) from err
+    return new_items
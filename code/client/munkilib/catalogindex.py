@@ -0,0 +1,211 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogindex.py
+
+An on-disk form of a downloaded catalog that managedsoftwareupdate can use
+without decoding every item in it.
+
+The index file is written beside the catalog the first time the catalog is
+loaded after it changes. It holds the lookup tables updatecheck.catalogs
+builds for the catalog, plus each item serialized as its own binary plist.
+Later runs read only the tables, and memory-map the rest of the file; an
+item is decoded the first time it is looked at, and kept from then on.
+
+Layout:
+    header          -- MAGIC, then the length of the table plist (8 bytes)
+    table plist     -- binary plist: the size and modification time of the
+                       catalog the index was made from, the item offsets,
+                       the lookup tables and lists of item indexes
+    items           -- one binary plist per item, back to back
+"""
+from __future__ import absolute_import, print_function
+
+import mmap
+import os
+import plistlib
+import struct
+
+from array import array
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+
+# file name suffix of an index, next to the catalog it was made from
+INDEX_SUFFIX = '.index'
+
+MAGIC = b'MUNKICX1'
+HEADER = struct.Struct('>8sQ')
+# item offsets are stored as native unsigned 64-bit ints; the index never
+# leaves the machine that made it
+OFFSET_TYPECODE = 'Q'
+
+
+class CatalogIndexError(Exception):
+    '''Error to raise when an index can't be written'''
+    pass
+
+
+def index_path(catalogpath):
+    '''Returns the path of the index for the catalog at catalogpath'''
+    return catalogpath + INDEX_SUFFIX
+
+
+def _source_info(catalogpath):
+    '''Returns what we record about the catalog an index was made from'''
+    stat = os.stat(catalogpath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class CatalogItems(Sequence):
+    '''A read-only list of the items in an index. Each item is decoded the
+    first time it is accessed; the same object is returned after that, so
+    changes made to it are seen by later lookups, just as with a list of
+    dicts.'''
+
+    def __init__(self, buffer, data_start, offsets):
+        self._buffer = buffer
+        self._data_start = data_start
+        self._offsets = offsets
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('catalog item index out of range')
+        try:
+            return self._decoded[index]
+        except KeyError:
+            pass
+        start = self._data_start + self._offsets[index]
+        end = self._data_start + self._offsets[index + 1]
+        item = plistlib.loads(self._buffer[start:end])
+        # if another thread got here first, use the item it decoded
+        return self._decoded.setdefault(index, item)
+
+    def decoded_count(self):
+        '''Returns how many items have been decoded so far'''
+        return len(self._decoded)
+
+    def subset(self, indexes):
+        '''Returns a CatalogItemSubset of the items at indexes'''
+        return CatalogItemSubset(self, indexes)
+
+
+class CatalogItemSubset(Sequence):
+    '''A read-only list of some of the items in a CatalogItems, in the order
+    of indexes'''
+
+    def __init__(self, items, indexes):
+        self._items = items
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._items[i] for i in self._indexes[index]]
+        return self._items[self._indexes[index]]
+
+
+def write_index(path, catalogpath, items, tables, item_lists):
+    '''Writes an index for the catalog at catalogpath to path.
+
+    Args:
+      items: the list of items in the catalog.
+      tables: a dict of lookup tables. They must be serializable as a plist.
+      item_lists: a dict of lists of indexes into items.
+
+    Raises CatalogIndexError if the index can't be written.'''
+    offsets = array(OFFSET_TYPECODE, [0])
+    blobs = []
+    try:
+        for item in items:
+            blobs.append(plistlib.dumps(item, fmt=plistlib.FMT_BINARY))
+            offsets.append(offsets[-1] + len(blobs[-1]))
+        table_data = plistlib.dumps(
+            {'source': _source_info(catalogpath),
+             'offsets': offsets.tobytes(),
+             'tables': tables,
+             'item_lists': item_lists},
+            fmt=plistlib.FMT_BINARY)
+    except (TypeError, ValueError, OverflowError, OSError) as err:
+        raise CatalogIndexError(
+            'Could not index %s: %s' % (catalogpath, err)) from err
+
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as fileref:
+            fileref.write(HEADER.pack(MAGIC, len(table_data)))
+            fileref.write(table_data)
+            for blob in blobs:
+                fileref.write(blob)
+        os.rename(temp_path, path)
+    except (OSError, IOError) as err:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise CatalogIndexError(
+            'Could not write %s: %s' % (path, err)) from err
+
+
+def open_index(path, catalogpath):
+    '''Opens the index at path. Returns (tables, items, item_lists) as passed
+    to write_index, with items as a CatalogItems and each list in item_lists
+    as a CatalogItemSubset; or None if there's no usable index that is
+    current for the catalog at catalogpath.'''
+    try:
+        fileref = open(path, 'rb')
+    except (OSError, IOError):
+        return None
+    with fileref:
+        try:
+            header = fileref.read(HEADER.size)
+            if len(header) != HEADER.size:
+                return None
+            (magic, table_length) = HEADER.unpack(header)
+            if magic != MAGIC:
+                return None
+            index = plistlib.loads(fileref.read(table_length))
+            if index.get('source') != _source_info(catalogpath):
+                return None
+            offsets = array(OFFSET_TYPECODE)
+            offsets.frombytes(index['offsets'])
+            buffer = mmap.mmap(
+                fileref.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, IOError, ValueError, KeyError,
+                plistlib.InvalidFileException):
+            return None
+    # the mapping stays valid after the file is closed
+    data_start = HEADER.size + table_length
+    if not offsets or data_start + offsets[-1] > len(buffer):
+        return None
+    items = CatalogItems(buffer, data_start, offsets)
+    item_lists = dict(
+        (key, items.subset(indexes))
+        for (key, indexes) in index.get('item_lists', {}).items())
+    return (index.get('tables', {}), items, item_lists)
@@ -0,0 +1,183 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogshards.py
+
+Support for name-sharded catalogs, shared by makecatalogs and
+managedsoftwareupdate.
+
+makecatalogs --shards splits each catalog by item name into
+catalogs/_shards/<catalogname>/. Each shard holds every item with one name,
+in catalog order, so a client need only fetch the shards for the names its
+manifests refer to. The index says which shard holds each name, and carries
+what a client would otherwise need the whole catalog for: which items are
+updates for which, which require which, which are marked for autoremoval,
+and the receipts of every item.
+
+Layout of catalogs/_shards/<catalogname>/:
+    index.plist     -- the shard index
+    <hash>.plist    -- the items named <name>, where <hash> is made from
+                       the name by shard_file_name()
+
+Index keys:
+    shards          -- name: {'file', 'hash' (SHA-256 of the shard),
+                       'positions' (of its items in the catalog)}
+    update_for      -- update_for string: names of the items it's in
+    requires        -- name: the requires strings of its items
+    autoremove      -- names of items with autoremove set
+    package_ids     -- [name, [[packageid, version], ...]] for each name
+                       with receipts, as made by merged_package_ids()
+"""
+from __future__ import absolute_import, print_function
+
+import hashlib
+import unicodedata
+
+from .wrappers import is_a_string, writePlistToString
+
+
+# subdirectory of catalogs/ that holds the shards
+SHARDS_DIR = '_shards'
+INDEX_NAME = 'index.plist'
+
+
+def normalized_name(name):
+    '''Returns name as catalog lookups see it'''
+    return unicodedata.normalize('NFC', name)
+
+
+def shard_file_name(name):
+    '''Returns the file name of the shard for items named name. Names can
+    contain anything, so the file is named for a hash of the name.'''
+    return '%s.plist' % hashlib.sha256(
+        normalized_name(name).encode('UTF-8')).hexdigest()[:32]
+
+
+def package_ids_table(catalogitems):
+    '''Returns a list of [name, [[pkgid, version], ...]] for each named
+    catalogitem with receipts'''
+    table = []
+    for item in catalogitems:
+        name = item.get('name')
+        if not name or not item.get('receipts'):
+            continue
+        table.append(
+            [name, [[receipt['packageid'], receipt['version']]
+                    for receipt in item['receipts']
+                    if 'packageid' in receipt and 'version' in receipt]])
+    return table
+
+
+def merged_package_ids(table):
+    '''Merges the entries for each name in a package_ids_table, dropping
+    repeated receipts. The result is smaller, but means the same to
+    updatecheck.catalogs.add_package_ids.'''
+    merged = {}
+    names = []
+    for (name, receipts) in table:
+        if name not in merged:
+            merged[name] = []
+            names.append(name)
+        for receipt in receipts:
+            if receipt not in merged[name]:
+                merged[name].append(receipt)
+    return [[name, merged[name]] for name in names]
+
+
+def _string_list(value):
+    '''Returns value as a list, allowing for a single string'''
+    if is_a_string(value):
+        return [value]
+    return list(value or [])
+
+
+def make_shards(items):
+    '''Splits the list of catalog items into shards.
+
+    Returns (index, shards), where shards is a dictionary of shard file
+    name -> serialized shard data.'''
+    by_name = {}
+    positions = {}
+    index = {'shards': {},
+             'update_for': {},
+             'requires': {},
+             'autoremove': [],
+             'package_ids': merged_package_ids(package_ids_table(items))}
+    for (position, item) in enumerate(items):
+        name = normalized_name(item.get('name', 'NO NAME'))
+        by_name.setdefault(name, []).append(item)
+        positions.setdefault(name, []).append(position)
+        for update_for in _string_list(item.get('update_for')):
+            names = index['update_for'].setdefault(update_for, [])
+            if name not in names:
+                names.append(name)
+        for requires in _string_list(item.get('requires')):
+            requirements = index['requires'].setdefault(name, [])
+            if requires not in requirements:
+                requirements.append(requires)
+        if item.get('autoremove') and name not in index['autoremove']:
+            index['autoremove'].append(name)
+
+    shards = {}
+    for name in sorted(by_name):
+        file_name = shard_file_name(name)
+        shards[file_name] = writePlistToString(by_name[name])
+        index['shards'][name] = {
+            'file': file_name,
+            'hash': hashlib.sha256(shards[file_name]).hexdigest(),
+            'positions': positions[name]}
+    return (index, shards)
+
+
+def reachable_names(index, names, split_name_and_version):
+    '''Returns the set of names in index reachable from names: the names
+    themselves, what they require, and the items that are updates for
+    them, and so on for those in turn.
+
+    split_name_and_version is a function that splits 'name-version' or
+    'name--version' strings into (name, version).'''
+    # update_for strings can name a specific version; map each to the
+    # plain name it's an update for
+    updaters = {}
+    for (update_for, updater_names) in index.get('update_for', {}).items():
+        base_name = normalized_name(split_name_and_version(update_for)[0])
+        updaters.setdefault(base_name, set()).update(updater_names)
+
+    def candidates(name):
+        '''The forms of name that might be an item name'''
+        name = normalized_name(name)
+        return (name, normalized_name(split_name_and_version(name)[0]))
+
+    shards = index.get('shards', {})
+    reachable = set()
+    queue = [candidate for name in names for candidate in candidates(name)]
+    while queue:
+        name = queue.pop()
+        if name in reachable or name not in shards:
+            continue
+        reachable.add(name)
+        for requires in index.get('requires', {}).get(name, []):
+            queue.extend(candidates(requires))
+        queue.extend(updaters.get(name, []))
+    return reachable
+
+
+def names_requiring(index, requires_strings):
+    '''Returns the names of the items in index that require any of
+    requires_strings'''
+    requires_strings = set(requires_strings)
+    return set(name for (name, requirements) in index.get(
+        'requires', {}).items() if requires_strings.intersection(requirements))
@@ -22,6 +22,7 @@ Common output functions
 """
 from __future__ import absolute_import, print_function
 
+import logging
 import sys
 import warnings
 
@@ -172,6 +173,9 @@ def display_detail(msg, *args):
     These are usually logged only, but can be printed to
     stdout if verbose is set greater than 1
     """
+    if verbose <= 1 and munkilog.logging_level() <= 0:
+        # not printed or logged; don't bother formatting
+        return
     msg = _concat_message(msg, *args)
     if verbose > 1:
         print('    %s' % msg)
@@ -184,6 +188,9 @@ def display_debug1(msg, *args):
     """
     Displays debug messages, formatting as needed.
     """
+    if verbose <= 2 and munkilog.logging_level() <= 1:
+        # not printed or logged; don't bother formatting
+        return
     msg = _concat_message(msg, *args)
     if verbose > 2:
         print('    %s' % msg)
@@ -196,6 +203,9 @@ def display_debug2(msg, *args):
     """
     Displays debug messages, formatting as needed.
     """
+    if verbose <= 3 and munkilog.logging_level() <= 2:
+        # not printed or logged; don't bother formatting
+        return
     msg = _concat_message(msg, *args)
     if verbose > 3:
         print('    %s' % msg)
@@ -211,9 +221,9 @@ def display_warning(msg, *args):
     warning = 'WARNING: %s' % msg
     if verbose > 0:
         print(warning, file=sys.stderr)
-    munkilog.log(warning)
+    munkilog.log(warning, level=logging.WARNING)
     # append this warning to our warnings log
-    munkilog.log(warning, 'warnings.log')
+    munkilog.log(warning, 'warnings.log', level=logging.WARNING)
     # collect the warning for later reporting
     if 'Warnings' not in reports.report:
         reports.report['Warnings'] = []
@@ -228,9 +238,9 @@ def display_error(msg, *args):
     errmsg = 'ERROR: %s' % msg
     if verbose > 0:
         print(errmsg, file=sys.stderr)
-    munkilog.log(errmsg)
+    munkilog.log(errmsg, level=logging.ERROR)
     # append this error to our errors log
-    munkilog.log(errmsg, 'errors.log')
+    munkilog.log(errmsg, 'errors.log', level=logging.ERROR)
     # collect the errors for later reporting
     if 'Errors' not in reports.report:
         reports.report['Errors'] = []
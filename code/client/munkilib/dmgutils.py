@@ -24,6 +24,7 @@ from __future__ import absolute_import, print_function
 
 import os
 import subprocess
+import threading
 
 from . import display
 from . import utils
@@ -103,21 +104,125 @@ def hdiutil_info():
     return None
 
 
+class DiskImageState(object):
+    """
+    Attached disk images, indexed by image path and by mount point. Safe to
+    share between threads.
+    """
+
+    def __init__(self, infoplist=None):
+        self._lock = threading.RLock()
+        self.mountpoints_by_image = {}
+        self.image_by_mountpoint = {}
+        if infoplist:
+            self.add_info(infoplist)
+
+    def add_info(self, infoplist):
+        """Records the images in the output of hdiutil info -plist"""
+        for imageProperties in infoplist.get('images', []):
+            if 'image-path' in imageProperties:
+                mountpoints = [
+                    entity['mount-point']
+                    for entity in imageProperties.get('system-entities', [])
+                    if entity.get('mount-point')]
+                self.add(imageProperties['image-path'], mountpoints)
+
+    def add(self, dmgpath, mountpoints):
+        """Records that dmgpath is mounted at mountpoints"""
+        with self._lock:
+            known_mountpoints = self.mountpoints_by_image.setdefault(
+                dmgpath, [])
+            for mountpoint in mountpoints:
+                if mountpoint not in known_mountpoints:
+                    known_mountpoints.append(mountpoint)
+                self.image_by_mountpoint[mountpoint] = dmgpath
+
+    def detach(self, mountpoint):
+        """Records that the disk image mounted at mountpoint, and so all of
+        its volumes, was detached. Returns false if we didn't know of a
+        disk image mounted there."""
+        with self._lock:
+            dmgpath = self.image_by_mountpoint.get(mountpoint)
+            if dmgpath is None:
+                return False
+            for item in self.mountpoints_by_image.pop(dmgpath, []):
+                self.image_by_mountpoint.pop(item, None)
+            return True
+
+    def is_mounted(self, dmgpath):
+        """Returns true if dmgpath has any mounted volumes"""
+        with self._lock:
+            return bool(self.mountpoints_by_image.get(dmgpath))
+
+    def mountpoints(self, dmgpath):
+        """Returns a list of the mount points of dmgpath"""
+        with self._lock:
+            return list(self.mountpoints_by_image.get(dmgpath, []))
+
+    def is_mountpoint(self, path):
+        """Returns true if path is the mount point of a disk image volume"""
+        with self._lock:
+            return path in self.image_by_mountpoint
+
+    def image_for_mountpoint(self, path):
+        """Returns the path of the disk image mounted at path, or None. path
+        may be any path to the mount point, like /private/tmp/dmg.XXXX for
+        /tmp/dmg.XXXX"""
+        with self._lock:
+            if path in self.image_by_mountpoint:
+                return self.image_by_mountpoint[path]
+            # a copy, since we don't hold the lock while we stat
+            images = list(self.image_by_mountpoint.items())
+        for (mountpoint, dmgpath) in images:
+            try:
+                if os.path.samefile(path, mountpoint):
+                    return dmgpath
+            except OSError:
+                pass
+        return None
+
+
+# the disk images hdiutil last told us about, updated as we mount and
+# unmount them; see disk_image_state()
+_DISK_IMAGE_STATE = None
+# held while _DISK_IMAGE_STATE is made, replaced or updated
+_DISK_IMAGE_STATE_LOCK = threading.RLock()
+
+
+def disk_image_state():
+    """
+    Returns a DiskImageState for the attached disk images, running
+    hdiutil info only if we don't already have one
+    """
+    # pylint: disable=global-statement
+    global _DISK_IMAGE_STATE
+    with _DISK_IMAGE_STATE_LOCK:
+        if _DISK_IMAGE_STATE is None:
+            infoplist = hdiutil_info()
+            if infoplist is None:
+                # don't remember a failure
+                return DiskImageState()
+            _DISK_IMAGE_STATE = DiskImageState(infoplist)
+        return _DISK_IMAGE_STATE
+
+
+def invalidate_disk_image_state():
+    """
+    Forgets what we know about attached disk images, so the next query
+    runs hdiutil info again. Call this if disk images may have been
+    mounted or unmounted by something other than mountdmg and unmountdmg.
+    """
+    # pylint: disable=global-statement
+    global _DISK_IMAGE_STATE
+    with _DISK_IMAGE_STATE_LOCK:
+        _DISK_IMAGE_STATE = None
+
+
 def diskImageIsMounted(dmgpath):
     """
     Returns true if the given disk image is currently mounted
     """
-    isMounted = False
-    infoplist = hdiutil_info()
-    for imageProperties in infoplist.get('images'):
-        if 'image-path' in imageProperties:
-            imagepath = imageProperties['image-path']
-            if imagepath == dmgpath:
-                for entity in imageProperties.get('system-entities', []):
-                    if entity.get('mount-point'):
-                        isMounted = True
-                        break
-    return isMounted
+    return disk_image_state().is_mounted(dmgpath)
 
 
 def pathIsVolumeMountPoint(path):
@@ -126,17 +231,7 @@ def pathIsVolumeMountPoint(path):
 
     Returns true if the given path is a mount point or false if it isn't
     """
-    isMountPoint = False
-    infoplist = hdiutil_info()
-    for imageProperties in infoplist.get('images'):
-        if 'image-path' in imageProperties:
-            for entity in imageProperties.get('system-entities', []):
-                if 'mount-point' in entity:
-                    mountpoint = entity['mount-point']
-                    if path == mountpoint:
-                        isMountPoint = True
-                        break
-    return isMountPoint
+    return disk_image_state().is_mountpoint(path)
 
 
 def diskImageForMountPoint(path):
@@ -146,34 +241,14 @@ def diskImageForMountPoint(path):
     Returns a path to a disk image file or None if the path is not
     a valid mount point
     """
-    dmgpath = None
-    infoplist = hdiutil_info()
-    for imageProperties in infoplist.get('images'):
-        if 'image-path' in imageProperties:
-            imagepath = imageProperties['image-path']
-            for entity in imageProperties.get('system-entities', []):
-                if 'mount-point' in entity:
-                    mountpoint = entity['mount-point']
-                    if os.path.samefile(path, mountpoint):
-                        dmgpath = imagepath
-    return dmgpath
+    return disk_image_state().image_for_mountpoint(path)
 
 
 def mount_points_for_disk_image(dmgpath):
     """
     Returns a list of mountpoints for the given disk image
     """
-    mountpoints = []
-    infoplist = hdiutil_info()
-    for imageProperties in infoplist.get('images'):
-        if 'image-path' in imageProperties:
-            imagepath = imageProperties['image-path']
-            if imagepath == dmgpath:
-                for entity in imageProperties.get('system-entities', []):
-                    if 'mount-point' in entity:
-                        mountpoints.append(entity['mount-point'])
-                break
-    return mountpoints
+    return disk_image_state().mountpoints(dmgpath)
 
 
 def mountdmg(dmgpath, use_shadow=False, use_existing_mounts=False,
@@ -192,7 +267,12 @@ def mountdmg(dmgpath, use_shadow=False, use_existing_mounts=False,
         # and if so, bail out and return the mountpoints
         if diskImageIsMounted(dmgpath):
             mountpoints = mount_points_for_disk_image(dmgpath)
-            return mountpoints
+            if all(os.path.ismount(item) for item in mountpoints):
+                return mountpoints
+            # it was unmounted behind our back
+            invalidate_disk_image_state()
+            if diskImageIsMounted(dmgpath):
+                return mount_points_for_disk_image(dmgpath)
 
     # Attempt to mount the dmg
     stdin = b''
@@ -227,6 +307,10 @@ def mountdmg(dmgpath, use_shadow=False, use_existing_mounts=False,
             display.display_error(
                 'Bad plist string returned when mounting diskimage %s:\n%s'
                 % (dmgname, pliststr))
+    if mountpoints:
+        with _DISK_IMAGE_STATE_LOCK:
+            if _DISK_IMAGE_STATE is not None:
+                _DISK_IMAGE_STATE.add(dmgpath, mountpoints)
     return mountpoints
 
 
@@ -249,6 +333,13 @@ def unmountdmg(mountpoint):
         if proc.returncode:
             display.display_warning(
                 'Failed to unmount %s: %s', mountpoint, err.decode("UTF-8"))
+            # we don't know what state it's in now
+            invalidate_disk_image_state()
+            return
+    with _DISK_IMAGE_STATE_LOCK:
+        if (_DISK_IMAGE_STATE is not None and
+                not _DISK_IMAGE_STATE.detach(mountpoint)):
+            invalidate_disk_image_state()
 
 
 if __name__ == '__main__':
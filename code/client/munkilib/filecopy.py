@@ -0,0 +1,265 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+filecopy.py
+
+Copies large files, like installer items, with as little data movement as
+the filesystems allow:
+
+  - a clone (APFS clonefile, or a Btrfs/XFS reflink) shares the source's
+    blocks, so nothing is copied at all
+  - otherwise the kernel copies the data (copy_file_range or sendfile),
+    which never passes it through Python
+  - otherwise we read and write it ourselves
+
+Holes in sparse files are skipped rather than copied. If hash values are
+wanted, they're computed in the same pass that copies the data, or, for a
+clone, in a single read of the source.
+"""
+from __future__ import absolute_import, print_function
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import munkihash
+
+
+# ioctl request to reflink a whole file on Linux: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors that mean "this way of copying isn't available here"
+_UNSUPPORTED_ERRNOS = set(
+    getattr(errno, name) for name in
+    ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL', 'ENOSYS',
+     'EBADF', 'ENOTSOCK', 'EPERM')
+    if hasattr(errno, name))
+
+# how much to copy per system call
+COPY_CHUNK_SIZE = 2**30
+
+
+def _libc_clonefile():
+    '''Returns macOS's clonefile(2), or None'''
+    if sys.platform != 'darwin':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clonefile = libc.clonefile
+    except (OSError, AttributeError):
+        return None
+    clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    clonefile.restype = ctypes.c_int
+    return clonefile
+
+
+_CLONEFILE = _libc_clonefile()
+
+
+def _clonefile(src, dst):
+    '''Makes dst a clone of src with macOS's clonefile(2), if the
+    filesystem can. Returns True if it did.'''
+    if not _CLONEFILE:
+        return False
+    # clonefile won't replace an existing file, so clone to a temporary
+    # name and rename that over dst
+    tmp_dst = '%s.clone-%s' % (dst, os.getpid())
+    if _CLONEFILE(os.fsencode(src), os.fsencode(tmp_dst), 0) != 0:
+        return False
+    try:
+        os.rename(tmp_dst, dst)
+    except OSError:
+        try:
+            os.unlink(tmp_dst)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def _reflink(src_fd, dst_fd):
+    '''Makes the file open as dst_fd a reflink of the one open as src_fd,
+    if the filesystem can (Btrfs, XFS and others on Linux). Returns True if
+    it did.'''
+    if not fcntl or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError) as err:
+        if err.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def _data_segments(fd, size):
+    '''Yields (start, end) for each run of data in the file open as fd,
+    skipping holes where the OS can tell us where they are'''
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    seek_hole = getattr(os, 'SEEK_HOLE', None)
+    if seek_data is None or seek_hole is None:
+        yield (0, size)
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, seek_data)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # nothing but a hole from here to the end
+                return
+            if err.errno in _UNSUPPORTED_ERRNOS:
+                yield (offset, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, seek_hole), size)
+        yield (start, end)
+        offset = end
+
+
+def _kernel_copy_range(src_fd, dst_fd, start, end):
+    '''Copies bytes start to end of src_fd to the same place in dst_fd
+    without passing them through Python. Returns False if the OS can't.'''
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    offset = start
+    while offset < end:
+        count = min(COPY_CHUNK_SIZE, end - offset)
+        copied = None
+        if copy_file_range:
+            try:
+                copied = copy_file_range(
+                    src_fd, dst_fd, count, offset_src=offset,
+                    offset_dst=offset)
+            except OSError as err:
+                if err.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                copy_file_range = None
+        if copied is None and sendfile and sys.platform.startswith('linux'):
+            try:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = sendfile(dst_fd, src_fd, offset, count)
+            except OSError as err:
+                if err.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                sendfile = None
+        if copied is None:
+            if offset == start:
+                return False
+            # it worked before; finish the rest ourselves
+            _user_copy_range(src_fd, dst_fd, offset, end, [])
+            return True
+        if copied == 0:
+            # the source shrank under us
+            break
+        offset += copied
+    return True
+
+
+def _user_copy_range(src_fd, dst_fd, start, end, hash_functions):
+    '''Copies bytes start to end of src_fd to the same place in dst_fd,
+    feeding them to hash_functions on the way'''
+    buffer = bytearray(munkihash.read_size_for(end - start))
+    view = memoryview(buffer)
+    os.lseek(src_fd, start, os.SEEK_SET)
+    os.lseek(dst_fd, start, os.SEEK_SET)
+    remaining = end - start
+    while remaining > 0:
+        count = os.readv(src_fd, [view[:min(len(buffer), remaining)]])
+        if not count:
+            break
+        for hash_function in hash_functions:
+            hash_function.update(view[:count])
+        written = 0
+        while written < count:
+            written += os.write(dst_fd, view[written:count])
+        remaining -= count
+
+
+def _hash_zeros(hash_functions, count):
+    '''Feeds count zero bytes, a hole in a sparse file, to hash_functions'''
+    if not hash_functions:
+        return
+    zeros = bytes(min(count, munkihash.MAX_READ_SIZE))
+    while count > 0:
+        chunk = memoryview(zeros)[:min(len(zeros), count)]
+        for hash_function in hash_functions:
+            hash_function.update(chunk)
+        count -= len(chunk)
+
+
+def _hashes_of(path, algorithms):
+    '''Returns {algorithm: hex digest} for the file at path'''
+    if not algorithms:
+        return {}
+    hashes = munkihash.gethashes(path, algorithms)
+    if 'HASH_ERROR' in hashes.values():
+        raise IOError('Could not read %s' % path)
+    return hashes
+
+
+def _copy_fd(src_fd, dst_fd, hash_functions):
+    '''Copies the file open as src_fd to the empty one open as dst_fd,
+    skipping holes and feeding all the data to hash_functions'''
+    size = os.fstat(src_fd).st_size
+    kernel_copy = not hash_functions
+    offset = 0
+    for (start, end) in _data_segments(src_fd, size):
+        _hash_zeros(hash_functions, start - offset)
+        if kernel_copy:
+            kernel_copy = _kernel_copy_range(src_fd, dst_fd, start, end)
+        if not kernel_copy:
+            _user_copy_range(src_fd, dst_fd, start, end, hash_functions)
+        offset = end
+    _hash_zeros(hash_functions, size - offset)
+    # extend dst over any trailing hole
+    os.ftruncate(dst_fd, size)
+
+
+def copy_file(src, dst, algorithms=()):
+    '''Copies the contents of src to dst, replacing dst, by the cheapest
+    means available. If algorithms, a sequence of hashlib algorithm names,
+    is given, returns a dict mapping each to the hex digest of the data;
+    otherwise returns an empty dict. Raises OSError or IOError on failure.'''
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(
+            '%s and %s are the same file' % (src, dst))
+    if _clonefile(src, dst):
+        return _hashes_of(src, algorithms)
+    if not algorithms and sys.platform == 'darwin':
+        # shutil.copyfile uses fcopyfile(3) here, which copies in the kernel
+        shutil.copyfile(src, dst)
+        return {}
+
+    hash_functions = [hashlib.new(name) for name in algorithms]
+    with open(src, 'rb', buffering=0) as src_ref:
+        with open(dst, 'wb', buffering=0) as dst_ref:
+            cloned = _reflink(src_ref.fileno(), dst_ref.fileno())
+            if not cloned:
+                _copy_fd(src_ref.fileno(), dst_ref.fileno(), hash_functions)
+    if cloned:
+        return _hashes_of(src, algorithms)
+    return dict((name, hash_function.hexdigest())
+                for (name, hash_function) in zip(algorithms, hash_functions))
@@ -40,6 +40,7 @@ from Quartz import (CGImageSourceCreateWithURL, CGImageSourceCreateImageAtIndex,
                     kCGImagePropertyDPIHeight, kCGImagePropertyPixelHeight)
 # pylint: enable=E0611
 
+from . import bomutils
 from . import display
 from .wrappers import readPlist, PlistReadError
 
@@ -115,15 +116,15 @@ def findIconForApp(app_path):
 def extractAppBitsFromPkgArchive(archive_path, target_dir):
     '''Extracts application Info.plist and .icns files into target_dir
        from a package archive file. Returns the result code of the
-       pax extract operation.'''
+       pax extract operation.
+       The tools run in target_dir; the process's working directory is
+       left alone, since several of these may run at once.'''
     result = -999
     if os.path.exists(archive_path):
-        original_dir = os.getcwd()
-        os.chdir(target_dir)
         cmd = ['/bin/pax', '-rzf', archive_path,
                '*.app/Contents/Info.plist',
                '*.app/Contents/Resources/*.icns']
-        result = subprocess.call(cmd)
+        result = subprocess.call(cmd, cwd=target_dir)
         if result != 0:
             # pax failed. Maybe Apple Archive format?
             cmd = ["/usr/bin/aa", "extract",
@@ -132,8 +133,7 @@ def extractAppBitsFromPkgArchive(archive_path, target_dir):
                    "-include-regex", "\\.app/Contents/Resources/.*\\.icns",
                    "-d", "."
             ]
-            result = subprocess.call(cmd)
-        os.chdir(original_dir)
+            result = subprocess.call(cmd, cwd=target_dir)
     return result
 
 
@@ -157,18 +157,10 @@ def extractAppIconsFromFlatPkg(pkg_path):
         if not pkgname.endswith(u'.pkg'):
             # no subpackages; this is a component pkg
             pkgname = ''
-        cmd = ['/usr/bin/lsbom', '-s', bomfile]
-        proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-        output = proc.communicate()[0].decode('UTF-8')
-        if proc.returncode:
-            display.display_error(u'Could not lsbom %s', bomfile)
         # record paths to all app Info.plist files
         pkg_dict[pkgname] = [
-            os.path.normpath(line)
-            for line in output.splitlines()
-            if line.endswith(u'.app/Contents/Info.plist')]
+            os.path.normpath(path)
+            for path in getAppInfoPathsFromBOM(bomfile)]
         if not pkg_dict[pkgname]:
             # remove empty lists
             del pkg_dict[pkgname]
@@ -229,12 +221,13 @@ def findInfoPlistPathsInBundlePkg(pkg_path, repo=None):
         else:
             pkg_contents_dir = os.path.join(pkg_path, u'Contents')
             if os.path.isdir(pkg_contents_dir):
-                original_dir = os.getcwd()
-                os.chdir(pkg_contents_dir)
-                pkgs = (glob.glob('*.pkg') + glob.glob('*/*.pkg')
-                        + glob.glob('*/*/*.pkg') + glob.glob('*.mpkg') +
-                        glob.glob('*/*.mpkg') + glob.glob('*/*/*.mpkg'))
-                os.chdir(original_dir)
+                # absolute patterns, rather than changing the working
+                # directory, which other threads share
+                escaped_dir = glob.escape(pkg_contents_dir)
+                pkgs = []
+                for pattern in ('*.pkg', '*/*.pkg', '*/*/*.pkg',
+                                '*.mpkg', '*/*.mpkg', '*/*/*.mpkg'):
+                    pkgs.extend(glob.glob(os.path.join(escaped_dir, pattern)))
         for pkg in pkgs:
             full_path = os.path.join(pkg_contents_dir, pkg)
             pkg_dict.update(findInfoPlistPathsInBundlePkg(full_path))
@@ -269,13 +262,16 @@ def extractAppIconsFromBundlePkg(pkg_path, repo=None):
 def getAppInfoPathsFromBOM(bomfile):
     '''Returns a list of paths to application Info.plists'''
     if os.path.exists(bomfile):
-        cmd = ['/usr/bin/lsbom', '-s', bomfile]
-        proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-        output = proc.communicate()[0].decode('UTF-8')
-        return [line for line in output.splitlines()
-                if line.endswith('.app/Contents/Info.plist')]
+        try:
+            paths = bomutils.bom_paths(bomfile)
+        except bomutils.BomError:
+            try:
+                paths = [entry[0] for entry in bomutils.lsbom(bomfile)]
+            except bomutils.BomError:
+                display.display_error(u'Could not lsbom %s', bomfile)
+                return []
+        return [path for path in paths
+                if path.endswith('.app/Contents/Info.plist')]
     return []
 
 
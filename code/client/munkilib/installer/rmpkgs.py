@@ -29,6 +29,7 @@ import os
 import subprocess
 import sqlite3
 
+from .. import bomutils
 from .. import display
 from .. import munkistatus
 from .. import osutils
@@ -56,8 +57,22 @@ from .. import FoundationPlist
 #                          uid INTEGER,
 #                          gid INTEGER,
 #                          perms INTEGER )
+#
+# plus a table of our own recording what each package was imported from,
+# so init_database can import only receipts that changed:
+#
+# CREATE TABLE imported_receipts (source VARCHAR NOT NULL,
+#                                 name VARCHAR NOT NULL,
+#                                 path VARCHAR NOT NULL,
+#                                 mtime REAL NOT NULL,
+#                                 pkg_key INTEGER,
+#                                 PRIMARY KEY (source, name) )
 #################################################################
 
+RECEIPTS_DIR = u'/Library/Receipts'
+BOMS_DIR = u'/Library/Receipts/boms'
+PKGUTIL_RECEIPTS_DIR = u'/private/var/db/receipts'
+
 
 def should_rebuild_db(pkgdbpath):
     """
@@ -127,6 +142,29 @@ def create_tables(curs):
                           uid INTEGER,
                           gid INTEGER,
                           perms INTEGER )''')
+    curs.execute('''CREATE TABLE imported_receipts
+                         (source VARCHAR NOT NULL,
+                          name VARCHAR NOT NULL,
+                          path VARCHAR NOT NULL,
+                          mtime REAL NOT NULL,
+                          pkg_key INTEGER,
+                          PRIMARY KEY (source, name) )''')
+
+
+def create_indexes(curs):
+    """
+    Creates the indexes our queries need, if they don't exist yet. Done after
+    importing, since building an index once is cheaper than updating it for
+    every inserted row.
+    """
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_path_key
+                    ON pkgs_paths (path_key)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_pkg_key
+                    ON pkgs_paths (pkg_key)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_pkgid
+                    ON pkgs (pkgid)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_pkgname
+                    ON pkgs (pkgname)''')
 
 
 def find_bundle_receipt(pkgid):
@@ -165,6 +203,11 @@ def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
         uid = "0"
         gid = "0"
 
+    insert_path_into_pkgdb(path, perms, uid, gid, pkgkey, ppath, curs)
+
+
+def insert_path_into_pkgdb(path, perms, uid, gid, pkgkey, ppath, curs):
+    '''Inserts a path from a package's bom into our pkgdb'''
     try:
         if path != ".":
             # special case for MS Office 2008 installers
@@ -195,10 +238,33 @@ def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
         pass
 
 
+def import_bom_paths(bompath, pkgkey, ppath, curs):
+    '''Inserts all the paths in the bom file at bompath into our pkgdb'''
+    try:
+        for (path, mode, uid, gid) in bomutils.bom_entries(bompath):
+            insert_path_into_pkgdb(
+                path, '%o' % mode, uid, gid, pkgkey, ppath, curs)
+        return
+    except bomutils.BomError as err:
+        display.display_debug1(
+            'Could not read %s directly, trying lsbom: %s', bompath, err)
+    # forget any paths read before the error; lsbom will list them again
+    curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', (pkgkey, ))
+    try:
+        entries = bomutils.lsbom(bompath)
+    except bomutils.BomError as err:
+        display.display_warning('%s', err)
+        return
+    for (path, mode, uid, gid) in entries:
+        insert_path_into_pkgdb(
+            path, '%o' % mode, uid, gid, pkgkey, ppath, curs)
+
+
 def import_package(packagepath, curs):
     """
     Imports package data from the receipt at packagepath into
     our internal package database.
+    Returns the new pkg_key, or None if the receipt was skipped.
     """
 
     bompath = os.path.join(packagepath, 'Contents/Archive.bom')
@@ -249,15 +315,8 @@ def import_package(packagepath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    proc = subprocess.Popen(
-        ['/usr/bin/lsbom', bompath], shell=False, bufsize=-1,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
+    import_bom_paths(bompath, pkgkey, ppath, curs)
+    return pkgkey
 
 
 def import_bom(bompath, curs):
@@ -265,6 +324,7 @@ def import_bom(bompath, curs):
     Imports package data into our internal package database
     using a combination of the bom file and data in Apple's
     package database into our internal package database.
+    Returns the new pkg_key.
     """
     # If we completely trusted the accuracy of Apple's database, we wouldn't
     # need the bom files, but in my environment at least, the bom files are
@@ -302,20 +362,14 @@ def import_bom(bompath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/bin/lsbom", bompath]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    import_bom_paths(bompath, pkgkey, ppath, curs)
+    return pkgkey
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
 
 def import_from_pkgutil(pkgname, curs):
     """
     Imports package data from pkgutil into our internal package database.
+    Returns the new pkg_key.
     """
 
     timestamp = 0
@@ -357,6 +411,13 @@ def import_from_pkgutil(pkgname, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
+    # the receipt's bom has the same paths as pkgutil --files, plus their
+    # modes and owners
+    bompath = os.path.join(PKGUTIL_RECEIPTS_DIR, pkgid + '.bom')
+    if os.path.exists(bompath):
+        import_bom_paths(bompath, pkgkey, ppath, curs)
+        return pkgkey
+
     cmd = ["/usr/sbin/pkgutil", "--files", pkgid]
     proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
                             stdin=subprocess.PIPE,
@@ -367,47 +428,39 @@ def import_from_pkgutil(pkgname, curs):
         if not line and (proc.poll() != None):
             break
         insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
+    return pkgkey
 
 
-def init_database(forcerebuild=False):
+def installed_receipts():
     """
-    Builds or rebuilds our internal package database.
+    Returns a dictionary of every receipt we import, mapping
+    (source, name) to (path, mtime). source is 'receipt' for bundle receipts
+    in /Library/Receipts, 'bom' for bom files in /Library/Receipts/boms and
+    'pkgutil' for packages known to pkgutil. path is the file whose
+    modification time tells us if the receipt changed; installing any
+    version of a package rewrites it. mtime is -1 if there's no such file,
+    so the receipt is always re-imported.
     """
-    def abort_init_database():
-        '''What to do if user requests we stop'''
-        curs.close()
-        conn.close()
-        #our package db isn't valid, so we should delete it
-        os.remove(PACKAGEDB)
-        return False
+    receipts = {}
 
-    if not should_rebuild_db(PACKAGEDB) and not forcerebuild:
-        return True
-
-    display.display_status_minor(
-        'Gathering information on installed packages')
-
-    if os.path.exists(PACKAGEDB):
+    def add(source, name, path):
+        '''Adds a receipt with path's mtime'''
         try:
-            os.remove(PACKAGEDB)
+            mtime = os.stat(path).st_mtime
         except (OSError, IOError):
-            display.display_error(
-                "Could not remove out-of-date receipt database.")
-            return False
-
-    receiptsdir = u'/Library/Receipts'
-    receiptlist = []
-    if os.path.exists(receiptsdir):
-        receiptlist = [item for item in osutils.listdir(receiptsdir)
-                       if item.endswith(u'.pkg')]
-
-    bomsdir = u'/Library/Receipts/boms'
-    bomslist = []
-    if os.path.exists(bomsdir):
-        bomslist = [item for item in osutils.listdir(bomsdir)
-                    if item.endswith('.bom')]
-
-    pkglist = []
+            mtime = -1
+        receipts[(source, name)] = (path, mtime)
+
+    if os.path.exists(RECEIPTS_DIR):
+        for item in osutils.listdir(RECEIPTS_DIR):
+            if item.endswith(u'.pkg'):
+                add('receipt', item, os.path.join(RECEIPTS_DIR, item))
+
+    if os.path.exists(BOMS_DIR):
+        for item in osutils.listdir(BOMS_DIR):
+            if item.endswith('.bom'):
+                add('bom', item, os.path.join(BOMS_DIR, item))
+
     cmd = ['/usr/sbin/pkgutil', '--pkgs']
     proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
                             stdin=subprocess.PIPE,
@@ -418,53 +471,179 @@ def init_database(forcerebuild=False):
         if not line and (proc.poll() != None):
             break
 
-        pkglist.append(line.rstrip(u'\n'))
+        pkgid = line.rstrip(u'\n')
+        if pkgid:
+            add('pkgutil', pkgid,
+                os.path.join(PKGUTIL_RECEIPTS_DIR, pkgid + '.plist'))
 
-    pkgcount = len(receiptlist) + len(bomslist) + len(pkglist)
-    conn = sqlite3.connect(PACKAGEDB)
-    conn.text_factory = str
-    curs = conn.cursor()
-    create_tables(curs)
+    return receipts
 
-    currentpkgindex = 0
-    display.display_percent_done(0, pkgcount)
 
-    for item in receiptlist:
-        if processes.stop_requested():
-            return abort_init_database()
+def forget_package(pkgkey, curs):
+    """
+    Removes a package's data from our internal package database. Paths no
+    longer used by any package are removed separately.
+    """
+    pkgkey_t = (pkgkey, )
+    curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
+    curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+    curs.execute('DELETE FROM imported_receipts where pkg_key = ?', pkgkey_t)
 
-        receiptpath = os.path.join(receiptsdir, item)
-        display.display_detail("Importing %s...", receiptpath)
-        import_package(receiptpath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
 
-    for item in bomslist:
-        if processes.stop_requested():
-            return abort_init_database()
+def remove_orphaned_paths(curs):
+    """
+    Removes paths no package refers to from our internal package database.
+    """
+    curs.execute(
+        '''DELETE FROM paths where path_key not in
+           (select distinct path_key from pkgs_paths)''')
 
-        bompath = os.path.join(bomsdir, item)
-        display.display_detail("Importing %s...", bompath)
-        import_bom(bompath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
 
-    for pkg in pkglist:
+def has_imported_receipts_table(curs):
+    """
+    Returns True if the database records what each package was imported
+    from; databases built by older versions don't.
+    """
+    return curs.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'imported_receipts'").fetchone() is not None
+
+
+def init_database(forcerebuild=False):
+    """
+    Builds our internal package database, or brings it up to date with the
+    installed receipts: packages whose receipts are gone are dropped, and
+    only new or changed receipts are imported. If forcerebuild is True, the
+    database is rebuilt from scratch.
+    """
+    def abort_init_database():
+        '''What to do if user requests we stop'''
+        conn.rollback()
+        curs.close()
+        conn.close()
+        if rebuilding:
+            #our package db isn't valid, so we should delete it
+            os.remove(PACKAGEDB)
+        return False
+
+    if not should_rebuild_db(PACKAGEDB) and not forcerebuild:
+        # databases built by older versions lack our indexes
+        try:
+            conn = sqlite3.connect(PACKAGEDB)
+            curs = conn.cursor()
+            create_indexes(curs)
+            conn.commit()
+            curs.close()
+            conn.close()
+            return True
+        except sqlite3.Error as err:
+            display.display_warning(
+                "Could not index receipt database: %s. Rebuilding.", err)
+            forcerebuild = True
+
+    display.display_status_minor(
+        'Gathering information on installed packages')
+
+    rebuilding = forcerebuild or not os.path.exists(PACKAGEDB)
+    if not rebuilding:
+        try:
+            conn = sqlite3.connect(PACKAGEDB)
+            conn.text_factory = str
+            curs = conn.cursor()
+            if not has_imported_receipts_table(curs):
+                # we can't tell what's changed since it was built
+                curs.close()
+                conn.close()
+                rebuilding = True
+        except sqlite3.Error:
+            rebuilding = True
+
+    if rebuilding:
+        if os.path.exists(PACKAGEDB):
+            try:
+                os.remove(PACKAGEDB)
+            except (OSError, IOError):
+                display.display_error(
+                    "Could not remove out-of-date receipt database.")
+                return False
+        conn = sqlite3.connect(PACKAGEDB)
+        conn.text_factory = str
+        curs = conn.cursor()
+        create_tables(curs)
+
+    receipts = installed_receipts()
+    imported = {}
+    for (source, name, path, mtime, pkgkey) in curs.execute(
+            'SELECT source, name, path, mtime, pkg_key '
+            'FROM imported_receipts').fetchall():
+        imported[(source, name)] = ((path, mtime), pkgkey)
+
+    def is_current(key):
+        '''Returns True if the receipt for key was imported and hasn't
+        changed since'''
+        return (key in imported and key in receipts and
+                imported[key][0] == receipts[key] and
+                receipts[key][1] != -1)
+
+    # drop packages whose receipts are gone or have changed
+    outdated = [key for key in imported if not is_current(key)]
+    if outdated:
+        display.display_detail(
+            "Removing %s outdated packages from internal database...",
+            len(outdated))
+        for key in outdated:
+            pkgkey = imported[key][1]
+            if pkgkey is not None:
+                forget_package(pkgkey, curs)
+            curs.execute(
+                'DELETE FROM imported_receipts where source = ? and name = ?',
+                key)
+        remove_orphaned_paths(curs)
+
+    # import the new and changed ones; bundle receipts first, then boms,
+    # then pkgutil packages
+    source_order = {'receipt': 0, 'bom': 1, 'pkgutil': 2}
+    to_import = sorted(
+        [key for key in receipts if not is_current(key)],
+        key=lambda key: (source_order[key[0]], key[1]))
+    pkgcount = len(to_import)
+
+    currentpkgindex = 0
+    display.display_percent_done(0, pkgcount)
+
+    for (source, name) in to_import:
         if processes.stop_requested():
             return abort_init_database()
 
-        display.display_detail("Importing %s...", pkg)
-        import_from_pkgutil(pkg, curs)
+        (path, mtime) = receipts[(source, name)]
+        if source == 'receipt':
+            display.display_detail("Importing %s...", path)
+            pkgkey = import_package(path, curs)
+        elif source == 'bom':
+            display.display_detail("Importing %s...", path)
+            pkgkey = import_bom(path, curs)
+        else:
+            display.display_detail("Importing %s...", name)
+            pkgkey = import_from_pkgutil(name, curs)
+        curs.execute(
+            '''INSERT INTO imported_receipts
+               (source, name, path, mtime, pkg_key) values (?, ?, ?, ?, ?)''',
+            (source, name, path, mtime, pkgkey))
         currentpkgindex += 1
         display.display_percent_done(currentpkgindex, pkgcount)
 
     # in case we didn't quite get to 100% for some reason
     display.display_percent_done(pkgcount, pkgcount)
 
+    create_indexes(curs)
+
     # commit and close the db when we're done.
     conn.commit()
     curs.close()
     conn.close()
+    # mark the db as current even if no receipt needed importing, so
+    # should_rebuild_db doesn't send us here again
+    os.utime(PACKAGEDB, None)
     return True
 
 
@@ -514,45 +693,35 @@ def getpathstoremove(pkgkeylist):
     """
     Queries our database for paths to remove.
     """
-    pkgkeys = tuple(pkgkeylist)
-
     # open connection and cursor to our database
     conn = sqlite3.connect(PACKAGEDB)
     curs = conn.cursor()
 
-    # set up some subqueries:
-    # all the paths that are referred to by the selected packages:
-    if len(pkgkeys) > 1:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key in %s" % \
-           str(pkgkeys)
-    else:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key = %s" % \
-           str(pkgkeys[0])
-
-    # all the paths that are referred to by every package
-    # except the selected packages:
-    if len(pkgkeys) > 1:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key not in %s" % \
-         str(pkgkeys)
-    else:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key != %s" % \
-         str(pkgkeys[0])
-
-    # every path that is used by the selected packages and no other packages:
-    combined_query = \
-        "select path from paths where " + \
-        "(path_key in (%s) and path_key not in (%s))" % \
-                                (in_selected_packages, not_in_other_packages)
-
     display.display_status_minor(
         'Determining which filesystem items to remove')
     munkistatus.percent(-1)
 
-    curs.execute(combined_query)
+    # every path that is used by the selected packages and no other packages:
+    # count each path's references from the selected packages and compare
+    # with its total reference count. With the pkgs_paths indexes, this
+    # only visits rows for paths the selected packages use. (CROSS JOIN
+    # makes SQLite start from selected_pkgs rather than scan pkgs_paths.)
+    curs.execute(
+        'CREATE TEMP TABLE selected_pkgs (pkg_key INTEGER PRIMARY KEY)')
+    curs.executemany(
+        'INSERT OR IGNORE INTO selected_pkgs (pkg_key) values (?)',
+        [(pkgkey, ) for pkgkey in pkgkeylist])
+    curs.execute(
+        '''SELECT paths.path FROM
+               (SELECT pkgs_paths.path_key AS path_key,
+                       COUNT(*) AS selected_refs
+                FROM selected_pkgs CROSS JOIN pkgs_paths
+                     ON pkgs_paths.pkg_key = selected_pkgs.pkg_key
+                GROUP BY pkgs_paths.path_key) AS selected
+           JOIN paths ON paths.path_key = selected.path_key
+           WHERE (SELECT COUNT(*) FROM pkgs_paths
+                  WHERE pkgs_paths.path_key = selected.path_key)
+                 = selected.selected_refs''')
     results = curs.fetchall()
     curs.close()
     conn.close()
@@ -607,8 +776,7 @@ def remove_receipts(pkgkeylist, noupdateapplepkgdb):
         # remove pkg info from our database
         display.display_detail(
             "Removing package data from internal database...")
-        curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
-        curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+        forget_package(pkgkey, curs)
 
         # then remove pkg info from Apple's database unless option is passed
         if not noupdateapplepkgdb and pkgid:
@@ -629,9 +797,7 @@ def remove_receipts(pkgkeylist, noupdateapplepkgdb):
     # Apple DB...
     display.display_detail(
         "Removing unused paths from internal package database...")
-    curs.execute(
-        '''DELETE FROM paths where path_key not in
-           (select distinct path_key from pkgs_paths)''')
+    remove_orphaned_paths(curs)
     conn.commit()
     curs.close()
     conn.close()
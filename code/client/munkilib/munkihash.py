@@ -26,6 +26,36 @@ from __future__ import absolute_import, print_function
 import hashlib
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
+# read buffer bounds for hashing; larger files get larger reads so we make
+# fewer trips through the interpreter per byte hashed
+MIN_READ_SIZE = 2**16
+MAX_READ_SIZE = 2**22
+
+
+def read_size_for(filesize):
+    """Returns a read buffer size appropriate for a file of filesize bytes"""
+    read_size = MIN_READ_SIZE
+    while read_size < MAX_READ_SIZE and read_size * 64 < filesize:
+        read_size *= 2
+    return read_size
+
+
+def _update_from_file(fileref, hash_functions):
+    """Feeds the contents of fileref to each of hash_functions, reading the
+    file exactly once"""
+    filesize = os.fstat(fileref.fileno()).st_size
+    buffer = bytearray(read_size_for(filesize))
+    view = memoryview(buffer)
+    while True:
+        count = fileref.readinto(buffer)
+        if not count:
+            break
+        for hash_function in hash_functions:
+            hash_function.update(view[:count])
+
+
 def gethash(filename, hash_function):
     """
     Calculates the hashvalue of the given file with the given hash_function.
@@ -41,18 +71,71 @@ def gethash(filename, hash_function):
     if not os.path.isfile(filename):
         return 'NOT A FILE'
     try:
-        fileref = open(filename, 'rb')
-        while True:
-            chunk = fileref.read(2**16)
-            if not chunk:
-                break
-            hash_function.update(chunk)
-        fileref.close()
+        with open(filename, 'rb', buffering=0) as fileref:
+            _update_from_file(fileref, [hash_function])
         return hash_function.hexdigest()
     except (OSError, IOError):
         return 'HASH_ERROR'
 
 
+def gethashes(filename, algorithms=('sha256',)):
+    """
+    Calculates several hash values of the given file in a single read pass.
+
+    Args:
+      filename: The file name to calculate the hash values of.
+      algorithms: A sequence of hashlib algorithm names, e.g.
+          ('md5', 'sha256').
+
+    Returns:
+      A dictionary mapping each algorithm name to the hash value of the file
+      as a hex string. As with gethash(), every value is 'NOT A FILE' or
+      'HASH_ERROR' if the file could not be hashed.
+    """
+    if not os.path.isfile(filename):
+        return dict.fromkeys(algorithms, 'NOT A FILE')
+    hash_functions = [hashlib.new(name) for name in algorithms]
+    try:
+        with open(filename, 'rb', buffering=0) as fileref:
+            _update_from_file(fileref, hash_functions)
+    except (OSError, IOError):
+        return dict.fromkeys(algorithms, 'HASH_ERROR')
+    return dict((name, hash_function.hexdigest())
+                for name, hash_function in zip(algorithms, hash_functions))
+
+
+def gethashes_for_files(filenames, algorithms=('sha256',), max_workers=None):
+    """
+    Calculates hash values for many files, spreading the work across a pool
+    of threads. hashlib releases the GIL while digesting large buffers, so
+    this scales with the number of cores and with storage that handles
+    concurrent reads well.
+
+    Args:
+      filenames: An iterable of file names to hash.
+      algorithms: A sequence of hashlib algorithm names; each file is read
+          once no matter how many digests are requested.
+      max_workers: Maximum number of threads to use; defaults to the number
+          of CPUs.
+
+    Returns:
+      A dictionary mapping each file name to the dictionary returned by
+      gethashes() for that file.
+    """
+    # remove duplicates but keep the order
+    filenames = list(dict.fromkeys(filenames))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(filenames))
+    if max_workers <= 1:
+        return dict((filename, gethashes(filename, algorithms))
+                    for filename in filenames)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda filename: gethashes(filename, algorithms), filenames)
+        return dict(zip(filenames, results))
+
+
 def getmd5hash(filename):
     """
     Returns hex of MD5 checksum of a file
@@ -69,5 +152,16 @@ def getsha256hash(filename):
     return gethash(filename, hash_function)
 
 
+def getsha256hashes(filenames, max_workers=None):
+    """
+    Returns a dictionary mapping each of filenames to its SHA-256 hash value
+    as a hex string, hashing the files concurrently.
+    """
+    results = gethashes_for_files(
+        filenames, algorithms=('sha256',), max_workers=max_workers)
+    return dict((filename, hashes['sha256'])
+                for filename, hashes in results.items())
+
+
 if __name__ == '__main__':
     print('This is a library of support tools for the Munki Suite.')
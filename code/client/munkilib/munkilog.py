@@ -23,25 +23,183 @@ Logging functions for Munki
 """
 from __future__ import absolute_import, print_function
 
+import atexit
 import codecs
 import logging
 import logging.handlers
 import os
+import threading
 import time
 
 from . import prefs
 
 
+# date/time format string for log lines
+TIMESTAMP_FORMAT = '%b %d %Y %H:%M:%S %z'
+# lines for the main log are buffered and written once this many are waiting,
+# FLUSH_INTERVAL seconds after the first of them, as soon as a line at
+# FLUSH_LEVEL or above is logged, and at exit
+FLUSH_LINES = 200
+FLUSH_INTERVAL = 1.0
+FLUSH_LEVEL = logging.WARNING
+
+
+# LoggingLevel preference, read once by logging_level()
+_LOGGING_LEVEL = None
+
+
 def logging_level():
-    '''Returns the logging level, which might be defined badly by the admin'''
-    try:
-        return int(prefs.pref('LoggingLevel'))
-    except TypeError:
-        return 1
+    '''Returns the logging level, which might be defined badly by the admin.
+    The preference is read on the first call only; see reset_prefs()'''
+    global _LOGGING_LEVEL
+    if _LOGGING_LEVEL is None:
+        try:
+            _LOGGING_LEVEL = int(prefs.pref('LoggingLevel'))
+        except (TypeError, ValueError):
+            _LOGGING_LEVEL = 1
+    return _LOGGING_LEVEL
+
+
+def reset_logging_level():
+    '''Makes the next call to logging_level() read the preference again'''
+    global _LOGGING_LEVEL
+    _LOGGING_LEVEL = None
+
 
+class LogWriter(object):
+    """Process-wide writer for Munki's log files. Keeps log files open
+    between writes and buffers lines for the main log."""
 
-def log(msg, logname=''):
-    """Generic logging function."""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._main_logpath = None
+        # logpath -> open file object
+        self._files = {}
+        # lines waiting to be written to the main log
+        self._buffer = []
+        self._timer = None
+        self._timestamp_second = None
+        self._timestamp = ''
+
+    def logpath(self, logname=''):
+        """Returns the path to logname, or to the main log if no logname.
+        The LogFile preference is read once; see reset()."""
+        if self._main_logpath is None:
+            self._main_logpath = prefs.pref('LogFile')
+        if not logname:
+            return self._main_logpath
+        return os.path.join(os.path.dirname(self._main_logpath), logname)
+
+    def timestamp(self):
+        """Returns the timestamp for a log line; formatted at most once a
+        second"""
+        now = int(time.time())
+        if now != self._timestamp_second:
+            self._timestamp = time.strftime(
+                TIMESTAMP_FORMAT, time.localtime(now))
+            self._timestamp_second = now
+        return self._timestamp
+
+    def write(self, msg, logname='', level=logging.INFO):
+        """Adds a line to a log. Lines for logs other than the main log are
+        written at once, after any buffered main log lines."""
+        with self._lock:
+            line = '%s %s\n' % (self.timestamp(), msg)
+            if logname:
+                self.flush()
+                self._write_lines(self.logpath(logname), [line])
+                return
+            if self._main_logpath is None:
+                # buffered lines go to the log named when they were logged,
+                # even if there's a reset() before they're written
+                self.logpath()
+            self._buffer.append(line)
+            if level >= FLUSH_LEVEL or len(self._buffer) >= FLUSH_LINES:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Writes buffered lines to the main log"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._buffer:
+                lines = self._buffer
+                self._buffer = []
+                self._write_lines(self.logpath(), lines)
+
+    def _write_lines(self, logpath, lines):
+        """Appends lines to the file at logpath, reopening it if it's been
+        moved or removed since we opened it"""
+        fileobj = self._files.get(logpath)
+        if fileobj is not None:
+            try:
+                if (os.stat(logpath).st_ino !=
+                        os.fstat(fileobj.fileno()).st_ino):
+                    self.close(logpath)
+                    fileobj = None
+            except (OSError, IOError):
+                self.close(logpath)
+                fileobj = None
+        try:
+            if fileobj is None:
+                fileobj = codecs.open(logpath, mode='a', encoding='UTF-8')
+                self._files[logpath] = fileobj
+            fileobj.write(''.join(lines))
+            fileobj.flush()
+        except (OSError, IOError):
+            pass
+
+    def close(self, logpath=None):
+        """Writes buffered lines, then closes the file for logpath, or all
+        our files if logpath is None"""
+        with self._lock:
+            self.flush()
+            if logpath is None:
+                logpaths = list(self._files)
+            else:
+                logpaths = [logpath]
+            for path in logpaths:
+                fileobj = self._files.pop(path, None)
+                if fileobj is not None:
+                    try:
+                        fileobj.close()
+                    except (OSError, IOError):
+                        pass
+
+    def reset(self):
+        """Writes buffered lines and closes our files, so the next write
+        reads the LogFile preference again"""
+        with self._lock:
+            self.close()
+            self._main_logpath = None
+
+
+_WRITER = LogWriter()
+atexit.register(_WRITER.close)
+
+
+def flush():
+    """Writes any buffered lines to the main log"""
+    _WRITER.flush()
+
+
+def reset_prefs():
+    '''Makes logging read the LogFile and LoggingLevel preferences again,
+    after writing what's buffered for the current log file.
+    Call this after prefs.reload_prefs(); prefs can't call it for us, since
+    this module imports prefs.'''
+    _WRITER.reset()
+    reset_logging_level()
+
+
+def log(msg, logname='', level=logging.INFO):
+    """Generic logging function. level, a logging module level, decides
+    whether buffered lines are written to the log file right away."""
     if len(msg) > 1000:
         # See http://bugs.python.org/issue11907 and RFC-3164
         # break up huge msg into chunks and send 1000 characters at a time
@@ -52,22 +210,7 @@ def log(msg, logname=''):
     else:
         logging.info(msg)  # noop unless configure_syslog() is called first.
 
-    # date/time format string
-    formatstr = '%b %d %Y %H:%M:%S %z'
-    if not logname:
-        # use our regular logfile
-        logpath = prefs.pref('LogFile')
-    else:
-        logpath = os.path.join(os.path.dirname(prefs.pref('LogFile')), logname)
-    try:
-        fileobj = codecs.open(logpath, mode='a', encoding='UTF-8')
-        try:
-            fileobj.write("%s %s\n" % (time.strftime(formatstr), msg))
-        except (OSError, IOError):
-            pass
-        fileobj.close()
-    except (OSError, IOError):
-        pass
+    _WRITER.write(msg, logname, level)
 
 
 def configure_syslog():
@@ -94,11 +237,8 @@ def configure_syslog():
 
 def rotatelog(logname=''):
     """Rotate a log"""
-    if not logname:
-        # use our regular logfile
-        logpath = prefs.pref('LogFile')
-    else:
-        logpath = os.path.join(os.path.dirname(prefs.pref('LogFile')), logname)
+    logpath = _WRITER.logpath(logname)
+    _WRITER.close(logpath)
     if os.path.exists(logpath):
         for i in range(3, -1, -1):
             try:
@@ -117,7 +257,7 @@ def rotatelog(logname=''):
 
 def rotate_main_log():
     """Rotate our main log"""
-    main_log = prefs.pref('LogFile')
+    main_log = _WRITER.logpath()
     if os.path.exists(main_log):
         if os.path.getsize(main_log) > 1000000:
             rotatelog(main_log)
@@ -125,16 +265,14 @@ def rotate_main_log():
 
 def reset_warnings():
     """Rotate our warnings log."""
-    warningsfile = os.path.join(
-        os.path.dirname(prefs.pref('LogFile')), 'warnings.log')
+    warningsfile = _WRITER.logpath('warnings.log')
     if os.path.exists(warningsfile):
         rotatelog(warningsfile)
 
 
 def reset_errors():
     """Rotate our errors.log"""
-    errorsfile = os.path.join(
-        os.path.dirname(prefs.pref('LogFile')), 'errors.log')
+    errorsfile = _WRITER.logpath('errors.log')
     if os.path.exists(errorsfile):
         rotatelog(errorsfile)
 
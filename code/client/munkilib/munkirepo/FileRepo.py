@@ -10,7 +10,6 @@ from __future__ import absolute_import, print_function
 import errno
 import getpass
 import os
-import shutil
 import subprocess
 import sys
 
@@ -28,6 +27,7 @@ except ImportError:
     # Python 3
     from urllib.parse import urlparse
 
+from munkilib import filecopy
 from munkilib.munkirepo import Repo, RepoError
 from munkilib.wrappers import get_input
 
@@ -228,29 +228,47 @@ class FileRepo(Repo):
         if not os.path.exists(self.root):
             raise RepoError(u'%s does not exist' % self.root)
 
+    def _walk_items(self, kind):
+        '''Yields (identifier, absolute path) for each item of kind'''
+        kind = unicodeize(kind)
+        search_dir = os.path.join(self.root, kind)
+        for (dirpath, dirnames, filenames) in os.walk(search_dir,
+                                                      followlinks=True):
+            # don't recurse into directories that start with a period.
+            dirnames[:] = [name
+                           for name in dirnames if not name.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    # skip files that start with a period as well
+                    continue
+                abs_path = os.path.join(dirpath, name)
+                rel_path = abs_path[len(search_dir):].lstrip("/")
+                yield (rel_path, abs_path)
+
     def itemlist(self, kind):
         '''Returns a list of identifiers for each item of kind.
         Kind might be 'catalogs', 'manifests', 'pkgsinfo', 'pkgs', or 'icons'.
         For a file-backed repo this would be a list of pathnames.'''
-        kind = unicodeize(kind)
-        search_dir = os.path.join(self.root, kind)
-        file_list = []
         try:
-            for (dirpath, dirnames, filenames) in os.walk(search_dir,
-                                                          followlinks=True):
-                # don't recurse into directories that start with a period.
-                dirnames[:] = [name
-                               for name in dirnames if not name.startswith('.')]
-                for name in filenames:
-                    if name.startswith('.'):
-                        # skip files that start with a period as well
-                        continue
-                    abs_path = os.path.join(dirpath, name)
-                    rel_path = abs_path[len(search_dir):].lstrip("/")
-                    file_list.append(rel_path)
-            return file_list
+            return [rel_path for (rel_path, dummy_abs_path)
+                    in self._walk_items(kind)]
+        except (OSError, IOError) as err:
+            raise RepoError(err) from err
+
+    def itemsizes(self, kind):
+        '''Returns a dict mapping the identifier of each item of kind to its
+        size in bytes, like itemlist() with sizes. The size is None for an
+        item that can't be examined, like a broken symlink.'''
+        sizes = {}
+        try:
+            for (rel_path, abs_path) in self._walk_items(kind):
+                try:
+                    sizes[rel_path] = os.stat(abs_path).st_size
+                except OSError:
+                    sizes[rel_path] = None
         except (OSError, IOError) as err:
             raise RepoError(err) from err
+        return sizes
 
     def get(self, resource_identifier):
         '''Returns the content of item with given resource_identifier.
@@ -280,7 +298,7 @@ class FileRepo(Repo):
         repo_filepath = os.path.join(self.root, resource_identifier)
         local_file_path = unicodeize(local_file_path)
         try:
-            shutil.copyfile(repo_filepath, local_file_path)
+            filecopy.copy_file(repo_filepath, local_file_path)
         except (OSError, IOError) as err:
             raise RepoError(err) from err
 
@@ -305,18 +323,30 @@ class FileRepo(Repo):
         '''Copies the content of local_file_path to the repo based on
         resource_identifier. For a file-backed repo, a resource_identifier
         of 'pkgsinfo/apps/Firefox-52.0.plist' would result in the content
-        being saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
+        being saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.
+        Where the filesystem supports it, the repo file is a clone of the
+        local file and no data is copied.'''
+        self.put_from_local_file_with_hashes(
+            resource_identifier, local_file_path, ())
+
+    def put_from_local_file_with_hashes(self, resource_identifier,
+                                        local_file_path, algorithms):
+        '''Like put_from_local_file, but also returns a dict mapping each
+        of algorithms, a sequence of hashlib algorithm names, to the hex
+        digest of the content, computed in the same pass as the copy. The
+        dict is empty if nothing needed copying.'''
         resource_identifier = unicodeize(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
         local_file_path = unicodeize(local_file_path)
         if os.path.normpath(local_file_path) == os.path.normpath(repo_filepath):
             # nothing to do!
-            return
+            return {}
         dir_path = os.path.dirname(repo_filepath)
         if not os.path.exists(dir_path):
             os.makedirs(dir_path, 0o755)
         try:
-            shutil.copyfile(local_file_path, repo_filepath)
+            return filecopy.copy_file(
+                local_file_path, repo_filepath, algorithms=algorithms)
         except (OSError, IOError) as err:
             raise RepoError(err) from err
 
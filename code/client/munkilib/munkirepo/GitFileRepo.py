@@ -7,12 +7,17 @@ import os
 import pwd
 import subprocess
 import sys
+import threading
 
 from munkilib.munkirepo.FileRepo import FileRepo
 
 # TODO: make this more easily customized
 GITCMD = '/usr/bin/git'
 
+# git can't run two commands that change the index at once, so tools that
+# change the repo from several threads take turns
+_GIT_LOCK = threading.Lock()
+
 class MunkiGit(object):
     """A simple interface for some common interactions with the git binary"""
 
@@ -103,17 +108,18 @@ class MunkiGit(object):
     def _add_remove_file_at_path(self, a_path, operation):
         """Git adds or removes a file at a_path. operation must be either
         'add' or 'rm'"""
-        if self.path_is_in_git_repo(a_path):
-            if not self.path_is_gitignored(a_path):
-                self.git_repo_dir = os.path.dirname(a_path)
-                self.run_git([operation, a_path])
-                if self.results['returncode'] == 0:
-                    self.commit_file_at_path(a_path)
-                else:
-                    print("Git error: %s" % self.results['error'],
-                          file=sys.stderr)
-        else:
-            print("%s is not in a git repo." % a_path, file=sys.stderr)
+        with _GIT_LOCK:
+            if self.path_is_in_git_repo(a_path):
+                if not self.path_is_gitignored(a_path):
+                    self.git_repo_dir = os.path.dirname(a_path)
+                    self.run_git([operation, a_path])
+                    if self.results['returncode'] == 0:
+                        self.commit_file_at_path(a_path)
+                    else:
+                        print("Git error: %s" % self.results['error'],
+                              file=sys.stderr)
+            else:
+                print("%s is not in a git repo." % a_path, file=sys.stderr)
 
     def add_file_at_path(self, a_path):
         """Commits a file to the Git repo."""
@@ -132,11 +138,14 @@ class GitFileRepo(FileRepo):
         repo_filepath = os.path.join(self.root, resource_identifier)
         MunkiGit(self).add_file_at_path(repo_filepath)
 
-    def put_from_local_file(self, resource_identifier, local_file_path):
-        super(GitFileRepo, self).put_from_local_file(
-            resource_identifier, local_file_path)
+    def put_from_local_file_with_hashes(self, resource_identifier,
+                                        local_file_path, algorithms):
+        # FileRepo.put_from_local_file comes through here too
+        hashes = super(GitFileRepo, self).put_from_local_file_with_hashes(
+            resource_identifier, local_file_path, algorithms)
         repo_filepath = os.path.join(self.root, resource_identifier)
         MunkiGit(self).add_file_at_path(repo_filepath)
+        return hashes
 
     def delete(self, resource_identifier):
         super(GitFileRepo, self).delete(resource_identifier)
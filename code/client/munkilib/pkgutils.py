@@ -40,6 +40,7 @@ from xml.dom import minidom
 from . import display
 from . import osutils
 from . import utils
+from . import xarutils
 from . import FoundationPlist
 
 
@@ -361,9 +362,13 @@ def getBundleVersion(bundlepath, key=None):
     return '0.0.0.0.0'
 
 
-def getProductVersionFromDist(filename):
-    """Extracts product version from a Distribution file"""
-    dom = minidom.parse(filename)
+def getProductVersionFromDist(filename, xml_data=None):
+    """Extracts product version from a Distribution file, or from xml_data,
+    the contents of one, if given"""
+    if xml_data is not None:
+        dom = minidom.parseString(xml_data)
+    else:
+        dom = minidom.parse(filename)
     product = dom.getElementsByTagName('product')
     if product:
         keys = list(product[0].attributes.keys())
@@ -372,11 +377,15 @@ def getProductVersionFromDist(filename):
     return None
 
 
-def parsePkgRefs(filename, path_to_pkg=None):
+def parsePkgRefs(filename, path_to_pkg=None, xml_data=None):
     """Parses a .dist or PackageInfo file looking for pkg-ref or pkg-info tags
-    to get info on included sub-packages"""
+    to get info on included sub-packages. If xml_data is given, it's parsed
+    as the contents of filename."""
     info = []
-    dom = minidom.parse(filename)
+    if xml_data is not None:
+        dom = minidom.parseString(xml_data)
+    else:
+        dom = minidom.parse(filename)
     pkgrefs = dom.getElementsByTagName('pkg-info')
     if pkgrefs:
         # this is a PackageInfo file
@@ -448,12 +457,84 @@ def parsePkgRefs(filename, path_to_pkg=None):
     return info
 
 
+def _getFlatPackageInfoFromToc(pkgpath, toc, read_entry):
+    """
+    returns info on the subpackages of the flat package at pkgpath, given
+    the paths in its TOC and a function that returns the contents of one of
+    them, or None if it can't be extracted
+    """
+    receiptarray = []
+    # the contents of the flat package aren't on disk, so give the parsers
+    # paths to where they would be; relative references to other packages
+    # can't be resolved from there, same as when we extracted single files
+    abspkgpath = os.path.abspath(pkgpath)
+    # Walk trough the TOC entries
+    for toc_entry in toc:
+        # If the TOC entry is a top-level PackageInfo, read it
+        if toc_entry.startswith('PackageInfo') and not receiptarray:
+            data = read_entry(toc_entry)
+            if data is not None:
+                receiptarray = parsePkgRefs(
+                    os.path.join(abspkgpath, toc_entry), xml_data=data)
+                break
+        # If there are PackageInfo files elsewhere, gather them up
+        elif toc_entry.endswith('.pkg/PackageInfo'):
+            data = read_entry(toc_entry)
+            if data is not None:
+                receiptarray.extend(parsePkgRefs(
+                    os.path.join(abspkgpath, toc_entry), xml_data=data))
+
+    distributions = [item for item in toc if item.startswith('Distribution')]
+    if not receiptarray:
+        for toc_entry in distributions:
+            data = read_entry(toc_entry)
+            if data is not None:
+                receiptarray = parsePkgRefs(
+                    os.path.join(abspkgpath, toc_entry),
+                    path_to_pkg=pkgpath, xml_data=data)
+                break
+
+    if not receiptarray:
+        display.display_warning(
+            'No receipts found in Distribution or PackageInfo files within '
+            'the package.')
+
+    productversion = None
+    for toc_entry in distributions:
+        data = read_entry(toc_entry)
+        if data is not None:
+            productversion = getProductVersionFromDist(
+                os.path.join(abspkgpath, toc_entry), xml_data=data)
+
+    info = {
+        "receipts": receiptarray,
+        "product_version": productversion
+    }
+    return info
+
+
 def getFlatPackageInfo(pkgpath):
     """
     returns array of dictionaries with info on subpackages
     contained in the flat package
     """
-    receiptarray = []
+    # read the TOC once and only the members we need, in memory
+    try:
+        with xarutils.XarArchive(pkgpath) as archive:
+            contents = {}
+
+            def read_entry(toc_entry):
+                '''Returns the contents of toc_entry'''
+                if toc_entry not in contents:
+                    contents[toc_entry] = archive.read(toc_entry)
+                return contents[toc_entry]
+
+            return _getFlatPackageInfoFromToc(
+                pkgpath, archive.names(), read_entry)
+    except xarutils.XarError as err:
+        display.display_debug1(
+            'Could not read %s directly, trying xar: %s', pkgpath, err)
+
     # get the absolute path to the pkg because we need to do a chdir later
     abspkgpath = os.path.abspath(pkgpath)
     # make a tmp dir to expand the flat package into
@@ -462,6 +543,26 @@ def getFlatPackageInfo(pkgpath):
     cwd = os.getcwd()
     # change into our tmpdir so we can use xar to unarchive the flat package
     os.chdir(pkgtmp)
+    contents = {}
+
+    def extract_entry(toc_entry):
+        '''Extracts toc_entry with xar and returns its contents'''
+        if toc_entry not in contents:
+            cmd_extract = ['/usr/bin/xar', '-xf', abspkgpath, toc_entry]
+            proc = subprocess.Popen(cmd_extract, bufsize=-1,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            err = proc.communicate()[1]
+            contents[toc_entry] = None
+            if proc.returncode == 0:
+                with open(os.path.join(pkgtmp, toc_entry), 'rb') as fileref:
+                    contents[toc_entry] = fileref.read()
+            else:
+                display.display_warning(
+                    "An error occurred while extracting %s: %s",
+                    toc_entry, err.decode('UTF-8'))
+        return contents[toc_entry]
+
     # Get the TOC of the flat pkg so we can search it later
     cmd_toc = ['/usr/bin/xar', '-tf', abspkgpath]
     proc = subprocess.Popen(cmd_toc, bufsize=-1, stdout=subprocess.PIPE,
@@ -469,74 +570,17 @@ def getFlatPackageInfo(pkgpath):
     (toc, err) = proc.communicate()
     toc = toc.decode('UTF-8').strip().split('\n')
     if proc.returncode == 0:
-        # Walk trough the TOC entries
-        for toc_entry in toc:
-            # If the TOC entry is a top-level PackageInfo, extract it
-            if toc_entry.startswith('PackageInfo') and not receiptarray:
-                cmd_extract = ['/usr/bin/xar', '-xf', abspkgpath, toc_entry]
-                result = subprocess.call(cmd_extract)
-                if result == 0:
-                    packageinfoabspath = os.path.abspath(
-                        os.path.join(pkgtmp, toc_entry))
-                    receiptarray = parsePkgRefs(packageinfoabspath)
-                    break
-                display.display_warning(
-                    "An error occurred while extracting %s: %s",
-                    toc_entry, err)
-            # If there are PackageInfo files elsewhere, gather them up
-            elif toc_entry.endswith('.pkg/PackageInfo'):
-                cmd_extract = ['/usr/bin/xar', '-xf', abspkgpath, toc_entry]
-                result = subprocess.call(cmd_extract)
-                if result == 0:
-                    packageinfoabspath = os.path.abspath(
-                        os.path.join(pkgtmp, toc_entry))
-                    receiptarray.extend(parsePkgRefs(packageinfoabspath))
-                else:
-                    display.display_warning(
-                        "An error occurred while extracting %s: %s",
-                        toc_entry, err)
-        if not receiptarray:
-            for toc_entry in [item for item in toc
-                              if item.startswith('Distribution')]:
-                # Extract the Distribution file
-                cmd_extract = ['/usr/bin/xar', '-xf', abspkgpath, toc_entry]
-                result = subprocess.call(cmd_extract)
-                if result == 0:
-                    distributionabspath = os.path.abspath(
-                        os.path.join(pkgtmp, toc_entry))
-                    receiptarray = parsePkgRefs(distributionabspath,
-                                             path_to_pkg=pkgpath)
-                    break
-                display.display_warning(
-                    "An error occurred while extracting %s: %s",
-                    toc_entry, err)
-
-        if not receiptarray:
-            display.display_warning(
-                'No receipts found in Distribution or PackageInfo files within '
-                'the package.')
-
-        productversion = None
-        for toc_entry in [item for item in toc
-                          if item.startswith('Distribution')]:
-            # Extract the Distribution file
-            cmd_extract = ['/usr/bin/xar', '-xf', abspkgpath, toc_entry]
-            result = subprocess.call(cmd_extract)
-            if result == 0:
-                distributionabspath = os.path.abspath(
-                    os.path.join(pkgtmp, toc_entry))
-                productversion = getProductVersionFromDist(distributionabspath)
-
+        info = _getFlatPackageInfoFromToc(pkgpath, toc, extract_entry)
     else:
         display.display_warning(err.decode('UTF-8'))
+        info = {
+            "receipts": [],
+            "product_version": None
+        }
 
     # change back to original working dir
     os.chdir(cwd)
     shutil.rmtree(pkgtmp)
-    info = {
-        "receipts": receiptarray,
-        "product_version": productversion
-    }
     return info
 
 
@@ -82,6 +82,8 @@ DEFAULT_PREFS = {
     'PackageVerificationMode': 'hash',
     'PerformAuthRestarts': False,
     'RecoveryKeyFile': None,
+    'ReportHistoryMaxAgeDays': 90,
+    'ReportHistoryMaxSizeMB': 20,
     'ShowOptionalInstallsForHigherOSVersions': False,
     'SoftwareRepoCACertificate': None,
     'SoftwareRepoCAPath': None,
@@ -92,8 +94,11 @@ DEFAULT_PREFS = {
     'SuppressStopButtonOnInstall': False,
     'SuppressUserNotification': False,
     'UnattendedAppleUpdates': False,
+    'UseCatalogDeltas': False,
+    'UseCatalogShards': False,
     'UseClientCertificate': False,
     'UseClientCertificateCNAsClientIdentifier': False,
+    'UseCompressedCatalogs': False,
     'UseNotificationCenterDays': 3,
 }
 
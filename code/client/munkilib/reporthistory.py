@@ -0,0 +1,208 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+reporthistory.py
+
+A compact store for the history of ManagedInstallReport.plist files.
+
+Reports are appended to a single data file as individual gzip members, so
+the file only ever grows at the end and each report can be read back on its
+own by seeking to its offset. A small index plist records, for each report,
+its offset and length in the data file plus a summary: start time, duration,
+run type and counts of errors, warnings, installed and removed items.
+Tools that only need the summary never have to decompress or parse a report.
+"""
+from __future__ import absolute_import, print_function
+
+import datetime
+import gzip
+import os
+import time
+import zlib
+
+from .wrappers import (readPlist, readPlistFromString, writePlist,
+                       PlistReadError)
+
+
+DATA_NAME = 'reports.gz'
+INDEX_NAME = 'index.plist'
+INDEX_VERSION = 1
+
+
+class ReportHistoryError(Exception):
+    '''Error to raise when the report history can't be read or written'''
+    pass
+
+
+def _parse_timestamp(timestamp):
+    '''Converts a report timestamp ('2024-01-24 12:34:00 +0000') to seconds
+    since the epoch. Returns None if it can't be parsed.'''
+    try:
+        return datetime.datetime.strptime(
+            str(timestamp), '%Y-%m-%d %H:%M:%S %z').timestamp()
+    except ValueError:
+        return None
+
+
+def summarize(report, default_timestamp=None):
+    '''Returns the index summary for a report dictionary'''
+    summary = {}
+    start = _parse_timestamp(report.get('StartTime'))
+    end = _parse_timestamp(report.get('EndTime'))
+    if start is None:
+        start = default_timestamp or time.time()
+    summary['timestamp'] = start
+    if end is not None and end >= start:
+        summary['duration'] = end - start
+    summary['run_type'] = report.get('RunType') or ''
+    summary['errors'] = len(report.get('Errors') or [])
+    summary['warnings'] = len(report.get('Warnings') or [])
+    summary['installed'] = len(report.get('InstalledItems') or [])
+    summary['removed'] = len(report.get('RemovedItems') or [])
+    return summary
+
+
+class ReportHistory(object):
+    '''An append-only, compressed history of Munki reports'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_path = os.path.join(directory, DATA_NAME)
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self._entries = None
+
+    def _load_index(self):
+        '''Reads the index, if we haven't already'''
+        if self._entries is None:
+            self._entries = []
+            if os.path.exists(self.index_path):
+                try:
+                    index = readPlist(self.index_path)
+                except PlistReadError as err:
+                    raise ReportHistoryError(
+                        'Could not read %s: %s' % (self.index_path, err))
+                self._entries = list(index.get('entries', []))
+        return self._entries
+
+    def _save_index(self, entries):
+        '''Atomically replaces the index with entries'''
+        temp_path = self.index_path + '.tmp'
+        writePlist({'version': INDEX_VERSION, 'entries': entries}, temp_path)
+        os.rename(temp_path, self.index_path)
+        self._entries = entries
+
+    def entries(self, since=None, until=None, run_type=None,
+                with_errors=False, limit=None):
+        '''Returns index entries, oldest first, optionally filtered.
+
+        since, until: seconds since the epoch
+        run_type: only entries with this RunType (e.g. 'auto')
+        with_errors: only entries whose report had errors
+        limit: only the most recent limit matching entries'''
+        matches = []
+        for entry in self._load_index():
+            if since is not None and entry['timestamp'] < since:
+                continue
+            if until is not None and entry['timestamp'] > until:
+                continue
+            if run_type is not None and entry.get('run_type') != run_type:
+                continue
+            if with_errors and not entry.get('errors'):
+                continue
+            matches.append(entry)
+        if limit:
+            matches = matches[-limit:]
+        return matches
+
+    def total_size(self):
+        '''Returns the compressed size of all reports in the history'''
+        return sum(entry['length'] for entry in self._load_index())
+
+    def append(self, report_data, default_timestamp=None):
+        '''Adds a report, given as the bytes of a report plist, to the
+        history. Returns the new index entry.'''
+        try:
+            report = readPlistFromString(report_data)
+        except PlistReadError as err:
+            raise ReportHistoryError('Invalid report: %s' % err)
+        entry = summarize(report, default_timestamp=default_timestamp)
+        entries = list(self._load_index())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self.data_path, 'ab') as fileref:
+                # a previous interrupted append may have left bytes that
+                # aren't in the index; those are simply never read
+                fileref.seek(0, os.SEEK_END)
+                entry['offset'] = fileref.tell()
+                compressed = gzip.compress(report_data)
+                fileref.write(compressed)
+            entry['length'] = len(compressed)
+            entries.append(entry)
+            self._save_index(entries)
+        except (OSError, IOError) as err:
+            raise ReportHistoryError('Could not store report: %s' % err)
+        return entry
+
+    def get_report(self, entry):
+        '''Returns the full report dictionary for an index entry'''
+        try:
+            with open(self.data_path, 'rb') as fileref:
+                fileref.seek(entry['offset'])
+                compressed = fileref.read(entry['length'])
+            return readPlistFromString(gzip.decompress(compressed))
+        except (OSError, IOError, EOFError, zlib.error,
+                PlistReadError) as err:
+            raise ReportHistoryError('Could not read report: %s' % err)
+
+    def prune(self, max_age_days=None, max_bytes=None, now=None):
+        '''Removes reports older than max_age_days, then the oldest reports
+        until the history is no larger than max_bytes (compressed). The data
+        file is rewritten only if something was removed. Returns the number
+        of reports removed.'''
+        entries = self._load_index()
+        keep = list(entries)
+        if max_age_days is not None:
+            cutoff = (now or time.time()) - max_age_days * 24 * 60 * 60
+            keep = [entry for entry in keep if entry['timestamp'] >= cutoff]
+        if max_bytes is not None:
+            total = sum(entry['length'] for entry in keep)
+            while keep and total > max_bytes:
+                total -= keep.pop(0)['length']
+        removed = len(entries) - len(keep)
+        if not removed:
+            return 0
+
+        temp_data_path = self.data_path + '.tmp'
+        new_entries = []
+        try:
+            with open(self.data_path, 'rb') as source:
+                with open(temp_data_path, 'wb') as destination:
+                    for entry in keep:
+                        source.seek(entry['offset'])
+                        new_entry = dict(entry)
+                        new_entry['offset'] = destination.tell()
+                        destination.write(source.read(entry['length']))
+                        new_entries.append(new_entry)
+            os.rename(temp_data_path, self.data_path)
+            self._save_index(new_entries)
+        except (OSError, IOError) as err:
+            raise ReportHistoryError('Could not prune history: %s' % err)
+        return removed
+
+
+if __name__ == '__main__':
+    print('This is a library of support tools for the Munki Suite.')
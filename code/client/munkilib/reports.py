@@ -24,12 +24,11 @@ Reporting functions
 from __future__ import absolute_import, print_function
 
 import os
-import subprocess
 import sys
-import time
 
 from . import munkilog
 from . import prefs
+from . import reporthistory
 from . import FoundationPlist
 
 # This code is largely still compatible with Python 2, so for now, turn off
@@ -92,42 +91,57 @@ def _warn(msg):
     munkilog.log(warning, 'warnings.log')
 
 
+def report_history():
+    """Returns the ReportHistory for this machine"""
+    return reporthistory.ReportHistory(
+        os.path.join(prefs.pref('ManagedInstallDir'), 'Archives',
+                     'ReportHistory'))
+
+
+def _prune_legacy_archives(archivepath, keep=100):
+    """Keeps the number of ManagedInstallReport-*.plist files written by
+    older versions of Munki to keep or fewer"""
+    try:
+        archiveitems = [os.path.join(archivepath, item)
+                        for item in os.listdir(archivepath)
+                        if item.startswith('ManagedInstallReport-')]
+    except OSError:
+        return
+    archiveitems.sort(key=os.path.getmtime, reverse=True)
+    for itempath in archiveitems[keep:]:
+        if os.path.isfile(itempath):
+            try:
+                os.unlink(itempath)
+            except (OSError, IOError):
+                _warn('Could not remove archive item %s'
+                      % os.path.basename(itempath))
+
+
 def archive_report():
-    """Archive a report"""
+    """Archive a report into the report history, then prune the history"""
     reportfile = os.path.join(
         prefs.pref('ManagedInstallDir'), 'ManagedInstallReport.plist')
+    history = report_history()
     if os.path.exists(reportfile):
-        modtime = os.stat(reportfile).st_mtime
-        formatstr = '%Y-%m-%d-%H%M%S'
-        archivename = ('ManagedInstallReport-%s.plist'
-                       % time.strftime(formatstr, time.localtime(modtime)))
-        archivepath = os.path.join(prefs.pref('ManagedInstallDir'), 'Archives')
-        if not os.path.exists(archivepath):
-            try:
-                os.mkdir(archivepath)
-            except (OSError, IOError):
-                _warn('Could not create report archive path.')
         try:
-            os.rename(reportfile, os.path.join(archivepath, archivename))
-        except (OSError, IOError):
-            _warn('Could not archive report.')
-        # now keep number of archived reports to 100 or fewer
-        proc = subprocess.Popen(['/bin/ls', '-t1', archivepath],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output = proc.communicate()[0].decode('UTF-8')
-        if output:
-            archiveitems = [item
-                            for item in str(output).splitlines()
-                            if item.startswith('ManagedInstallReport-')]
-            if len(archiveitems) > 100:
-                for item in archiveitems[100:]:
-                    itempath = os.path.join(archivepath, item)
-                    if os.path.isfile(itempath):
-                        try:
-                            os.unlink(itempath)
-                        except (OSError, IOError):
-                            _warn('Could not remove archive item %s' % item)
+            with open(reportfile, 'rb') as fileref:
+                report_data = fileref.read()
+            history.append(report_data,
+                           default_timestamp=os.stat(reportfile).st_mtime)
+            os.unlink(reportfile)
+        except (OSError, IOError, reporthistory.ReportHistoryError) as err:
+            _warn('Could not archive report: %s' % err)
+    # for either limit, 0 or no value means no limit
+    max_age_days = prefs.pref('ReportHistoryMaxAgeDays')
+    max_size_mb = prefs.pref('ReportHistoryMaxSizeMB')
+    try:
+        history.prune(
+            max_age_days=max_age_days or None,
+            max_bytes=max_size_mb * 1024 * 1024 if max_size_mb else None)
+    except reporthistory.ReportHistoryError as err:
+        _warn('Could not prune report history: %s' % err)
+    _prune_legacy_archives(
+        os.path.join(prefs.pref('ManagedInstallDir'), 'Archives'))
 
 
 # module globals
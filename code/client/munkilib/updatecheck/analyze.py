@@ -149,7 +149,7 @@ def process_optional_install(manifestitem, cataloglist, installinfo):
     """
     manifestitemname = os.path.split(manifestitem)[1]
     display.display_debug1(
-        "* Processing manifest item %s for optional install" % manifestitemname)
+        "* Processing manifest item %s for optional install", manifestitemname)
 
     if already_processed(
             manifestitemname, installinfo,
@@ -675,7 +675,7 @@ def process_install(manifestitem, cataloglist, installinfo,
     # (unless it is a managed_update)
     if not is_managed_update:
         display.display_debug2(
-            'Adding %s to list of processed installs' % manifestitemname)
+            'Adding %s to list of processed installs', manifestitemname)
         installinfo['processed_installs'].append(manifestitemname)
 
     return True
@@ -790,7 +790,7 @@ def process_removal(manifestitem, cataloglist, installinfo):
 
     manifestitemname_withversion = os.path.split(manifestitem)[1]
     display.display_debug1(
-        '* Processing manifest item %s for removal' %
+        '* Processing manifest item %s for removal',
         manifestitemname_withversion)
 
     (manifestitemname, includedversion) = catalogs.split_name_and_version(
@@ -915,11 +915,14 @@ def process_removal(manifestitem, cataloglist, installinfo):
     alt_uninstall_name_w_version = (
         '%s--%s' % (uninstall_item.get('name'), uninstall_item.get('version')))
     processednames = []
+    catalogs.load_items_for(
+        cataloglist, requires=[uninstall_item_name, uninstall_name_w_version,
+                               alt_uninstall_name_w_version])
     for catalogname in cataloglist:
         if not catalogname in catalogs.catalogs():
             # in case the list refers to a non-existent catalog
             continue
-        for item_pl in catalogs.catalogs()[catalogname]['items']:
+        for item_pl in catalogs.catalogs()[catalogname]['requirers']:
             name = item_pl.get('name')
             if name not in processednames:
                 if 'requires' in item_pl:
@@ -27,22 +27,33 @@ Functions for working with Munki catalogs
 from __future__ import absolute_import, print_function
 
 import os
+import shutil
 import unicodedata
 
+from concurrent.futures import ThreadPoolExecutor
+
 from . import download
 
+from .. import catalogindex
+from .. import catalogshards
 from .. import display
 from .. import info
 from .. import pkgutils
 from .. import prefs
 from .. import utils
 from .. import FoundationPlist
-from ..wrappers import is_a_string
+from ..wrappers import is_a_string, readPlist, PlistReadError
+
 
+# make_catalog_db() entries that are lists of items rather than tables
+ITEM_LIST_KEYS = ('updaters', 'requirers', 'unused_software_candidates')
 
-def make_catalog_db(catalogitems):
+
+def make_catalog_db(catalogitems, warn_bad_items=True):
     """Takes an array of catalog items and builds some indexes so we can
-    get our common data faster. Returns a dict we can use like a database"""
+    get our common data faster. Returns a dict we can use like a database.
+    Warns about items without a name or version unless warn_bad_items is
+    False."""
     name_table = {}
     pkgid_table = {}
 
@@ -52,7 +63,7 @@ def make_catalog_db(catalogitems):
         name = item.get('name', 'NO NAME')
         vers = item.get('version', 'NO VERSION')
 
-        if name == 'NO NAME' or vers == 'NO VERSION':
+        if warn_bad_items and (name == 'NO NAME' or vers == 'NO VERSION'):
             display.display_warning('Bad pkginfo: %s', item)
 
         # normalize the version number
@@ -102,43 +113,86 @@ def make_catalog_db(catalogitems):
     # convert to set and back to list to get list of unique names
     autoremoveitems = list(set(autoremoveitems))
 
+    # items that require others, and items that can be removed if unused,
+    # so callers interested only in those needn't look at every item
+    requirers = [item for item in catalogitems if 'requires' in item]
+    unused_software_candidates = [
+        item for item in catalogitems
+        if item.get('unused_software_removal_info')]
+
     pkgdb = {}
     pkgdb['named'] = name_table
     pkgdb['receipts'] = pkgid_table
     pkgdb['updaters'] = updaters
     pkgdb['autoremoveitems'] = autoremoveitems
+    pkgdb['requirers'] = requirers
+    pkgdb['unused_software_candidates'] = unused_software_candidates
+    pkgdb['package_ids'] = catalogshards.package_ids_table(catalogitems)
     pkgdb['items'] = catalogitems
 
     return pkgdb
 
 
-def add_package_ids(catalogitems, itemname_to_pkgid, pkgid_to_itemname):
-    """Adds packageids from each catalogitem to two dictionaries.
-    One maps itemnames to receipt pkgids, the other maps receipt pkgids
-    to itemnames"""
-    for item in catalogitems:
-        name = item.get('name')
-        if not name:
-            continue
-        if item.get('receipts'):
-            if not name in itemname_to_pkgid:
-                itemname_to_pkgid[name] = {}
-
-            for receipt in item['receipts']:
-                if 'packageid' in receipt and 'version' in receipt:
-                    pkgid = receipt['packageid']
-                    vers = receipt['version']
-                    if not pkgid in itemname_to_pkgid[name]:
-                        itemname_to_pkgid[name][pkgid] = []
-                    if not vers in itemname_to_pkgid[name][pkgid]:
-                        itemname_to_pkgid[name][pkgid].append(vers)
-
-                    if not pkgid in pkgid_to_itemname:
-                        pkgid_to_itemname[pkgid] = {}
-                    if not name in pkgid_to_itemname[pkgid]:
-                        pkgid_to_itemname[pkgid][name] = []
-                    if not vers in pkgid_to_itemname[pkgid][name]:
-                        pkgid_to_itemname[pkgid][name].append(vers)
+def write_catalog_index(indexpath, catalogpath, pkgdb):
+    """Writes an on-disk index of a catalog db made by make_catalog_db, so
+    later runs can use it without decoding every item. Raises
+    catalogindex.CatalogIndexError if it can't be written."""
+    positions = dict(
+        (id(item), index) for (index, item) in enumerate(pkgdb['items']))
+    tables = dict((key, value) for (key, value) in pkgdb.items()
+                  if key != 'items' and key not in ITEM_LIST_KEYS)
+    item_lists = dict(
+        (key, [positions[id(item)] for item in pkgdb[key]])
+        for key in ITEM_LIST_KEYS)
+    catalogindex.write_index(
+        indexpath, catalogpath, pkgdb['items'], tables, item_lists)
+
+
+def open_catalog_index(indexpath, catalogpath):
+    """Returns a catalog db like make_catalog_db's from the index at
+    indexpath, or None if it isn't current for the catalog at catalogpath.
+    Its items are decoded only as they are used."""
+    index = catalogindex.open_index(indexpath, catalogpath)
+    if index is None:
+        return None
+    (pkgdb, items, item_lists) = index
+    pkgdb.update(item_lists)
+    pkgdb['items'] = items
+    return pkgdb
+
+
+def warn_about_bad_items(pkgdb):
+    """Repeats the warnings make_catalog_db gave about items without a
+    name or version"""
+    bad_indexes = set()
+    for (name, versions) in pkgdb['named'].items():
+        for (vers, indexlist) in versions.items():
+            if name == 'NO NAME' or vers == 'NO VERSION':
+                bad_indexes.update(indexlist)
+    for itemindex in sorted(bad_indexes):
+        display.display_warning('Bad pkginfo: %s', pkgdb['items'][itemindex])
+
+
+def add_package_ids(package_ids, itemname_to_pkgid, pkgid_to_itemname):
+    """Adds packageids from a table made by catalogshards.package_ids_table
+    to two dictionaries. One maps itemnames to receipt pkgids, the other maps
+    receipt pkgids to itemnames"""
+    for (name, receipts) in package_ids:
+        if not name in itemname_to_pkgid:
+            itemname_to_pkgid[name] = {}
+
+        for (pkgid, vers) in receipts:
+            if not pkgid in itemname_to_pkgid[name]:
+                itemname_to_pkgid[name][pkgid] = []
+            if not vers in itemname_to_pkgid[name][pkgid]:
+                itemname_to_pkgid[name][pkgid].append(vers)
+
+            if not pkgid in pkgid_to_itemname:
+                pkgid_to_itemname[pkgid] = {}
+            if not name in pkgid_to_itemname[pkgid]:
+                pkgid_to_itemname[pkgid][name] = []
+            if not vers in pkgid_to_itemname[pkgid][name]:
+                pkgid_to_itemname[pkgid][name].append(vers)
 
 
 def split_name_and_version(some_string):
@@ -178,6 +232,7 @@ def get_all_items_with_name(name, cataloglist):
     name = split_name_and_version(name)[0]
 
     display.display_debug1('Looking for all items matching: %s...', name)
+    load_items_for(cataloglist, names=[name])
     for catalogname in cataloglist:
         if not catalogname in list(_CATALOG.keys()):
             # in case catalogname refers to a non-existent catalog...
@@ -241,6 +296,7 @@ def look_for_updates(itemname, cataloglist):
     display.display_debug1('Looking for updates for: %s', itemname)
     # get a list of catalog items that are updates for other items
     update_list = []
+    load_items_for(cataloglist, update_for=[itemname])
     for catalogname in cataloglist:
         if catalogname not in _CATALOG:
             # in case the list refers to a non-existent catalog
@@ -311,8 +367,8 @@ def analyze_installed_pkgs():
     itemname_to_pkgid = {}
     pkgid_to_itemname = {}
     for catalogname in _CATALOG:
-        catalogitems = _CATALOG[catalogname]['items']
-        add_package_ids(catalogitems, itemname_to_pkgid, pkgid_to_itemname)
+        add_package_ids(_CATALOG[catalogname]['package_ids'],
+                        itemname_to_pkgid, pkgid_to_itemname)
     # itemname_to_pkgid now contains all receipts (pkgids) we know about
     # from items in all available catalogs
 
@@ -572,6 +628,7 @@ def get_item_detail(name, cataloglist, vers='',
         display.display_debug1(
             'Looking for detail for: %s, version %s...', name, vers)
 
+    load_items_for(cataloglist, names=[name])
     for catalogname in cataloglist:
         # is name in the catalog?
         name = unicodedata.normalize("NFC", name)
@@ -590,8 +647,8 @@ def get_item_detail(name, cataloglist, vers='',
 
             if indexlist:
                 display.display_debug1(
-                    'Considering %s items with name %s from catalog %s' %
-                    (len(indexlist), name, catalogname))
+                    'Considering %s items with name %s from catalog %s',
+                    len(indexlist), name, catalogname)
             for index in indexlist:
                 # iterate through list of items with matching name, highest
                 # version first, looking for first one that passes all the
@@ -624,32 +681,255 @@ def get_catalogs(cataloglist):
     dictionary.
     """
     #global _CATALOG
+    use_shards = prefs.pref('UseCatalogShards')
     for catalogname in cataloglist:
         if not catalogname in _CATALOG:
+            load_catalog(catalogname,
+                         *download_catalog_files(catalogname, use_shards))
+
+
+def download_catalog_files(catalogname, use_shards):
+    """Downloads the shard index of catalogname if use_shards and there is
+    one, otherwise the whole catalog. Returns (shard index path, catalog
+    path); either may be None. Only downloads, so it can be run on a worker
+    thread."""
+    if use_shards:
+        indexpath = download.download_catalog_shard_index(catalogname)
+        if indexpath:
+            return (indexpath, None)
+    return (None, download.download_catalog(catalogname))
+
+
+def load_catalog(catalogname, indexpath, catalogpath):
+    """Loads catalogname into our catalogs dictionary from the files
+    download_catalog_files returned for it"""
+    catalogdb = None
+    if indexpath:
+        catalogdb = load_sharded_catalog_db(catalogname, indexpath)
+        if catalogdb is None:
             catalogpath = download.download_catalog(catalogname)
-            if catalogpath:
-                try:
-                    catalogdata = FoundationPlist.readPlist(catalogpath)
-                except FoundationPlist.NSPropertyListSerializationException:
-                    display.display_error(
-                        'Retrieved catalog %s is invalid.', catalogname)
-                    try:
-                        os.unlink(catalogpath)
-                    except (OSError, IOError):
-                        pass
-                else:
-                    _CATALOG[catalogname] = make_catalog_db(catalogdata)
+    if catalogdb is None and catalogpath:
+        catalogdb = load_catalog_db(catalogname, catalogpath)
+    if catalogdb is not None:
+        _CATALOG[catalogname] = catalogdb
+
+
+def load_whole_catalog_db(catalogname):
+    """Downloads catalogname and returns a catalog db for it, or None"""
+    catalogpath = download.download_catalog(catalogname)
+    if catalogpath:
+        return load_catalog_db(catalogname, catalogpath)
+    return None
+
+
+def load_catalog_db(catalogname, catalogpath):
+    """Returns a catalog db for the catalog at catalogpath, or None if the
+    catalog is invalid. The catalog's on-disk index is used if it's current;
+    if not, the catalog is read and a new index written."""
+    indexpath = catalogindex.index_path(catalogpath)
+    catalogdb = open_catalog_index(indexpath, catalogpath)
+    if catalogdb is not None:
+        display.display_debug1('Using index of catalog %s', catalogname)
+        warn_about_bad_items(catalogdb)
+        return catalogdb
+    try:
+        # items must be plain Python objects to be indexed
+        catalogdata = readPlist(catalogpath)
+    except PlistReadError:
+        # not something plistlib can read; see if Foundation can
+        try:
+            catalogdata = FoundationPlist.readPlist(catalogpath)
+        except FoundationPlist.NSPropertyListSerializationException:
+            display.display_error(
+                'Retrieved catalog %s is invalid.', catalogname)
+            try:
+                os.unlink(catalogpath)
+            except (OSError, IOError):
+                pass
+            return None
+        return make_catalog_db(catalogdata)
+    catalogdb = make_catalog_db(catalogdata)
+    try:
+        write_catalog_index(indexpath, catalogpath, catalogdb)
+    except catalogindex.CatalogIndexError as err:
+        display.display_debug1('%s', err)
+        return catalogdb
+    # use the index we just wrote, so the decoded items can be freed
+    return open_catalog_index(indexpath, catalogpath) or catalogdb
+
+
+def prefetch_catalogs(cataloglist, max_workers=4):
+    """Downloads the catalogs in cataloglist concurrently, then loads them,
+    so later calls to get_catalogs find them already loaded. The worker
+    threads only download; catalogs are read, indexed and added to our
+    catalogs dictionary on the calling thread."""
+    names = [name for name in cataloglist if name not in _CATALOG]
+    if not names:
+        return
+    display.display_debug1('Prefetching catalogs: %s', ', '.join(names))
+    use_shards = prefs.pref('UseCatalogShards')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded = list(executor.map(
+            lambda name: download_catalog_files(name, use_shards), names))
+    for (catalogname, (indexpath, catalogpath)) in zip(names, downloaded):
+        load_catalog(catalogname, indexpath, catalogpath)
+
+
+def load_sharded_catalog_db(catalogname, indexpath):
+    """Returns a catalog db for catalogname made from its shard index at
+    indexpath, or None if the index can't be read. No items are loaded until
+    they're needed; see load_shards. The db's autoremoveitems and
+    package_ids cover the whole catalog."""
+    try:
+        index = readPlist(indexpath)
+    except PlistReadError as err:
+        display.display_debug1(
+            'Shard index of catalog %s is invalid: %s', catalogname, err)
+        return None
+    catalogdb = make_catalog_db([])
+    catalogdb['autoremoveitems'] = list(index.get('autoremove', []))
+    catalogdb['package_ids'] = index.get('package_ids', [])
+    catalogdb['shard_index'] = index
+    catalogdb['shard_items'] = {}
+    display.display_debug1('Using shard index of catalog %s', catalogname)
+    return catalogdb
+
+
+def load_shards(catalogname, names, max_workers=4):
+    """Makes sure the items with names are loaded from the shards of
+    catalogname, fetching the shards concurrently. If a shard can't be
+    had, falls back to the whole catalog."""
+    catalogdb = _CATALOG.get(catalogname)
+    if not catalogdb or 'shard_index' not in catalogdb:
+        return
+    shards = catalogdb['shard_index'].get('shards', {})
+    names = sorted(set(
+        name for name in names
+        if name in shards and name not in catalogdb['shard_items']))
+    if not names:
+        return
+    display.display_debug1(
+        'Loading %s shards of catalog %s', len(names), catalogname)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_paths = list(executor.map(
+            lambda name: download.download_catalog_shard(
+                catalogname, shards[name]), names))
+    new_items = {}
+    for (name, shard_path) in zip(names, shard_paths):
+        try:
+            if shard_path:
+                new_items[name] = readPlist(shard_path)
+                continue
+        except PlistReadError as err:
+            display.display_warning(
+                'Shard %s of catalog %s is invalid: %s',
+                shards[name]['file'], catalogname, err)
+        # without this shard we can't answer lookups as the whole catalog
+        # would
+        display.display_warning(
+            'Using the whole catalog %s instead of its shards', catalogname)
+        wholedb = load_whole_catalog_db(catalogname)
+        if wholedb is not None:
+            _CATALOG[catalogname] = wholedb
+        return
+    for items in new_items.values():
+        for item in items:
+            if (item.get('name', 'NO NAME') == 'NO NAME' or
+                    item.get('version', 'NO VERSION') == 'NO VERSION'):
+                display.display_warning('Bad pkginfo: %s', item)
+    catalogdb['shard_items'].update(new_items)
+
+    # rebuild the tables from every loaded item, in catalog order, so
+    # lookups find items in the order they would in the whole catalog
+    positioned_items = []
+    for (name, items) in catalogdb['shard_items'].items():
+        positioned_items.extend(zip(shards[name]['positions'], items))
+    positioned_items.sort(key=lambda positioned_item: positioned_item[0])
+    # the warnings were given above
+    rebuilt = make_catalog_db(
+        [item for (dummy_position, item) in positioned_items],
+        warn_bad_items=False)
+    for key in ('named', 'receipts', 'items') + ITEM_LIST_KEYS:
+        catalogdb[key] = rebuilt[key]
+
+
+def load_items_for(cataloglist, names=(), update_for=(), requires=()):
+    """Makes sure the sharded catalogs in cataloglist have loaded the items
+    named names, the items that are updates for the update_for strings, and
+    the items that require the requires strings. Whole catalogs have all
+    their items already."""
+    for catalogname in cataloglist or []:
+        catalogdb = _CATALOG.get(catalogname)
+        if not catalogdb or 'shard_index' not in catalogdb:
+            continue
+        index = catalogdb['shard_index']
+        wanted = set(catalogshards.normalized_name(name) for name in names)
+        for update_for_string in update_for:
+            wanted.update(index.get('update_for', {}).get(
+                update_for_string, []))
+        wanted.update(catalogshards.names_requiring(index, requires))
+        load_shards(catalogname, wanted)
+
+
+def prefetch_catalog_shards(cataloglist, names):
+    """For the sharded catalogs in cataloglist, loads the items with names,
+    those they require, the items that are updates for them, and the items
+    marked for autoremoval; and so on for those in turn. Anything else is
+    fetched if and when it's looked up."""
+    for catalogname in cataloglist:
+        catalogdb = _CATALOG.get(catalogname)
+        if not catalogdb or 'shard_index' not in catalogdb:
+            continue
+        index = catalogdb['shard_index']
+        reachable = catalogshards.reachable_names(
+            index, list(names) + list(index.get('autoremove', [])),
+            split_name_and_version)
+        display.display_debug1(
+            '%s of %s item names in catalog %s are referred to',
+            len(reachable), len(index.get('shards', {})), catalogname)
+        load_shards(catalogname, reachable)
 
 
 def clean_up():
     """Removes any catalog files that are no longer in use by this client"""
     catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'),
                                'catalogs')
+    # catalogs we used in full, rather than by shard
+    whole_catalogs = set(catalogname for catalogname in _CATALOG
+                         if 'shard_index' not in _CATALOG[catalogname])
     for item in os.listdir(catalog_dir):
-        if item not in _CATALOG:
+        if item == catalogshards.SHARDS_DIR:
+            clean_up_shards(os.path.join(catalog_dir, item))
+            continue
+        if item.endswith('.gz') and item[:-3] in whole_catalogs:
+            # compressed copy of a catalog in use; kept for conditional
+            # requests
+            continue
+        if (item.endswith(catalogindex.INDEX_SUFFIX) and
+                item[:-len(catalogindex.INDEX_SUFFIX)] in whole_catalogs):
+            # index of a catalog in use
+            continue
+        if item not in whole_catalogs:
             os.unlink(os.path.join(catalog_dir, item))
 
 
+def clean_up_shards(shards_dir):
+    """Removes shards that are no longer in use by this client. Shards of
+    a sharded catalog in use are kept, even if we didn't need them this
+    time."""
+    for catalogname in os.listdir(shards_dir):
+        catalog_shards_dir = os.path.join(shards_dir, catalogname)
+        index = _CATALOG.get(catalogname, {}).get('shard_index')
+        if index is None:
+            shutil.rmtree(catalog_shards_dir, ignore_errors=True)
+            continue
+        keep = set(shard['file'] for shard in index.get('shards', {}).values())
+        keep.add(catalogshards.INDEX_NAME)
+        for item in os.listdir(catalog_shards_dir):
+            if item not in keep:
+                os.unlink(os.path.join(catalog_shards_dir, item))
+
+
 def catalogs():
     '''Returns our internal _CATALOG dict'''
     return _CATALOG
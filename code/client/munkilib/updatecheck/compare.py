@@ -94,8 +94,8 @@ def compare_application_version(app):
             'No path, application name or bundleid was specified!')
 
     display.display_debug1(
-        'Looking for application %s with bundleid: %s, version %s...' %
-        (name, bundleid, versionstring))
+        'Looking for application %s with bundleid: %s, version %s...',
+        name, bundleid, versionstring)
 
     # find installed apps that match this item by name or bundleid
     appdata = info.filtered_app_data()
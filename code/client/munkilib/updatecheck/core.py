@@ -37,6 +37,7 @@ from . import download
 from . import licensing
 from . import manifestutils
 from . import selfservice
+from . import unused_software
 
 from .. import display
 from .. import info
@@ -118,6 +119,27 @@ def check(client_id='', localmanifestpath=None):
         # recreate if still valid
         osinstaller.remove_staged_os_installer_info()
 
+        # fetch all the manifests and catalogs we'll need concurrently and
+        # up front, so the passes below work from the local copies
+        display.display_detail('**Fetching manifests and catalogs**')
+        cataloglist = manifestutils.prefetch_manifests(mainmanifestpath)
+        catalogs.prefetch_catalogs(cataloglist)
+        if prefs.pref('UseCatalogShards'):
+            # fetch the shards of the items the manifests refer to; any
+            # others are fetched if they're looked up
+            manifestpaths = list(manifestutils.manifests().values())
+            manifestpaths.append(selfservice.manifest_path())
+            if prefs.pref('LocalOnlyManifest'):
+                manifestpaths.append(os.path.join(
+                    managed_install_dir, 'manifests',
+                    prefs.pref('LocalOnlyManifest')))
+            catalogs.prefetch_catalog_shards(
+                cataloglist,
+                manifestutils.referenced_item_names(manifestpaths))
+        unused_software.clear_usage_data()
+        if processes.stop_requested():
+            return 0
+
         display.display_detail('**Checking for installs**')
         analyze.process_manifest_for_key(
             mainmanifestpath, 'managed_installs', installinfo)
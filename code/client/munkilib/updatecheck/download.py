@@ -23,7 +23,10 @@ Functions for downloading resources from the Munki server
 """
 from __future__ import absolute_import, print_function
 
+import gzip
 import os
+import shutil
+import zlib
 
 try:
     # Python 2
@@ -38,6 +41,8 @@ except ImportError:
     # Python 3
     from urllib.parse import urlparse
 
+from .. import catalogdeltas
+from .. import catalogshards
 from .. import display
 from .. import fetch
 from .. import info
@@ -47,6 +52,8 @@ from .. import osutils
 from .. import prefs
 from .. import reports
 from .. import FoundationPlist
+from ..wrappers import (readPlist, writePlistToString,
+                        PlistReadError, PlistWriteError)
 
 
 ICON_HASHES_PLIST_NAME = '_icon_hashes.plist'
@@ -348,19 +355,156 @@ def download_client_resources():
                     'Could not remove stale %s: %s', resource_archive_path, err)
 
 
-def download_catalog(catalogname):
-    '''Attempt to download a catalog from the Munki server, Returns the path to
-    the downloaded catalog file'''
+def update_catalog_from_delta(catalogbaseurl, catalogname, catalogpath):
+    '''Attempts to bring the cached catalog at catalogpath up to date by
+    applying a delta published by makecatalogs. Returns True if the cached
+    catalog is now current; False if a full download is needed.'''
+    if not os.path.isfile(catalogpath):
+        return False
+    deltas_url = (catalogbaseurl + catalogdeltas.DELTAS_DIR + '/' +
+                  quote(catalogname.encode('UTF-8')) + '/')
+    delta_dir = os.path.join(osutils.tmpdir(), 'catalog_deltas')
+    if not os.path.isdir(delta_dir):
+        os.makedirs(delta_dir)
+    index_path = os.path.join(delta_dir, catalogname + '.index.plist')
+    try:
+        fetch.munki_resource(
+            deltas_url + catalogdeltas.INDEX_NAME, index_path)
+        index = readPlist(index_path)
+    except (fetch.Error, PlistReadError) as err:
+        display.display_debug1(
+            'No delta index for catalog %s: %s', catalogname, err)
+        return False
+
+    cached_hash = munkihash.getsha256hash(catalogpath)
+    if cached_hash == index.get('catalog_hash'):
+        display.display_detail('Cached catalog %s is current.', catalogname)
+        return True
+    for delta_info in index.get('deltas', []):
+        if delta_info.get('from_hash') == cached_hash:
+            break
+    else:
+        display.display_debug1(
+            'No delta available from the cached revision of catalog %s',
+            catalogname)
+        return False
+
+    delta_path = os.path.join(delta_dir, catalogname + '.delta.plist')
+    message = 'Updating catalog "%s" from revision %s to %s...' % (
+        catalogname, delta_info.get('from_revision'), index.get('revision'))
+    try:
+        fetch.munki_resource(
+            deltas_url + quote(delta_info['name'].encode('UTF-8')),
+            delta_path, message=message)
+        delta = readPlist(delta_path)
+        new_items = catalogdeltas.apply_delta(readPlist(catalogpath), delta)
+        catalog_data = writePlistToString(new_items)
+    except (fetch.Error, PlistReadError, PlistWriteError,
+            catalogdeltas.CatalogDeltaError) as err:
+        display.display_warning(
+            'Could not apply delta to catalog %s: %s', catalogname, err)
+        return False
+    # the patched catalog must be byte-for-byte identical to the full one
+    if catalogdeltas.catalog_hash(catalog_data) != index.get('catalog_hash'):
+        display.display_warning(
+            'Patched catalog %s does not match the catalog on the server.',
+            catalogname)
+        return False
+
+    temp_path = catalogpath + '.download'
+    try:
+        with open(temp_path, 'wb') as fileref:
+            fileref.write(catalog_data)
+        os.rename(temp_path, catalogpath)
+    except (OSError, IOError) as err:
+        display.display_warning(
+            'Could not write patched catalog %s: %s', catalogname, err)
+        return False
+    display.display_detail(
+        'Updated catalog %s to revision %s using a delta (%s added, '
+        '%s removed)', catalogname, index.get('revision'),
+        len(delta.get('added', {})), len(delta.get('removed', [])))
+    return True
+
+
+def download_compressed_catalog(catalogurl, catalogpath, message=None):
+    '''Attempts to download the gzip-compressed variant of a catalog
+    published by makecatalogs --gzip and decompress it to catalogpath. The
+    result is checked against the SHA-256 of the catalog that makecatalogs
+    publishes beside it. The compressed file is kept next to the catalog so
+    later runs can make conditional requests for it. Returns True if
+    catalogpath is current; False if the plain catalog should be downloaded
+    instead.'''
+    hash_path = os.path.join(
+        osutils.tmpdir(), os.path.basename(catalogpath) + '.sha256')
+    try:
+        fetch.munki_resource(catalogurl + '.sha256', hash_path)
+        with open(hash_path, 'rb') as fileref:
+            expected_hash = fileref.read().decode('UTF-8').strip()
+    except (fetch.Error, OSError, IOError, UnicodeDecodeError) as err:
+        display.display_debug1(
+            'Could not retrieve compressed catalog hash: %s', err)
+        return False
+    if (os.path.isfile(catalogpath) and
+            munkihash.getsha256hash(catalogpath) == expected_hash):
+        display.display_detail('Cached catalog %s is current.', catalogpath)
+        return True
+
+    compressed_path = catalogpath + '.gz'
+    temp_path = catalogpath + '.download'
+    try:
+        fetch.munki_resource(
+            catalogurl + '.gz', compressed_path, message=message)
+    except fetch.Error as err:
+        display.display_debug1(
+            'Could not retrieve compressed catalog: %s', err)
+        return False
+    try:
+        with gzip.open(compressed_path, 'rb') as source:
+            with open(temp_path, 'wb') as destination:
+                shutil.copyfileobj(source, destination, 2**20)
+        if munkihash.getsha256hash(temp_path) != expected_hash:
+            raise ValueError('does not match the catalog on the server')
+        os.rename(temp_path, catalogpath)
+    except (OSError, IOError, EOFError, ValueError, zlib.error) as err:
+        display.display_warning(
+            'Could not decompress %s: %s', compressed_path, err)
+        # don't let a conditional request keep a bad compressed catalog
+        for path in (temp_path, compressed_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return False
+    return True
+
+
+def catalog_base_url():
+    '''Returns the URL catalog names are appended to'''
     catalogbaseurl = (prefs.pref('CatalogURL') or
                       prefs.pref('SoftwareRepoURL') + '/catalogs/')
     if not catalogbaseurl.endswith('?') and not catalogbaseurl.endswith('/'):
         catalogbaseurl = catalogbaseurl + '/'
+    return catalogbaseurl
+
+
+def download_catalog(catalogname):
+    '''Attempt to download a catalog from the Munki server, Returns the path to
+    the downloaded catalog file'''
+    catalogbaseurl = catalog_base_url()
     display.display_debug2('Catalog base URL is: %s', catalogbaseurl)
     catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'), 'catalogs')
     catalogurl = catalogbaseurl + quote(catalogname.encode('UTF-8'))
     catalogpath = os.path.join(catalog_dir, catalogname)
     display.display_detail('Getting catalog %s...', catalogname)
+    if (prefs.pref('UseCatalogDeltas') and
+            update_catalog_from_delta(catalogbaseurl, catalogname, catalogpath)):
+        return catalogpath
     message = 'Retrieving catalog "%s"...' % catalogname
+    if (prefs.pref('UseCompressedCatalogs') and
+            download_compressed_catalog(
+                catalogurl, catalogpath, message=message)):
+        return catalogpath
     try:
         fetch.munki_resource(catalogurl, catalogpath, message=message)
         return catalogpath
@@ -371,6 +515,67 @@ def download_catalog(catalogname):
         return None
 
 
+def catalog_shards_dir(catalogname):
+    '''Returns the local directory for the shards of catalogname'''
+    return os.path.join(prefs.pref('ManagedInstallDir'), 'catalogs',
+                        catalogshards.SHARDS_DIR, catalogname)
+
+
+def _catalog_shards_url(catalogname):
+    '''Returns the URL of the directory of shards of catalogname'''
+    return (catalog_base_url() + catalogshards.SHARDS_DIR + '/' +
+            quote(catalogname.encode('UTF-8')) + '/')
+
+
+def download_catalog_shard_index(catalogname):
+    '''Attempts to download the shard index makecatalogs --shards publishes
+    for catalogname. Returns the path to the index, or None if there isn't
+    one.'''
+    shards_dir = catalog_shards_dir(catalogname)
+    index_path = os.path.join(shards_dir, catalogshards.INDEX_NAME)
+    message = 'Retrieving shard index for catalog "%s"...' % catalogname
+    try:
+        if not os.path.isdir(shards_dir):
+            os.makedirs(shards_dir)
+        fetch.munki_resource(
+            _catalog_shards_url(catalogname) + catalogshards.INDEX_NAME,
+            index_path, message=message)
+        return index_path
+    except (fetch.Error, OSError) as err:
+        display.display_debug1(
+            'No shard index for catalog %s: %s', catalogname, err)
+        return None
+
+
+def download_catalog_shard(catalogname, shard):
+    '''Makes sure our copy of shard, an entry in the shard index of
+    catalogname, is the one the index describes, downloading it if needed.
+    Returns the path to the shard, or None if it couldn't be retrieved.'''
+    shard_path = os.path.join(catalog_shards_dir(catalogname), shard['file'])
+    if os.path.isfile(shard_path):
+        if munkihash.getsha256hash(shard_path) == shard['hash']:
+            return shard_path
+        # changed on the server; don't let a conditional request keep our
+        # copy
+        os.unlink(shard_path)
+    try:
+        fetch.munki_resource(
+            _catalog_shards_url(catalogname) + quote(shard['file']),
+            shard_path)
+    except fetch.Error as err:
+        display.display_warning(
+            'Could not retrieve shard %s of catalog %s: %s',
+            shard['file'], catalogname, err)
+        return None
+    if munkihash.getsha256hash(shard_path) != shard['hash']:
+        display.display_warning(
+            'Shard %s of catalog %s does not match the shard index.',
+            shard['file'], catalogname)
+        os.unlink(shard_path)
+        return None
+    return shard_path
+
+
 ### precaching support ###
 
 def _installinfo():
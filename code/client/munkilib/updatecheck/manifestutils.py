@@ -25,6 +25,8 @@ from __future__ import absolute_import, print_function
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 try:
     # Python 2
     from urllib2 import quote
@@ -39,11 +41,18 @@ from .. import keychain
 from .. import prefs
 from .. import reports
 from .. import FoundationPlist
-from ..wrappers import unicode_or_str
+from ..wrappers import is_a_string, unicode_or_str
 
 
 PRIMARY_MANIFEST_TAG = '_primary_manifest_'
 
+# how many manifests or catalogs we fetch at once when prefetching
+PREFETCH_WORKERS = 4
+
+# manifest keys that list item names
+ITEM_LIST_KEYS = ('managed_installs', 'managed_uninstalls', 'managed_updates',
+                  'optional_installs', 'featured_items', 'default_installs')
+
 
 class ManifestException(Exception):
     """Lets us raise an exception when we can't get a manifest."""
@@ -75,6 +84,20 @@ def set_manifest(name, path):
     _MANIFESTS[name] = path
 
 
+def manifest_url_and_path(manifest_name):
+    """Returns the URL of manifest_name on the server, and the path of our
+    copy of it"""
+    manifestbaseurl = (prefs.pref('ManifestURL') or
+                       prefs.pref('SoftwareRepoURL') + '/manifests/')
+    if (not manifestbaseurl.endswith('?') and
+            not manifestbaseurl.endswith('/')):
+        manifestbaseurl = manifestbaseurl + '/'
+    manifest_dir = os.path.join(prefs.pref('ManagedInstallDir'),
+                                'manifests')
+    return (manifestbaseurl + quote(manifest_name.encode('UTF-8')),
+            os.path.join(manifest_dir, manifest_name.lstrip('/')))
+
+
 def get_manifest(manifest_name, suppress_errors=False):
     """Gets a manifest from the server.
 
@@ -87,20 +110,9 @@ def get_manifest(manifest_name, suppress_errors=False):
     if manifest_name in _MANIFESTS:
         return _MANIFESTS[manifest_name]
 
-    manifestbaseurl = (prefs.pref('ManifestURL') or
-                       prefs.pref('SoftwareRepoURL') + '/manifests/')
-    if (not manifestbaseurl.endswith('?') and
-            not manifestbaseurl.endswith('/')):
-        manifestbaseurl = manifestbaseurl + '/'
-    manifest_dir = os.path.join(prefs.pref('ManagedInstallDir'),
-                                'manifests')
-
-    manifesturl = (
-        manifestbaseurl + quote(manifest_name.encode('UTF-8')))
-
-    display.display_debug2('Manifest base URL is: %s', manifestbaseurl)
+    (manifesturl, manifestpath) = manifest_url_and_path(manifest_name)
+    display.display_debug2('Manifest URL is: %s', manifesturl)
     display.display_detail('Getting manifest %s...', manifest_name)
-    manifestpath = os.path.join(manifest_dir, manifest_name.lstrip('/'))
 
     # Create the folder the manifest shall be stored in
     destinationdir = os.path.dirname(manifestpath)
@@ -217,6 +229,108 @@ def get_primary_manifest(alternate_id=''):
     return manifest
 
 
+def _download_manifest(manifesturl, manifestpath):
+    """Downloads a manifest for prefetch_manifests. Only downloads, so it can
+    be run on a worker thread. Returns None, or the error if the manifest
+    couldn't be downloaded."""
+    try:
+        destinationdir = os.path.dirname(manifestpath)
+        if not os.path.isdir(destinationdir):
+            os.makedirs(destinationdir)
+        fetch.munki_resource(manifesturl, manifestpath)
+    except (fetch.Error, OSError) as err:
+        return err
+    return None
+
+
+def _read_prefetched_manifest(manifestpath):
+    """Returns the manifest at manifestpath, or None if it can't be read.
+    Errors aren't reported here; analysis will request the manifest again
+    and report them then."""
+    try:
+        return FoundationPlist.readPlist(manifestpath)
+    except FoundationPlist.NSPropertyListSerializationException:
+        return None
+
+
+def prefetch_manifests(manifestpath, max_workers=PREFETCH_WORKERS):
+    """Discovers the included_manifests graph below the manifest at
+    manifestpath breadth-first, downloading all the manifests on each level
+    concurrently. Manifests that are valid are recorded as if fetched by
+    get_manifest, so later calls to it for them don't go to the server.
+    Manifests and catalogs named in conditional_items are left to analysis,
+    which fetches them if their conditions are true.
+
+    Returns a list of the catalogs named by the manifests, in the order they
+    were found."""
+    cataloglist = []
+    seen = set()
+    # (path, catalogs of the including manifest)
+    level = [(manifestpath, None)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            names = []
+            parentcatalogs = []
+            for (path, parent) in level:
+                manifestdata = _read_prefetched_manifest(path) or {}
+                manifestcatalogs = manifestdata.get('catalogs') or parent
+                if not manifestcatalogs:
+                    # analysis stops at a manifest without catalogs
+                    continue
+                for catalog in manifestcatalogs:
+                    if catalog not in cataloglist:
+                        cataloglist.append(catalog)
+                for name in manifestdata.get('included_manifests') or []:
+                    if name and is_a_string(name) and name not in seen:
+                        seen.add(name)
+                        names.append(name)
+                        parentcatalogs.append(manifestcatalogs)
+            to_download = [name for name in names if name not in _MANIFESTS]
+            if to_download:
+                display.display_debug1(
+                    'Prefetching manifests: %s', ', '.join(to_download))
+            locations = dict(
+                (name, manifest_url_and_path(name)) for name in to_download)
+            errors = executor.map(
+                lambda name: _download_manifest(*locations[name]),
+                to_download)
+            for (name, err) in zip(to_download, errors):
+                path = locations[name][1]
+                if err is None and _read_prefetched_manifest(path) is None:
+                    err = 'invalid manifest'
+                if err is None:
+                    _MANIFESTS[name] = path
+                else:
+                    display.display_debug1(
+                        'Could not prefetch manifest %s: %s', name, err)
+            level = [(_MANIFESTS[name], parent)
+                     for (name, parent) in zip(names, parentcatalogs)
+                     if name in _MANIFESTS]
+    return cataloglist
+
+
+def _item_names(manifestdata):
+    """Returns the item names listed in manifestdata, including those in
+    conditional_items, whether or not their conditions are true."""
+    names = []
+    for key in ITEM_LIST_KEYS:
+        names.extend(manifestdata.get(key) or [])
+    for item in manifestdata.get('conditional_items') or []:
+        if hasattr(item, 'get'):
+            names.extend(_item_names(item))
+    return [name for name in names if name and is_a_string(name)]
+
+
+def referenced_item_names(manifestpaths):
+    """Returns the set of item names listed in the manifests at
+    manifestpaths. Names may include a version ('Firefox--120.0')."""
+    names = set()
+    for path in manifestpaths:
+        if os.path.exists(path):
+            names.update(_item_names(get_manifest_data(path)))
+    return names
+
+
 def clean_up_manifests():
     """Removes any manifest files that are no longer in use by this client"""
     manifest_dir = os.path.join(
@@ -30,19 +30,23 @@ from AppKit import NSWorkspace
 # pylint: enable=E0611
 
 # our libs
+from . import catalogs
+
 from .. import app_usage
 from .. import display
 
 
+def running_bundleids():
+    '''Returns the set of bundle ids of currently running applications'''
+    workspace = NSWorkspace.sharedWorkspace()
+    return set(app.bundleIdentifier()
+               for app in workspace.runningApplications())
+
+
 def bundleid_is_running(app_bundleid):
     '''Returns a boolean indicating if the application with the given
     bundleid is currently running.'''
-    workspace = NSWorkspace.sharedWorkspace()
-    running_apps = workspace.runningApplications()
-    for app in running_apps:
-        if app.bundleIdentifier() == app_bundleid:
-            return True
-    return False
+    return app_bundleid in running_bundleids()
 
 
 def bundleids_from_installs_list(pkginfo_pl):
@@ -57,6 +61,66 @@ def bundleids_from_installs_list(pkginfo_pl):
     return bundle_ids
 
 
+def bundleids_to_check(item_pl):
+    '''Returns the application bundle_ids whose use keeps an item with
+    unused_software_removal_info from being removed'''
+    removal_info = item_pl.get('unused_software_removal_info') or {}
+    if 'bundle_ids' in removal_info:
+        return removal_info['bundle_ids']
+    # get application bundle_ids from installs list
+    return bundleids_from_installs_list(item_pl)
+
+
+# usage data for the items we may be asked about this run; filled by
+# get_usage_data() with one database query for every item in the loaded
+# catalogs that has unused_software_removal_info
+_USAGE_DATA = {}
+
+
+def clear_usage_data():
+    '''Forgets usage data looked up by an earlier run'''
+    _USAGE_DATA.clear()
+
+
+def get_usage_data(item_pl):
+    '''Returns usage data covering item_pl, as returned by
+    ApplicationUsageQuery.days_since_last_events, or None if the usage
+    database can't be read. The first call looks up every candidate item in
+    the loaded catalogs at once; later calls only query the database again
+    for items that weren't in those catalogs.'''
+    if not _USAGE_DATA:
+        candidates = [item for catalog in catalogs.catalogs().values()
+                      for item in catalog['unused_software_candidates']]
+    else:
+        candidates = []
+    if (item_pl['name'] not in _USAGE_DATA.get('checked_names', set()) or
+            not set(bundleids_to_check(item_pl)).issubset(
+                _USAGE_DATA.get('checked_bundle_ids', set()))):
+        candidates.append(item_pl)
+    if not candidates:
+        return _USAGE_DATA
+    names = set(item['name'] for item in candidates)
+    bundle_ids = set()
+    for item in candidates:
+        bundle_ids.update(bundleids_to_check(item))
+    display.display_debug2(
+        '\t\tLooking up usage data for %s items', len(candidates))
+    usage_data = app_usage.ApplicationUsageQuery().days_since_last_events(
+        bundle_ids, names)
+    if usage_data is None:
+        return None
+    if not _USAGE_DATA:
+        _USAGE_DATA.update(usage_data)
+        _USAGE_DATA['checked_names'] = set()
+        _USAGE_DATA['checked_bundle_ids'] = set()
+    else:
+        _USAGE_DATA['usage'].update(usage_data['usage'])
+        _USAGE_DATA['install'].update(usage_data['install'])
+    _USAGE_DATA['checked_names'].update(names)
+    _USAGE_DATA['checked_bundle_ids'].update(bundle_ids)
+    return _USAGE_DATA
+
+
 def should_be_removed(item_pl):
     """Determines if an optional install item should be removed due to lack of
     use.
@@ -81,8 +145,10 @@ def should_be_removed(item_pl):
 
     display.display_debug1(
         '\t\tNumber of days until removal is %s', removal_days)
-    usage = app_usage.ApplicationUsageQuery()
-    usage_data_days = usage.days_of_data()
+    usage_data = get_usage_data(item_pl)
+    if usage_data is None:
+        return False
+    usage_data_days = usage_data['days_of_data']
     if usage_data_days is None or usage_data_days < removal_days:
         # we don't have usage data old enough to judge
         display.display_debug1(
@@ -91,21 +157,15 @@ def should_be_removed(item_pl):
         return False
 
     # check to see if we have an install request within the removal_days
-    days_since_install_request = usage.days_since_last_install_event(
-        'install', name)
+    days_since_install_request = usage_data['install'].get(name)
     if (days_since_install_request is not None and
-            days_since_install_request != -1 and
             days_since_install_request <= removal_days):
         display.display_debug1('\t\t%s had an install request %s days ago.',
                                name, days_since_install_request)
         return False
 
     # get list of application bundle_ids to check
-    if 'bundle_ids' in removal_info:
-        bundle_ids = removal_info['bundle_ids']
-    else:
-        # get application bundle_ids from installs list
-        bundle_ids = bundleids_from_installs_list(item_pl)
+    bundle_ids = bundleids_to_check(item_pl)
     if not bundle_ids:
         display.display_debug1('\\tNo application bundle_ids to check.')
         return False
@@ -113,17 +173,17 @@ def should_be_removed(item_pl):
     # now check each bundleid to see if it's currently running or has been
     # activated in the past removal_days days
     display.display_debug1('\t\tChecking bundle_ids: %s', bundle_ids)
+    running = running_bundleids()
     for bundle_id in bundle_ids:
-        if bundleid_is_running(bundle_id):
+        if bundle_id in running:
             display.display_debug1(
                 '\t\tApplication %s is currently running.' % bundle_id)
             return False
-        days_since_last_activation = usage.days_since_last_usage_event(
-            'activate', bundle_id)
-        if days_since_last_activation == -1:
+        days_since_last_activation = usage_data['usage'].get(bundle_id)
+        if days_since_last_activation is None:
             display.display_debug1(
                 '\t\t%s has not been activated in more than %s days...',
-                bundle_id, usage.days_of_data())
+                bundle_id, usage_data_days)
         elif days_since_last_activation <= removal_days:
             display.display_debug1('\t\t%s was last activated %s days ago',
                                    bundle_id, days_since_last_activation)
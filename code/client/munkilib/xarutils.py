@@ -0,0 +1,219 @@
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+xarutils.py
+
+Reads xar archives, like flat packages, without running /usr/bin/xar.
+
+A xar archive is a fixed header, a zlib-compressed XML table of contents
+(TOC) and a heap. The TOC describes every file in the archive, and for
+each one the offset of its data in the heap, how it's encoded and its
+checksums. So we can list an archive by reading its TOC, and read one
+member by seeking straight to its data.
+"""
+from __future__ import absolute_import, print_function
+
+import bz2
+import hashlib
+import struct
+import zlib
+from xml.etree import ElementTree
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+
+XAR_MAGIC = b'xar!'
+
+# magic, header size, version, compressed and uncompressed TOC lengths,
+# TOC checksum algorithm
+_HEADER = struct.Struct('>4sHHQQI')
+
+# what decompressors raise for bad data
+_DECODE_ERRORS = (zlib.error, IOError, OSError, EOFError, ValueError)
+if lzma:
+    _DECODE_ERRORS += (lzma.LZMAError, )
+
+# how much compressed data we read and decompress at a time
+CHUNK_SIZE = 256 * 1024
+
+
+class XarError(Exception):
+    '''Error to raise when a xar archive or one of its members can't be
+    read'''
+    pass
+
+
+def _decompressor(encoding):
+    '''Returns an object with decompress() and flush() methods for a xar
+    encoding style'''
+    if encoding in (None, 'application/octet-stream'):
+        return None
+    if encoding == 'application/x-gzip':
+        # xar calls it gzip, but it's a zlib stream
+        return zlib.decompressobj()
+    if encoding == 'application/x-bzip2':
+        return bz2.BZ2Decompressor()
+    if encoding in ('application/x-lzma', 'application/x-xz') and lzma:
+        return lzma.LZMADecompressor()
+    raise XarError('Unsupported encoding %s' % encoding)
+
+
+class XarMember(object):
+    '''Where to find an archived file in the heap, and how to decode it'''
+
+    def __init__(self, name, data_element):
+        self.name = name
+        try:
+            self.offset = int(data_element.findtext('offset'))
+            self.length = int(data_element.findtext('length'))
+            self.size = int(data_element.findtext('size'))
+        except (TypeError, ValueError):
+            raise XarError('Invalid data description for %s' % name)
+        encoding = data_element.find('encoding')
+        self.encoding = None
+        if encoding is not None:
+            self.encoding = encoding.get('style')
+        self.checksum = None
+        self.checksum_style = None
+        checksum = data_element.find('extracted-checksum')
+        if checksum is not None and checksum.text:
+            self.checksum = checksum.text.strip().lower()
+            self.checksum_style = (checksum.get('style') or '').lower()
+
+
+class XarArchive(object):
+    '''A xar archive opened for reading. The TOC is read once, when the
+    archive is opened.'''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.fileref = open(path, 'rb')
+        except (OSError, IOError) as err:
+            raise XarError('Could not open %s: %s' % (path, err))
+        try:
+            self._read_toc()
+        except Exception:
+            self.fileref.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Closes the archive'''
+        self.fileref.close()
+
+    def _read_toc(self):
+        '''Reads and parses the table of contents'''
+        header = self.fileref.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise XarError('%s is not a xar archive' % self.path)
+        (magic, header_size, dummy_version, toc_length, toc_size,
+         dummy_checksum_alg) = _HEADER.unpack(header)
+        if magic != XAR_MAGIC:
+            raise XarError('%s is not a xar archive' % self.path)
+        self.fileref.seek(header_size)
+        compressed_toc = self.fileref.read(toc_length)
+        if len(compressed_toc) < toc_length:
+            raise XarError('%s is truncated' % self.path)
+        try:
+            toc = zlib.decompress(compressed_toc)
+        except zlib.error as err:
+            raise XarError('Could not decompress TOC of %s: %s'
+                           % (self.path, err))
+        if len(toc) != toc_size:
+            raise XarError('TOC of %s has the wrong size' % self.path)
+        try:
+            root = ElementTree.fromstring(toc)
+        except ElementTree.ParseError as err:
+            raise XarError('Could not parse TOC of %s: %s' % (self.path, err))
+        toc_element = root.find('toc')
+        if toc_element is None:
+            raise XarError('%s has no TOC' % self.path)
+        self.heap_offset = header_size + toc_length
+        # member names in TOC order, as xar -t lists them
+        self._names = []
+        self._members = {}
+        self._add_files(toc_element, '')
+
+    def _add_files(self, element, prefix):
+        '''Records the file elements that are children of element, and
+        their children'''
+        for file_element in element.findall('file'):
+            name = prefix + (file_element.findtext('name') or '')
+            self._names.append(name)
+            data_element = file_element.find('data')
+            if (data_element is not None and
+                    file_element.findtext('type', 'file') == 'file'):
+                self._members[name] = XarMember(name, data_element)
+            self._add_files(file_element, name + '/')
+
+    def names(self):
+        '''Returns the paths of everything in the archive, like xar -t'''
+        return list(self._names)
+
+    def read(self, name):
+        '''Returns the contents of the file at path name in the archive.
+        Raises XarError if there's no such file or it can't be decoded.'''
+        member = self._members.get(name)
+        if member is None:
+            raise XarError('%s has no file %s' % (self.path, name))
+        decompressor = _decompressor(member.encoding)
+        self.fileref.seek(self.heap_offset + member.offset)
+        remaining = member.length
+        chunks = []
+        try:
+            while remaining > 0:
+                chunk = self.fileref.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise XarError('%s is truncated' % self.path)
+                remaining -= len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                chunks.append(chunk)
+            if decompressor and hasattr(decompressor, 'flush'):
+                chunks.append(decompressor.flush())
+        except _DECODE_ERRORS as err:
+            raise XarError('Could not decode %s in %s: %s'
+                           % (name, self.path, err))
+        data = b''.join(chunks)
+        if len(data) != member.size:
+            raise XarError('%s in %s has the wrong size' % (name, self.path))
+        if member.checksum and member.checksum_style in ('sha1', 'md5',
+                                                         'sha256', 'sha512'):
+            digest = hashlib.new(member.checksum_style, data).hexdigest()
+            if digest != member.checksum:
+                raise XarError('Checksum mismatch for %s in %s'
+                               % (name, self.path))
+        return data
+
+
+def list_archive(path):
+    '''Returns the paths of everything in the xar archive at path'''
+    with XarArchive(path) as archive:
+        return archive.names()
+
+
+if __name__ == '__main__':
+    print('This is a library of support tools for the Munki Suite.')
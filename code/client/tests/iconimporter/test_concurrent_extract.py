@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_concurrent_extract.py
+
+Runs iconimporter's real PkgExtractor on several bundle packages at once,
+to check that concurrent extractions each find their own icons.
+
+Where there's no /bin/pax, a stand-in extracts the payload instead; like
+pax, it unpacks into its working directory, so extractions that depended on
+the process's working directory would collide.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import io
+import os
+import plistlib
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import unittest
+
+from importlib.machinery import SourceFileLoader
+
+from munkilib import iconutils
+from munkilib.admin import iconpipeline
+
+from ..munkilib.bomutils import make_fixtures
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+ICONIMPORTER = SourceFileLoader(
+    'iconimporter',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 os.pardir, os.pardir, 'iconimporter')).load_module()
+
+REAL_CALL = subprocess.call
+
+
+def fake_call(cmd, **kwargs):
+    """Runs /bin/pax -rzf on a tar payload in Python, extracting into
+    kwargs['cwd'] or else the working directory, as pax would"""
+    if cmd[0] != '/bin/pax':
+        return 1
+    # let other extractions get going first
+    time.sleep(0.05)
+    target_dir = kwargs.get('cwd') or os.getcwd()
+    with tarfile.open(cmd[2], 'r:gz') as archive:
+        archive.extractall(target_dir)
+    return 0
+
+
+def write_bundle_pkg(pkg_path, app_name):
+    """Writes a bundle pkg at pkg_path that installs app_name.app, whose
+    icon holds app_name"""
+    app_dir = './Applications/%s.app' % app_name
+    contents = os.path.join(pkg_path, 'Contents')
+    os.makedirs(contents)
+    files = {
+        app_dir + '/Contents/Info.plist': plistlib.dumps(
+            {'CFBundleIconFile': 'AppIcon'}),
+        app_dir + '/Contents/Resources/AppIcon.icns':
+            app_name.encode('UTF-8'),
+    }
+    items = [make_fixtures.directory('.'),
+             make_fixtures.directory('./Applications'),
+             make_fixtures.directory(app_dir),
+             make_fixtures.directory(app_dir + '/Contents'),
+             make_fixtures.regular_file(
+                 app_dir + '/Contents/Info.plist',
+                 len(files[app_dir + '/Contents/Info.plist'])),
+             make_fixtures.directory(app_dir + '/Contents/Resources'),
+             make_fixtures.regular_file(
+                 app_dir + '/Contents/Resources/AppIcon.icns',
+                 len(app_name))]
+    with open(os.path.join(contents, 'Archive.bom'), 'wb') as fileref:
+        fileref.write(make_fixtures.make_bom(items))
+    with tarfile.open(os.path.join(contents, 'Archive.pax.gz'),
+                      'w:gz', format=tarfile.USTAR_FORMAT) as archive:
+        for (path, data) in sorted(files.items()):
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+class FakeRepo(object):
+    """A repo whose pkgs are bundle pkgs in a directory, and whose icons
+    are kept in memory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.icons = {}
+
+    def get_to_local_file(self, resource_identifier, local_file_path):
+        shutil.copytree(os.path.join(self.root, resource_identifier),
+                        local_file_path)
+
+    def put_from_local_file(self, resource_identifier, local_file_path):
+        with open(local_file_path, 'rb') as fileref:
+            self.icons[resource_identifier] = fileref.read()
+
+
+class TestConcurrentExtract(unittest.TestCase):
+    """Concurrent PkgExtractor runs don't share a working directory"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = FakeRepo(self.tempdir)
+        self.names = ['App%s' % index for index in range(6)]
+        for name in self.names:
+            pkg_path = os.path.join(self.tempdir, 'pkgs', name + '.pkg')
+            if name == 'App0':
+                # a distribution bundle, with the app in a component pkg
+                write_bundle_pkg(os.path.join(
+                    pkg_path, 'Contents', 'Packages', name + 'Core.pkg'),
+                                 name)
+            else:
+                write_bundle_pkg(pkg_path, name)
+        self.original_dir = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        shutil.rmtree(self.tempdir)
+
+    def run_pipeline(self):
+        """Extracts icons for every pkg, two at a time"""
+        items = [{'name': name, 'version': '1.0',
+                  'installer_item_location': name + '.pkg'}
+                 for name in self.names]
+        pipeline = iconpipeline.IconPipeline(
+            self.repo, {'': ICONIMPORTER.PkgExtractor()},
+            lambda src, dst: bool(shutil.copyfile(src, dst)),
+            extract_jobs=2)
+        return pipeline.run(items, report=lambda job: None)
+
+    def test_each_item_gets_its_own_icon(self):
+        """Every item's icon comes from its own pkg"""
+        if os.path.exists('/bin/pax'):
+            jobs = self.run_pipeline()
+        else:
+            with patch.object(iconutils.subprocess, 'call', fake_call):
+                jobs = self.run_pipeline()
+        for job in jobs:
+            self.assertEqual(job.uploaded, ['icons/%s.png' % job.name],
+                             job.messages)
+        self.assertEqual(
+            self.repo.icons,
+            dict(('icons/%s.png' % name, name.encode('UTF-8'))
+                 for name in self.names))
+        # and nobody left us somewhere else
+        self.assertEqual(os.getcwd(), self.original_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
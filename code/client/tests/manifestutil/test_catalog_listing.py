@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalog_listing.py
+
+Unit tests for the catalogs manifestutil lists, validates against and
+completes: only the catalogs themselves, not what makecatalogs publishes
+beside them.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from importlib.machinery import SourceFileLoader
+
+from munkilib import munkirepo
+from munkilib.wrappers import writePlistToString
+
+
+MANIFESTUTIL = SourceFileLoader(
+    'manifestutil',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 os.pardir, os.pardir, 'manifestutil')).load_module()
+
+
+class TestCatalogListing(unittest.TestCase):
+    """Tests for get_catalogs and get_installer_item_names"""
+
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        self.repo = munkirepo.connect('file://' + self.repo_root, 'FileRepo')
+        catalog = writePlistToString([{'name': 'Firefox', 'version': '1.0'}])
+        for name in ('all', 'testing'):
+            self.write_catalog(name, catalog)
+            self.write_catalog(name + '.gz', gzip.compress(catalog))
+            self.write_catalog(name + '.sha256', b'0' * 64)
+        self.write_catalog('_settings.plist', writePlistToString({}))
+        self.write_catalog('_deltas/testing/index.plist',
+                           writePlistToString({}))
+        self.write_catalog('_deltas/testing/1-2.plist', catalog)
+        self.write_catalog('_shards/testing/index.plist',
+                           writePlistToString({}))
+        self.write_catalog('_shards/testing/Firefox.plist', catalog)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_root)
+
+    def write_catalog(self, name, data):
+        """Writes data to catalogs/name in the repo"""
+        path = os.path.join(self.repo_root, 'catalogs', name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fileref:
+            fileref.write(data)
+
+    def test_get_catalogs(self):
+        """Only catalogs are listed"""
+        self.assertEqual(MANIFESTUTIL.get_catalogs(self.repo),
+                         ['all', 'testing'])
+
+    def test_get_installer_item_names(self):
+        """Compressed catalogs aren't read as catalogs"""
+        self.assertEqual(
+            MANIFESTUTIL.get_installer_item_names(
+                self.repo, ['testing', 'testing.gz', 'testing.sha256',
+                            '_deltas/testing/1-2.plist',
+                            '_shards/testing/Firefox.plist']),
+            ['Firefox'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_batch_import.py
+
+Unit tests for munkiimport --batch: finding installer items, naming them in
+the repo, skipping duplicates, and counting failures.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from importlib.machinery import SourceFileLoader
+
+from munkilib import munkirepo
+from munkilib.admin import catalogdb
+from munkilib.admin import munkiimportlib
+from munkilib.admin.common import AttributeDict
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+MUNKIIMPORT = SourceFileLoader(
+    'munkiimport',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 os.pardir, os.pardir, 'munkiimport')).load_module()
+
+
+def fake_makepkginfo(installer_item, dummy_options):
+    """Returns a pkginfo for installer_item, named for the file without
+    any version, with the hash of its contents"""
+    with open(installer_item, 'rb') as fileref:
+        item_hash = hashlib.sha256(fileref.read()).hexdigest()
+    name = os.path.splitext(os.path.basename(installer_item))[0]
+    return {'name': name.split('-')[0],
+            'version': '1.0',
+            'catalogs': ['testing'],
+            'installer_item_hash': item_hash}
+
+
+def fake_copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
+    """Records pkginfo in the repo under a unique name"""
+    pkginfo_path = os.path.join(
+        'pkgsinfo', subdirectory, os.path.basename(
+            pkginfo['installer_item_location']) + '.plist')
+    repo.put(pkginfo_path, pkginfo['installer_item_hash'].encode('UTF-8'))
+    return pkginfo_path
+
+
+class TestBatchImport(unittest.TestCase):
+    """Tests for munkiimport's batch mode"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.tempdir, 'repo')
+        for kind in ('catalogs', 'pkgs', 'pkgsinfo'):
+            os.makedirs(os.path.join(self.repo_root, kind))
+        self.repo = munkirepo.connect('file://' + self.repo_root, 'FileRepo')
+        self.source = os.path.join(self.tempdir, 'source')
+        os.mkdir(self.source)
+        self.options = AttributeDict({'subdirectory': '', 'jobs': 4})
+        for (module, name, replacement) in (
+                (MUNKIIMPORT.pkginfolib, 'makepkginfo', fake_makepkginfo),
+                (munkiimportlib, 'copy_pkginfo_to_repo',
+                 fake_copy_pkginfo_to_repo),
+                (munkiimportlib, 'add_icon_hash_to_pkginfo',
+                 lambda pkginfo: None),
+                (munkiimportlib, 'make_catalog_db',
+                 lambda repo: catalogdb.catalog_db_from_items([])),
+                (MUNKIIMPORT.dmgutils, 'pathIsVolumeMountPoint',
+                 lambda path: False),
+                (MUNKIIMPORT, 'make_catalogs', lambda repo, options: None)):
+            patcher = patch.object(module, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_item(self, name, contents, directory=None):
+        """Makes an installer item in the source directory"""
+        path = os.path.join(directory or self.source, name)
+        with open(path, 'w') as fileref:
+            fileref.write(contents)
+        return path
+
+    def repo_pkgs(self):
+        """Returns the names of the installer items in the repo"""
+        return sorted(os.listdir(os.path.join(self.repo_root, 'pkgs')))
+
+    def test_batch_items(self):
+        """Directories are expanded to the installer items in them"""
+        self.make_item('Foo.dmg', 'foo')
+        self.make_item('Bar.pkg', 'bar')
+        self.make_item('ReadMe.txt', 'not an installer item')
+        other = self.make_item('Other.dmg', 'other', directory=self.tempdir)
+        self.assertEqual(
+            MUNKIIMPORT.batch_items([self.source + '/', other]),
+            [os.path.join(self.source, 'Bar.pkg'),
+             os.path.join(self.source, 'Foo.dmg'), other])
+
+    def test_names_are_unique(self):
+        """Items that would get the same repo name each get their own"""
+        self.make_item('Foo.dmg', 'first')
+        self.make_item('Foo-1.0.dmg', 'second')
+        failures = MUNKIIMPORT.batch_import(
+            self.repo, [self.source], self.options)
+        self.assertEqual(failures, 0)
+        self.assertEqual(len(self.repo_pkgs()), 2)
+        contents = set()
+        for name in self.repo_pkgs():
+            with open(os.path.join(self.repo_root, 'pkgs', name)) as fileref:
+                contents.add(fileref.read())
+        self.assertEqual(contents, set(['first', 'second']))
+
+    def test_duplicates_are_skipped(self):
+        """An item identical to one earlier in the batch is skipped"""
+        self.make_item('Foo.dmg', 'same')
+        self.make_item('Bar.dmg', 'same')
+        self.make_item('Baz.dmg', 'different')
+        failures = MUNKIIMPORT.batch_import(
+            self.repo, [self.source], self.options)
+        self.assertEqual(failures, 0)
+        self.assertEqual(len(self.repo_pkgs()), 2)
+
+    def test_duplicate_of_failed_copy_is_imported(self):
+        """An item identical to one that failed to copy is still imported"""
+        self.make_item('Foo.dmg', 'same')
+        self.make_item('Bar.dmg', 'same')
+        copy_item_to_repo = munkiimportlib.copy_item_to_repo
+        calls = []
+
+        def fail_once(*args, **kwargs):
+            """Fails the first copy only"""
+            calls.append(args)
+            if len(calls) == 1:
+                raise munkiimportlib.RepoCopyError('disk full')
+            return copy_item_to_repo(*args, **kwargs)
+
+        with patch.object(munkiimportlib, 'copy_item_to_repo', fail_once):
+            failures = MUNKIIMPORT.batch_import(
+                self.repo, [self.source], self.options)
+        self.assertEqual(failures, 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.repo_pkgs()), 1)
+
+    def test_failures_are_counted(self):
+        """batch_import returns the number of items that failed"""
+        self.make_item('Foo.dmg', 'foo')
+        missing = os.path.join(self.tempdir, 'Missing.dmg')
+        unknown = self.make_item('ReadMe.txt', 'text', directory=self.tempdir)
+        failures = MUNKIIMPORT.batch_import(
+            self.repo, [self.source, missing, unknown], self.options)
+        self.assertEqual(failures, 2)
+        self.assertEqual(self.repo_pkgs(), ['Foo-1.0.dmg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
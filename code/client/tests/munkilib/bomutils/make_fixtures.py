@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+make_fixtures.py
+
+Writes the BOM files in fixtures/ along with the listing expected for each
+of them (fixtures/<name>.lsbom). Run it from this directory to regenerate
+them.
+
+The BOMs are built here, independently of munkilib.bomutils, following the
+BOMStore layout mkbom uses. The .lsbom files are NOT captured from
+/usr/bin/lsbom: they are made from the item lists below by lsbom_line(),
+in lsbom's default output format. Comparison with the real lsbom is left
+to the test that runs it against installed receipts on macOS.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, print_function
+
+import os
+import posixpath
+import struct
+import zlib
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+TYPE_FILE = 1
+TYPE_DIR = 2
+TYPE_LINK = 3
+
+
+def directory(path, mode=0o40755, uid=0, gid=0):
+    '''Returns an item for a directory'''
+    return (path, TYPE_DIR, mode, uid, gid, 0, 0, '')
+
+
+def regular_file(path, size, mode=0o100644, uid=0, gid=0):
+    '''Returns an item for a file, with a made up checksum'''
+    return (path, TYPE_FILE, mode, uid, gid, size,
+            zlib.crc32(path.encode('UTF-8')) & 0xffffffff, '')
+
+
+def symlink(path, target, mode=0o120755, uid=0, gid=0):
+    '''Returns an item for a symbolic link'''
+    return (path, TYPE_LINK, mode, uid, gid, len(target),
+            zlib.crc32(target.encode('UTF-8')) & 0xffffffff, target)
+
+
+def lsbom_line(item):
+    '''Formats an item in lsbom's default output format'''
+    (path, item_type, mode, uid, gid, size, checksum, linkname) = item
+    fields = [path, '%o' % mode, '%s/%s' % (uid, gid)]
+    if item_type == TYPE_FILE:
+        fields.extend([str(size), str(checksum)])
+    elif item_type == TYPE_LINK:
+        fields.extend([str(size), str(checksum), linkname])
+    return '\t'.join(fields)
+
+
+def make_bom(items, leaf_size=32, order=None):
+    '''Returns the bytes of a BOM file listing items. Leaves of the Paths
+    tree hold leaf_size entries each. order, if given, is the order of
+    item indexes in the leaves; by default, the order of items.'''
+    blocks = [None]
+
+    def add_block(data):
+        blocks.append(data)
+        return len(blocks) - 1
+
+    ids = {}
+    entries = []
+    for (item_id, item) in enumerate(items, 1):
+        (path, item_type, mode, uid, gid, size, checksum, linkname) = item
+        ids[path] = item_id
+        if path == '.':
+            parent = 0
+            name = '.'
+        else:
+            parent = ids[posixpath.dirname(path)]
+            name = posixpath.basename(path)
+        link = linkname.encode('UTF-8') + b'\0' if linkname else b''
+        info2 = add_block(
+            struct.pack('>BBHHIIIIBII', item_type, 1, 3, mode, uid, gid,
+                        0x5f000000, size, 1, checksum, len(link)) + link)
+        info1 = add_block(struct.pack('>II', item_id, info2))
+        file_block = add_block(
+            struct.pack('>I', parent) + name.encode('UTF-8') + b'\0')
+        entries.append((info1, file_block))
+    if order is not None:
+        entries = [entries[index] for index in order]
+
+    chunks = [entries[start:start + leaf_size]
+              for start in range(0, len(entries), leaf_size)]
+    leaf_indexes = [add_block(b'') for dummy_chunk in chunks]
+    for (number, chunk) in enumerate(chunks):
+        forward = leaf_indexes[number + 1] if number + 1 < len(chunks) else 0
+        backward = leaf_indexes[number - 1] if number else 0
+        blocks[leaf_indexes[number]] = (
+            struct.pack('>HHII', 1, len(chunk), forward, backward) +
+            b''.join(struct.pack('>II', *entry) for entry in chunk))
+    if len(chunks) > 1:
+        root = add_block(
+            struct.pack('>HHII', 0, len(chunks), 0, 0) +
+            b''.join(struct.pack('>II', leaf, chunk[0][1])
+                     for (leaf, chunk) in zip(leaf_indexes, chunks)))
+    else:
+        root = leaf_indexes[0]
+    paths_tree = add_block(
+        struct.pack('>4sIIIIB', b'tree', 1, root, 4096, len(items), 0))
+    bom_info = add_block(struct.pack('>III', 1, len(items), 0))
+
+    header_size = 512
+    data = b''
+    pointers = [(0, 0)]
+    for block in blocks[1:]:
+        pointers.append((header_size + len(data), len(block)))
+        data += block
+    index = struct.pack('>I', len(pointers)) + b''.join(
+        struct.pack('>II', *pointer) for pointer in pointers)
+    variables = [('BomInfo', bom_info), ('Paths', paths_tree)]
+    var_data = struct.pack('>I', len(variables)) + b''.join(
+        struct.pack('>IB', block, len(name)) + name.encode('UTF-8')
+        for (name, block) in variables)
+    index_offset = header_size + len(data)
+    vars_offset = index_offset + len(index)
+    header = struct.pack('>8sIIIIII', b'BOMStore', 1, len(blocks) - 1,
+                         index_offset, len(index), vars_offset, len(var_data))
+    return (header.ljust(header_size, b'\0') + data + index + var_data)
+
+
+FIXTURES = {
+    'flat_receipt': [
+        directory('.'),
+        directory('./usr'),
+        directory('./usr/local'),
+        directory('./usr/local/bin'),
+        regular_file('./usr/local/bin/munkitool', 20480, mode=0o100755),
+        symlink('./usr/local/bin/mt', 'munkitool'),
+    ],
+    'app_bundle': (
+        [directory('.', mode=0o41775, gid=80),
+         directory('./Applications', mode=0o41775, gid=80),
+         directory('./Applications/Example App.app'),
+         directory('./Applications/Example App.app/Contents'),
+         regular_file('./Applications/Example App.app/Contents/Info.plist',
+                      1734),
+         regular_file('./Applications/Example App.app/Contents/PkgInfo', 8),
+         directory('./Applications/Example App.app/Contents/MacOS'),
+         regular_file(
+             './Applications/Example App.app/Contents/MacOS/Example App',
+             104816, mode=0o100755),
+         directory('./Applications/Example App.app/Contents/Resources'),
+         directory('./Library', uid=501, gid=20),
+         regular_file('./Library/café.txt', 12, uid=501, gid=20)] +
+        [regular_file('./Applications/Example App.app/Contents/Resources/'
+                      'image%03d.png' % index, 1000 + index)
+         for index in range(100)]),
+}
+
+
+def main():
+    '''Writes the fixtures'''
+    if not os.path.isdir(FIXTURES_DIR):
+        os.makedirs(FIXTURES_DIR)
+    for (name, items) in sorted(FIXTURES.items()):
+        with open(os.path.join(FIXTURES_DIR, name + '.bom'), 'wb') as fileref:
+            fileref.write(make_bom(items))
+        with open(os.path.join(FIXTURES_DIR, name + '.lsbom'), 'wb') as fileref:
+            fileref.write(''.join(
+                lsbom_line(item) + '\n' for item in items).encode('UTF-8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_bomutils.py
+
+Unit tests for the pure-Python BOM reader in bomutils, checked against the
+listings make_fixtures.py writes for the BOMs in fixtures/ (made from its
+item lists, not captured from lsbom) and, on macOS, against /usr/bin/lsbom
+itself.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import bomutils
+
+from . import make_fixtures
+
+
+RECEIPTS_DIR = '/private/var/db/receipts'
+
+
+class TestBomReader(unittest.TestCase):
+    """Tests for bomutils.bom_items and friends"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_bom(self, data):
+        """Writes data to a BOM file and returns its path"""
+        path = os.path.join(self.tempdir, 'test.bom')
+        with open(path, 'wb') as fileref:
+            fileref.write(data)
+        return path
+
+    def test_fixtures_match_expected_listings(self):
+        """Every fixture lists the items it was built from"""
+        for name in sorted(make_fixtures.FIXTURES):
+            bompath = os.path.join(make_fixtures.FIXTURES_DIR, name + '.bom')
+            with open(os.path.join(make_fixtures.FIXTURES_DIR,
+                                   name + '.lsbom'), 'rb') as fileref:
+                expected = fileref.read().decode('UTF-8').splitlines()
+            lines = [bomutils.lsbom_line(item)
+                     for item in bomutils.bom_items(bompath)]
+            self.assertEqual(lines, expected, name)
+
+    def test_entries_and_paths(self):
+        """bom_entries and bom_paths agree with the fixture items"""
+        bompath = os.path.join(
+            make_fixtures.FIXTURES_DIR, 'flat_receipt.bom')
+        items = make_fixtures.FIXTURES['flat_receipt']
+        self.assertEqual(list(bomutils.bom_entries(bompath)),
+                         [item[0:1] + item[2:5] for item in items])
+        self.assertEqual(bomutils.bom_paths(bompath),
+                         [item[0] for item in items])
+
+    def test_children_listed_before_parents(self):
+        """Items are still resolved if a child precedes its parent"""
+        items = make_fixtures.FIXTURES['flat_receipt']
+        order = [0, 4, 5, 3, 2, 1]
+        bompath = self.write_bom(
+            make_fixtures.make_bom(items, leaf_size=2, order=order))
+        self.assertEqual(sorted(bomutils.bom_paths(bompath)),
+                         sorted(item[0] for item in items))
+
+    def test_not_a_bom(self):
+        """Files that aren't BOMs raise BomError"""
+        for data in (b'', b'not a bom file at all, really not',
+                     make_fixtures.make_bom(
+                         make_fixtures.FIXTURES['flat_receipt'])[:600]):
+            bompath = self.write_bom(data)
+            with self.assertRaises(bomutils.BomError):
+                list(bomutils.bom_items(bompath))
+
+    def test_missing_file(self):
+        """A missing file raises BomError"""
+        with self.assertRaises(bomutils.BomError):
+            list(bomutils.bom_items(os.path.join(self.tempdir, 'nope.bom')))
+
+    @unittest.skipUnless(os.path.exists('/usr/bin/lsbom') and
+                         os.path.isdir(RECEIPTS_DIR),
+                         'needs macOS lsbom and package receipts')
+    def test_matches_lsbom_on_installed_receipts(self):
+        """The reader and lsbom agree on this Mac's receipt BOMs"""
+        bompaths = sorted(glob.glob(os.path.join(RECEIPTS_DIR, '*.bom')))
+        for bompath in bompaths[:25]:
+            self.assertEqual(list(bomutils.bom_entries(bompath)),
+                             bomutils.lsbom(bompath), bompath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalogdb.py
+
+Unit tests for the cached catalog db munkiimport uses to find matching
+items.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import munkirepo
+from munkilib.admin import catalogdb
+from munkilib.wrappers import writePlistToString
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+def make_item(name, version, pkgid=None):
+    """Returns a fake catalog item"""
+    item = {'name': name,
+            'version': version,
+            'catalogs': ['testing'],
+            'installer_item_hash': '%s-%s-hash' % (name, version),
+            'installer_item_location': 'apps/%s-%s.dmg' % (name, version),
+            'installs': [{'path': '/Applications/%s.app' % name,
+                          'type': 'application'}]}
+    if pkgid:
+        item['receipts'] = [{'packageid': pkgid, 'version': version}]
+    return item
+
+
+class FakeRepo(object):
+    """Just enough of a repo for the catalog db"""
+
+    def __init__(self, items):
+        self.baseurl = 'file:///Users/Shared/munki_repo'
+        self.items = {}
+        self.set_catalog(items)
+
+    def set_catalog(self, items):
+        """Replaces catalogs/all"""
+        self.items['catalogs/all'] = writePlistToString(items)
+
+    def get(self, resource_identifier):
+        """Returns the contents of a repo item"""
+        try:
+            return self.items[resource_identifier]
+        except KeyError:
+            raise munkirepo.RepoError('No such item')
+
+
+class TestCatalogDB(unittest.TestCase):
+    """Tests for catalogdb.open_catalog_db"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.patcher = patch('munkilib.admin.catalogdb.CACHE_DIR',
+                             self.tempdir)
+        self.patcher.start()
+        self.items = [make_item('Firefox', '119.0', 'org.mozilla.firefox'),
+                      make_item('Firefox', '120.0', 'org.mozilla.firefox'),
+                      make_item('Editor', '5.0')]
+        self.repo = FakeRepo(self.items)
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tempdir)
+
+    def lookup(self, table, key):
+        """Returns the items the cached db has for table and key, by
+        version, in the shape make_catalog_db would"""
+        catdb = catalogdb.open_catalog_db(self.repo)
+        try:
+            keys = catdb[table].get(key)
+            if keys is None:
+                return None
+            if table == 'hashes':
+                return [catdb['items'][item_key] for item_key in keys]
+            return dict((vers, [catdb['items'][item_key]
+                                for item_key in item_keys])
+                        for (vers, item_keys) in keys.items())
+        finally:
+            catdb.close()
+
+    def test_matches_in_memory_db(self):
+        """The cached db finds the same items as make_catalog_db"""
+        memdb = catalogdb.make_catalog_db(self.repo)
+        for (table, key) in (('hashes', 'Firefox-120.0-hash'),
+                             ('receipts', 'org.mozilla.firefox'),
+                             ('applications', '/Applications/Editor.app'),
+                             ('installer_items', 'Firefox.dmg'),
+                             ('receipts', 'com.example.nothing')):
+            expected = memdb[table].get(key)
+            if expected is not None:
+                if table == 'hashes':
+                    expected = [memdb['items'][index] for index in expected]
+                else:
+                    expected = dict(
+                        (vers, [memdb['items'][index] for index in indexes])
+                        for (vers, indexes) in expected.items())
+            self.assertEqual(self.lookup(table, key), expected)
+
+    def test_reused_until_catalog_changes(self):
+        """catalogs/all is only decoded again when it changes"""
+        with patch('munkilib.admin.catalogdb.decode_catalog',
+                   wraps=catalogdb.decode_catalog) as decode_mock:
+            self.lookup('receipts', 'org.mozilla.firefox')
+            self.lookup('receipts', 'org.mozilla.firefox')
+            self.assertEqual(decode_mock.call_count, 1)
+            self.repo.set_catalog(self.items[1:])
+            self.lookup('receipts', 'org.mozilla.firefox')
+            self.assertEqual(decode_mock.call_count, 2)
+
+    def test_updated_in_place(self):
+        """Unchanged items are kept, removed ones dropped, new ones added"""
+        catdb = catalogdb.open_catalog_db(self.repo)
+        editor_key = catdb['hashes'].get('Editor-5.0-hash')
+        catdb.close()
+        self.repo.set_catalog(
+            self.items[1:] + [make_item('Editor', '6.0')])
+        catdb = catalogdb.open_catalog_db(self.repo)
+        try:
+            self.assertEqual(catdb['hashes'].get('Editor-5.0-hash'),
+                             editor_key)
+            self.assertIsNone(catdb['hashes'].get('Firefox-119.0-hash'))
+            self.assertEqual(
+                sorted(catdb['applications'].get('/Applications/Editor.app')),
+                ['5.0', '6.0'])
+        finally:
+            catdb.close()
+
+    def test_imported_items_are_found(self):
+        """Items added after an import are found before makecatalogs"""
+        catalogdb.open_catalog_db(self.repo).close()
+        catalogdb.add_imported_item(self.repo, make_item('Tool', '1.0'))
+        self.assertEqual(self.lookup('hashes', 'Tool-1.0-hash'),
+                         [make_item('Tool', '1.0')])
+
+    def test_missing_catalog(self):
+        """A repo without catalogs/all raises CatalogReadException"""
+        del self.repo.items['catalogs/all']
+        with self.assertRaises(catalogdb.CatalogReadException):
+            catalogdb.open_catalog_db(self.repo)
+
+
+    def test_no_cache_without_url(self):
+        """A repo without a URL gets no cached db"""
+        del self.repo.baseurl
+        self.assertIsNone(catalogdb.open_catalog_db(self.repo))
+        catalogdb.add_imported_item(self.repo, make_item('Tool', '1.0'))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalogdeltas.py
+
+Unit tests for catalogdeltas.make_delta and catalogdeltas.apply_delta.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import unittest
+
+from munkilib import catalogdeltas
+from munkilib.wrappers import readPlistFromString, writePlistToString
+
+
+def make_items(count):
+    """Returns a list of fake catalog items"""
+    return [{'name': 'Item%s' % index,
+             'version': '1.0.%s' % index,
+             'catalogs': ['testing'],
+             'installs': [{'path': '/Applications/Item%s.app' % index,
+                           'type': 'application'}]}
+            for index in range(count)]
+
+
+class TestCatalogDeltas(unittest.TestCase):
+    """Test that a patched catalog is identical to the full catalog."""
+
+    def assertPatchedMatchesFull(self, old_items, new_items):
+        old_hashes = [catalogdeltas.item_hash(item) for item in old_items]
+        new_hashes = [catalogdeltas.item_hash(item) for item in new_items]
+        delta = catalogdeltas.make_delta(old_hashes, new_hashes, new_items)
+        # round trip the delta through a plist like makecatalogs does
+        delta = readPlistFromString(writePlistToString(delta))
+        patched = catalogdeltas.apply_delta(old_items, delta)
+        self.assertEqual(
+            catalogdeltas.catalog_hash(writePlistToString(patched)),
+            catalogdeltas.catalog_hash(writePlistToString(new_items)))
+        return delta
+
+    def test_unchanged_catalog(self):
+        items = make_items(50)
+        delta = self.assertPatchedMatchesFull(items, list(items))
+        self.assertEqual(delta['added'], {})
+        self.assertEqual(delta['removed'], [])
+
+    def test_changed_item(self):
+        old_items = make_items(50)
+        new_items = list(old_items)
+        new_items[20] = dict(new_items[20], version='2.0')
+        delta = self.assertPatchedMatchesFull(old_items, new_items)
+        self.assertEqual(len(delta['added']), 1)
+        self.assertEqual(len(delta['removed']), 1)
+
+    def test_added_and_removed_items(self):
+        old_items = make_items(50)
+        new_items = old_items[5:] + make_items(60)[50:]
+        del new_items[10]
+        self.assertPatchedMatchesFull(old_items, new_items)
+
+    def test_reordered_and_duplicate_items(self):
+        old_items = make_items(20)
+        new_items = list(reversed(old_items)) + old_items[:3]
+        self.assertPatchedMatchesFull(old_items, new_items)
+
+    def test_delta_for_wrong_catalog_raises(self):
+        old_items = make_items(50)
+        new_items = old_items[:40]
+        delta = catalogdeltas.make_delta(
+            [catalogdeltas.item_hash(item) for item in old_items],
+            [catalogdeltas.item_hash(item) for item in new_items],
+            new_items)
+        with self.assertRaises(catalogdeltas.CatalogDeltaError):
+            catalogdeltas.apply_delta(old_items[:10], delta)
+
+
+if __name__ == '__main__':
+    unittest.main()
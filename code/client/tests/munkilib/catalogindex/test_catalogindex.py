@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalogindex.py
+
+Unit tests for the on-disk catalog index managedsoftwareupdate loads
+catalog items from lazily.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import catalogindex
+from munkilib.wrappers import writePlist
+
+
+def make_items(count):
+    """Returns a list of fake catalog items"""
+    return [{'name': 'Item%s' % index,
+             'version': '1.0.%s' % index,
+             'catalogs': ['testing'],
+             'installer_item_hash': 'hash%s' % index,
+             'installs': [{'path': '/Applications/Item%s.app' % index,
+                           'type': 'application'}],
+             'postinstall_script': '#!/bin/sh\necho %s\n' % index}
+            for index in range(count)]
+
+
+class TestCatalogIndex(unittest.TestCase):
+    """Tests for writing and opening catalog indexes"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.catalogpath = os.path.join(self.tempdir, 'testing')
+        self.indexpath = catalogindex.index_path(self.catalogpath)
+        self.items = make_items(50)
+        self.items[3]['force_install_after_date'] = datetime.datetime(
+            2024, 6, 20, 12, 0)
+        writePlist(self.items, self.catalogpath)
+        self.tables = {'named': {'Item3': {'1.0.3': [3]}},
+                       'autoremoveitems': []}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_index(self):
+        """Indexes the catalog"""
+        catalogindex.write_index(
+            self.indexpath, self.catalogpath, self.items, self.tables,
+            {'updaters': [7, 2]})
+
+    def test_round_trip(self):
+        """Items and tables come back as they went in"""
+        self.write_index()
+        (tables, items, item_lists) = catalogindex.open_index(
+            self.indexpath, self.catalogpath)
+        self.assertEqual(tables, self.tables)
+        self.assertEqual(len(items), 50)
+        self.assertEqual(list(items), self.items)
+        self.assertEqual(items[-1], self.items[-1])
+        self.assertEqual(items[1:3], self.items[1:3])
+        self.assertEqual(list(item_lists['updaters']),
+                         [self.items[7], self.items[2]])
+        with self.assertRaises(IndexError):
+            items[50]
+
+    def test_items_decoded_lazily(self):
+        """Only items that are looked at are decoded, once each"""
+        self.write_index()
+        (dummy_tables, items, item_lists) = catalogindex.open_index(
+            self.indexpath, self.catalogpath)
+        self.assertEqual(items.decoded_count(), 0)
+        item = items[3]
+        item['installed'] = True
+        self.assertIs(item_lists['updaters'][0], items[7])
+        self.assertEqual(items.decoded_count(), 2)
+        # changes to an item are kept, as with a list of dicts
+        self.assertTrue(items[3]['installed'])
+
+    def test_stale_index(self):
+        """An index isn't used once the catalog changes"""
+        self.write_index()
+        writePlist(self.items[:10], self.catalogpath)
+        os.utime(self.catalogpath, (0, 0))
+        self.assertIsNone(
+            catalogindex.open_index(self.indexpath, self.catalogpath))
+
+    def test_bad_index(self):
+        """Missing or damaged indexes aren't used"""
+        self.assertIsNone(
+            catalogindex.open_index(self.indexpath, self.catalogpath))
+        self.write_index()
+        with open(self.indexpath, 'r+b') as fileref:
+            fileref.truncate(os.path.getsize(self.indexpath) - 10)
+        self.assertIsNone(
+            catalogindex.open_index(self.indexpath, self.catalogpath))
+        with open(self.indexpath, 'wb') as fileref:
+            fileref.write(b'<?xml version="1.0"?>')
+        self.assertIsNone(
+            catalogindex.open_index(self.indexpath, self.catalogpath))
+
+    def test_unindexable_catalog(self):
+        """Items a plist can't hold raise CatalogIndexError"""
+        self.items[0]['receipts'] = {1: 'not a plist key'}
+        with self.assertRaises(catalogindex.CatalogIndexError):
+            self.write_index()
+        self.assertEqual(os.listdir(self.tempdir), ['testing'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalogshards.py
+
+Unit tests for splitting catalogs into shards with catalogshards, and for
+working out which shards a client needs.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import hashlib
+import unittest
+
+from munkilib import catalogshards
+from munkilib.wrappers import readPlistFromString, writePlistToString
+
+
+def make_item(name, version, **kwargs):
+    """Returns a fake catalog item"""
+    item = {'name': name, 'version': version, 'catalogs': ['production']}
+    item.update(kwargs)
+    return item
+
+
+def split_name_and_version(some_string):
+    """The same split updatecheck.catalogs does"""
+    for delim in ('--', '-'):
+        if some_string.count(delim) > 0:
+            chunks = some_string.split(delim)
+            vers = chunks.pop()
+            name = delim.join(chunks)
+            if vers and vers[0] in '0123456789':
+                return (name, vers)
+    return (some_string, '')
+
+
+class TestCatalogShards(unittest.TestCase):
+    """Tests for catalogshards"""
+
+    def setUp(self):
+        self.items = [
+            make_item('Firefox', '119.0',
+                      receipts=[{'packageid': 'org.mozilla.firefox',
+                                 'version': '119.0'}]),
+            make_item('Office', '16.0', requires=['Licensing']),
+            make_item('Licensing', '1.0'),
+            make_item('Firefox', '120.0',
+                      receipts=[{'packageid': 'org.mozilla.firefox',
+                                 'version': '120.0'},
+                                {'packageid': 'org.mozilla.firefox',
+                                 'version': '119.0'}]),
+            make_item('FirefoxPolicies', '1.0', update_for='Firefox-120.0'),
+            make_item('OfficeFonts', '1.0', update_for=['Office'],
+                      requires=['Fonts--2.0']),
+            make_item('Fonts', '2.0'),
+            make_item('OldTool', '1.0', autoremove=True),
+            make_item('Unrelated', '1.0'),
+        ]
+        (self.index, self.shards) = catalogshards.make_shards(self.items)
+        # clients get the index as a plist
+        self.index = readPlistFromString(writePlistToString(self.index))
+
+    def shard_items(self, name):
+        """Returns the items in the shard for name"""
+        shard = self.index['shards'][name]
+        data = self.shards[shard['file']]
+        self.assertEqual(hashlib.sha256(data).hexdigest(), shard['hash'])
+        return readPlistFromString(data)
+
+    def test_shards(self):
+        """Each name's items are in one shard, in catalog order"""
+        self.assertEqual(len(self.shards), 8)
+        self.assertEqual(self.shard_items('Firefox'),
+                         [self.items[0], self.items[3]])
+        self.assertEqual(self.index['shards']['Firefox']['positions'], [0, 3])
+        self.assertEqual(self.index['update_for'],
+                         {'Firefox-120.0': ['FirefoxPolicies'],
+                          'Office': ['OfficeFonts']})
+        self.assertEqual(self.index['requires'],
+                         {'Office': ['Licensing'],
+                          'OfficeFonts': ['Fonts--2.0']})
+        self.assertEqual(self.index['autoremove'], ['OldTool'])
+        self.assertEqual(
+            self.index['package_ids'],
+            [['Firefox', [['org.mozilla.firefox', '119.0'],
+                          ['org.mozilla.firefox', '120.0']]]])
+
+    def test_reachable_names(self):
+        """requires and update_for are followed, through versions"""
+        self.assertEqual(
+            catalogshards.reachable_names(
+                self.index, ['Office', 'Firefox--119.0', 'Missing'],
+                split_name_and_version),
+            set(['Office', 'Licensing', 'OfficeFonts', 'Fonts', 'Firefox',
+                 'FirefoxPolicies']))
+
+    def test_names_requiring(self):
+        """Items requiring any form of a name are found"""
+        self.assertEqual(
+            catalogshards.names_requiring(
+                self.index, ['Fonts', 'Fonts-2.0', 'Fonts--2.0']),
+            set(['OfficeFonts']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,7 +33,7 @@ ARG_UNI = u'Günther'
 ARG_STR = u'Günther'.encode('UTF-8')
 
 
-def log(msg, logname=''):
+def log(msg, logname='', level=None):
     """Redefine the logging function so our tests don't write
     a bunch of garbage to Munki's logs"""
     pass
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_disk_image_state.py
+
+Unit tests for the cached disk image state in dmgutils, using hdiutil info
+output recorded in fixtures/.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+import unittest
+
+from munkilib import dmgutils
+from munkilib.wrappers import readPlist
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+FIREFOX_DMG = '/Users/Shared/munki_repo/pkgs/apps/Firefox-120.0.dmg'
+SUITE_DMG = '/Library/Managed Installs/Cache/Suite-3.2.dmg'
+TOOL_DMG = '/Users/Shared/munki_repo/pkgs/apps/Tool-1.0.dmg'
+
+
+def hdiutil_info_fixture(name):
+    """Returns recorded hdiutil info -plist output"""
+    return readPlist(os.path.join(FIXTURES_DIR, 'hdiutil_info_%s.plist' % name))
+
+
+class TestDiskImageState(unittest.TestCase):
+    """Tests for dmgutils.DiskImageState"""
+
+    def setUp(self):
+        self.state = dmgutils.DiskImageState(hdiutil_info_fixture('mounted'))
+
+    def test_indexes(self):
+        """Images are indexed by path and by mount point"""
+        self.assertTrue(self.state.is_mounted(FIREFOX_DMG))
+        self.assertEqual(self.state.mountpoints(SUITE_DMG),
+                         ['/Volumes/Suite Installer', '/Volumes/Suite Extras'])
+        self.assertTrue(self.state.is_mountpoint('/Volumes/Suite Extras'))
+        self.assertEqual(
+            self.state.image_for_mountpoint('/private/tmp/dmg.Tb8bOv'),
+            FIREFOX_DMG)
+
+    def test_attached_without_volumes(self):
+        """An image attached without mounting its volumes isn't mounted"""
+        self.assertFalse(self.state.is_mounted(TOOL_DMG))
+        self.assertEqual(self.state.mountpoints(TOOL_DMG), [])
+
+    def test_unknown_paths(self):
+        """Paths hdiutil doesn't know about aren't mounted or mount points"""
+        self.assertFalse(self.state.is_mounted('/tmp/other.dmg'))
+        self.assertFalse(self.state.is_mountpoint('/Volumes'))
+        self.assertIsNone(self.state.image_for_mountpoint('/nonexistent'))
+
+    def test_no_images(self):
+        """Nothing is mounted when hdiutil lists no images"""
+        state = dmgutils.DiskImageState(hdiutil_info_fixture('none'))
+        self.assertFalse(state.is_mounted(FIREFOX_DMG))
+        self.assertEqual(state.image_by_mountpoint, {})
+
+    def test_add_and_detach(self):
+        """Mounting and detaching update both indexes"""
+        self.state.add('/tmp/new.dmg', ['/private/tmp/dmg.aaaaaa'])
+        self.assertEqual(
+            self.state.image_for_mountpoint('/private/tmp/dmg.aaaaaa'),
+            '/tmp/new.dmg')
+        # detaching one volume detaches the whole image
+        self.assertTrue(self.state.detach('/Volumes/Suite Installer'))
+        self.assertFalse(self.state.is_mounted(SUITE_DMG))
+        self.assertFalse(self.state.is_mountpoint('/Volumes/Suite Extras'))
+        self.assertFalse(self.state.detach('/Volumes/Suite Extras'))
+
+    def test_lookups_while_mounting(self):
+        """Lookups by any path to a mount point work while other threads
+        mount and unmount"""
+        errors = []
+        done = threading.Event()
+
+        def mount_and_unmount(index):
+            """Adds and detaches a disk image over and over"""
+            try:
+                while not done.is_set():
+                    mountpoint = '/tmp/dmg.%s' % index
+                    self.state.add('/tmp/Image%s.dmg' % index, [mountpoint])
+                    self.state.detach(mountpoint)
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(err)
+
+        threads = [threading.Thread(target=mount_and_unmount, args=(index,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            deadline = time.time() + 0.5
+            while time.time() < deadline:
+                self.assertIsNone(
+                    self.state.image_for_mountpoint('/Volumes/Nothing Here'))
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.state.mountpoints(FIREFOX_DMG),
+                         ['/private/tmp/dmg.Tb8bOv'])
+
+
+class TestCachedQueries(unittest.TestCase):
+    """Tests that the dmgutils queries share one hdiutil info"""
+
+    def setUp(self):
+        dmgutils.invalidate_disk_image_state()
+
+    def tearDown(self):
+        dmgutils.invalidate_disk_image_state()
+
+    @patch('munkilib.dmgutils.hdiutil_info')
+    def test_hdiutil_info_runs_once(self, info_mock):
+        """Repeated queries run hdiutil info once until invalidated"""
+        info_mock.return_value = hdiutil_info_fixture('mounted')
+        self.assertTrue(dmgutils.diskImageIsMounted(FIREFOX_DMG))
+        self.assertEqual(dmgutils.mount_points_for_disk_image(FIREFOX_DMG),
+                         ['/private/tmp/dmg.Tb8bOv'])
+        self.assertTrue(dmgutils.pathIsVolumeMountPoint('/Volumes/Suite Extras'))
+        self.assertEqual(
+            dmgutils.diskImageForMountPoint('/Volumes/Suite Installer'),
+            SUITE_DMG)
+        self.assertEqual(info_mock.call_count, 1)
+
+        info_mock.return_value = hdiutil_info_fixture('none')
+        dmgutils.invalidate_disk_image_state()
+        self.assertFalse(dmgutils.diskImageIsMounted(FIREFOX_DMG))
+        self.assertEqual(info_mock.call_count, 2)
+
+    @patch('munkilib.dmgutils.hdiutil_info')
+    def test_first_queries_at_once(self, info_mock):
+        """Threads asking at once share one hdiutil info"""
+
+        def slow_info():
+            """hdiutil info, taking long enough for the others to ask"""
+            time.sleep(0.1)
+            return hdiutil_info_fixture('mounted')
+
+        info_mock.side_effect = slow_info
+        results = []
+
+        def query():
+            """Asks whether Firefox is mounted"""
+            results.append(dmgutils.diskImageIsMounted(FIREFOX_DMG))
+
+        threads = [threading.Thread(target=query) for dummy in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(info_mock.call_count, 1)
+
+    @patch('munkilib.dmgutils.hdiutil_info', return_value=None)
+    def test_failures_are_not_cached(self, info_mock):
+        """If hdiutil info fails, it's run again next time"""
+        self.assertFalse(dmgutils.diskImageIsMounted(FIREFOX_DMG))
+        self.assertFalse(dmgutils.diskImageIsMounted(FIREFOX_DMG))
+        self.assertEqual(info_mock.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_filecopy.py
+
+Unit tests for filecopy, which must produce the same bytes (and hashes)
+whichever way it ends up copying.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import filecopy, munkirepo
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class TestCopyFile(unittest.TestCase):
+    """Tests for filecopy.copy_file"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tempdir, 'src.dmg')
+        self.dst = os.path.join(self.tempdir, 'dst.dmg')
+        # a sparse file: data, a hole, more data, and a trailing hole
+        with open(self.src, 'wb') as fileref:
+            fileref.write(b'munki' * 1000)
+            fileref.seek(3 * 2**20)
+            fileref.write(b'ikunm' * 1000)
+            fileref.truncate(5 * 2**20)
+        with open(self.src, 'rb') as fileref:
+            self.contents = fileref.read()
+        # an existing file to replace
+        with open(self.dst, 'wb') as fileref:
+            fileref.write(b'old contents' * 2**20)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assert_copied(self):
+        """Checks dst has the same contents as src"""
+        with open(self.dst, 'rb') as fileref:
+            self.assertEqual(fileref.read(), self.contents)
+
+    def test_copy(self):
+        """The copy has the same contents"""
+        self.assertEqual(filecopy.copy_file(self.src, self.dst), {})
+        self.assert_copied()
+
+    def test_copy_with_hashes(self):
+        """Hashes are those of the whole file, holes included"""
+        hashes = filecopy.copy_file(self.src, self.dst, ('sha256', 'md5'))
+        self.assert_copied()
+        self.assertEqual(hashes, {
+            'sha256': hashlib.sha256(self.contents).hexdigest(),
+            'md5': hashlib.md5(self.contents).hexdigest()})
+
+    @patch('munkilib.filecopy._clonefile', return_value=False)
+    @patch('munkilib.filecopy._reflink', return_value=False)
+    @patch('munkilib.filecopy._kernel_copy_range', return_value=False)
+    def test_userspace_copy(self, dummy_kernel_mock, dummy_reflink_mock,
+                            dummy_clonefile_mock):
+        """Without clones or kernel copies, we copy it ourselves"""
+        filecopy.copy_file(self.src, self.dst)
+        self.assert_copied()
+
+    def test_same_file(self):
+        """Copying a file onto itself fails without harming it"""
+        with self.assertRaises(OSError):
+            filecopy.copy_file(self.src, self.src)
+        with open(self.src, 'rb') as fileref:
+            self.assertEqual(fileref.read(), self.contents)
+
+    def test_failed_clone_rename_leaves_nothing(self):
+        """If the clone can't be renamed into place, it's removed"""
+        def fake_clonefile(src, dst, dummy_flags):
+            shutil.copyfile(src, dst)
+            return 0
+
+        with patch('munkilib.filecopy._CLONEFILE', fake_clonefile):
+            with patch('os.rename', side_effect=OSError(13, 'denied')):
+                with self.assertRaises(OSError):
+                    filecopy.copy_file(self.src, self.dst)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['dst.dmg', 'src.dmg'])
+
+    def test_repo_copy_with_hashes(self):
+        """FileRepo hands back the hashes worked out while copying"""
+        repo = munkirepo.connect('file://' + self.tempdir, 'FileRepo')
+        hashes = repo.put_from_local_file_with_hashes(
+            'pkgs/apps/dst.dmg', self.src, ['sha256'])
+        self.assertEqual(
+            hashes, {'sha256': hashlib.sha256(self.contents).hexdigest()})
+        with open(os.path.join(self.tempdir, 'pkgs/apps/dst.dmg'),
+                  'rb') as fileref:
+            self.assertEqual(fileref.read(), self.contents)
+        self.assertEqual(repo.put_from_local_file_with_hashes(
+            'src.dmg', self.src, ['sha256']), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_iconpipeline.py
+
+Unit tests for the iconimporter pipeline, using stub extractors and a
+stub converter in place of hdiutil and sips.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from munkilib import munkirepo
+from munkilib.admin import iconpipeline
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class FakeRepo(object):
+    """A repo whose pkgs are made up and whose icons are kept in memory"""
+
+    def __init__(self):
+        self.icons = {}
+
+    def get_to_local_file(self, resource_identifier, local_file_path):
+        if 'missing' in resource_identifier:
+            raise munkirepo.RepoError('No such file')
+        with open(local_file_path, 'w') as fileref:
+            fileref.write(resource_identifier)
+
+    def put_from_local_file(self, resource_identifier, local_file_path):
+        with open(local_file_path) as fileref:
+            self.icons[resource_identifier] = fileref.read()
+
+
+class StageCounter(object):
+    """Counts how many items are in a stage at once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        # give other workers a chance to pile in
+        time.sleep(0.01)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.current -= 1
+
+
+class StubExtractor(iconpipeline.IconExtractor):
+    """Finds icon_count icons in every installer"""
+
+    def __init__(self, icon_count=1):
+        self.icon_count = icon_count
+        self.counter = StageCounter()
+
+    def extract(self, job):
+        with self.counter:
+            icon_paths = []
+            for index in range(self.icon_count):
+                icon_path = os.path.join(job.workdir, 'icon%s.icns' % index)
+                with open(icon_path, 'w') as fileref:
+                    fileref.write(job.name)
+                icon_paths.append(icon_path)
+            return icon_paths
+
+
+def make_item(name, installer_type=None, installer_hash=None):
+    """Returns a fake catalog item"""
+    item = {'name': name, 'version': '1.0',
+            'installer_item_location': 'apps/%s-1.0.dmg' % name}
+    if installer_type:
+        item['installer_type'] = installer_type
+    if installer_hash:
+        item['installer_item_hash'] = installer_hash
+    return item
+
+
+class TestIconPipeline(unittest.TestCase):
+    """Tests for iconpipeline.IconPipeline"""
+
+    def setUp(self):
+        self.repo = FakeRepo()
+        self.convert_counter = StageCounter()
+        self.reported = []
+
+    def converter(self, icon_path, png_path):
+        """Copies the icon, failing for ones named Broken"""
+        with self.convert_counter:
+            shutil.copyfile(icon_path, png_path)
+            with open(icon_path) as fileref:
+                return fileref.read() != 'Broken'
+
+    def run_pipeline(self, items, extractors, **kwargs):
+        """Runs items through a pipeline, returning their jobs by name"""
+        pipeline = iconpipeline.IconPipeline(
+            self.repo, extractors, self.converter, **kwargs)
+        jobs = pipeline.run(items, report=self.reported.append)
+        return dict((job.name, job) for job in jobs)
+
+    def test_stage_limits(self):
+        """No stage ever has more items in it than its limit"""
+        extractor = StubExtractor()
+        items = [make_item('App%s' % index, 'copy_from_dmg')
+                 for index in range(20)]
+        self.run_pipeline(items, {'copy_from_dmg': extractor},
+                          extract_jobs=2, convert_jobs=3)
+        self.assertEqual(len(self.repo.icons), 20)
+        self.assertEqual(self.repo.icons['icons/App7.png'], 'App7')
+        self.assertTrue(1 < extractor.counter.peak <= 2)
+        self.assertTrue(1 < self.convert_counter.peak <= 3)
+        self.assertEqual(len(self.reported), 20)
+
+    def test_icon_names_and_failures(self):
+        """Several icons are numbered; a failed item doesn't stop others"""
+        jobs = self.run_pipeline(
+            [make_item('Suite'), make_item('Broken'), make_item('missing'),
+             make_item('Script', 'nopkg')],
+            {'': StubExtractor(icon_count=2)})
+        self.assertEqual(sorted(self.repo.icons),
+                         ['icons/Suite_1.png', 'icons/Suite_2.png'])
+        self.assertEqual(jobs['Broken'].uploaded, [])
+        self.assertIn('download', jobs['missing'].messages[0])
+        # items of unknown types are reported, but never queued
+        self.assertEqual(len(self.reported), 4)
+        self.assertNotIn('Script', jobs)
+
+    def test_extractor_errors_are_logged(self):
+        """An extractor raising anything fails only its own item"""
+
+        class FlakyExtractor(StubExtractor):
+            """Blows up on items named Flaky"""
+
+            def extract(self, job):
+                if job.name == 'Flaky':
+                    raise ValueError('bad plist in installer')
+                return StubExtractor.extract(self, job)
+
+        jobs = self.run_pipeline(
+            [make_item('Flaky'), make_item('App')],
+            {'': FlakyExtractor()})
+        self.assertEqual(sorted(self.repo.icons), ['icons/App.png'])
+        self.assertIn('bad plist in installer', jobs['Flaky'].messages[-1])
+        self.assertFalse(os.path.exists(jobs['Flaky'].workdir))
+        self.assertEqual(len(self.reported), 2)
+
+    def test_base_extractor_finds_nothing(self):
+        """The base IconExtractor finds no icons"""
+        jobs = self.run_pipeline(
+            [make_item('App')], {'': iconpipeline.IconExtractor()})
+        self.assertEqual(self.repo.icons, {})
+        self.assertEqual(jobs['App'].messages,
+                         [u'No application icons found.'])
+
+    def test_work_directories_removed(self):
+        """Nothing is left behind in the work directories"""
+        jobs = self.run_pipeline(
+            [make_item('App')], {'': StubExtractor()})
+        self.assertFalse(os.path.exists(jobs['App'].workdir))
+
+
+class TestSourceHashes(unittest.TestCase):
+    """Tests for skipping icons made from the same installer item"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_needs_icon(self):
+        """Only missing icons, or ones whose installer changed, are made"""
+        icons_list = ['Firefox.png', 'Custom.png']
+        source_hashes = {'Firefox.png': 'abc'}
+        self.assertTrue(iconpipeline.needs_icon(
+            make_item('Chrome'), icons_list, source_hashes))
+        self.assertFalse(iconpipeline.needs_icon(
+            make_item('Firefox', installer_hash='abc'), icons_list,
+            source_hashes))
+        self.assertTrue(iconpipeline.needs_icon(
+            make_item('Firefox', installer_hash='def'), icons_list,
+            source_hashes))
+        # an icon we didn't make is left alone unless forced
+        self.assertFalse(iconpipeline.needs_icon(
+            make_item('Custom', installer_hash='def'), icons_list,
+            source_hashes))
+        self.assertTrue(iconpipeline.needs_icon(
+            make_item('Custom'), icons_list, source_hashes, force=True))
+
+    def test_source_hashes_recorded(self):
+        """Hashes are recorded for items that got icons, and saved"""
+        source_hashes = {}
+        pipeline = iconpipeline.IconPipeline(
+            FakeRepo(), {'': StubExtractor()},
+            lambda src, dst: bool(shutil.copyfile(src, dst)))
+        pipeline.run([make_item('Firefox', installer_hash='abc'),
+                      make_item('missing', installer_hash='def')],
+                     source_hashes=source_hashes, report=lambda job: None)
+        self.assertEqual(source_hashes, {'Firefox.png': 'abc'})
+
+        repo = FakeRepo()
+        repo.baseurl = 'file:///Users/Shared/munki_repo'
+        with patch.object(
+                iconpipeline, 'CACHE_DIR', self.tempdir):
+            iconpipeline.save_source_hashes(repo, source_hashes)
+            self.assertEqual(iconpipeline.load_source_hashes(repo),
+                             source_hashes)
+
+        # nothing is kept for a repo without a URL
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        with patch.object(iconpipeline, 'CACHE_DIR', cache_dir):
+            iconpipeline.save_source_hashes(FakeRepo(), source_hashes)
+            self.assertFalse(os.path.exists(cache_dir))
+            self.assertEqual(iconpipeline.load_source_hashes(FakeRepo()), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
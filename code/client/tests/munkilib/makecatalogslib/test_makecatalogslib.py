@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_makecatalogslib.py
+
+Unit tests for what makecatalogslib.makecatalogs publishes besides the
+catalogs, and for keeping it published across runs that don't ask for it.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import catalogdeltas
+from munkilib import catalogshards
+from munkilib import munkirepo
+from munkilib.admin import makecatalogslib
+from munkilib.wrappers import readPlist, writePlist
+
+
+class TestMakeCatalogsPublishing(unittest.TestCase):
+    """Tests for publishing deltas, compressed catalogs and shards with
+    makecatalogs"""
+
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        for kind in ('catalogs', 'icons', 'pkgs', 'pkgsinfo'):
+            os.mkdir(os.path.join(self.repo_root, kind))
+        self.repo = munkirepo.connect('file://' + self.repo_root, 'FileRepo')
+        self.add_pkginfo('Firefox', '119.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_root)
+
+    def add_pkginfo(self, name, version):
+        """Adds a nopkg pkginfo to the repo"""
+        writePlist({'name': name, 'version': version,
+                    'installer_type': 'nopkg', 'catalogs': ['testing']},
+                   os.path.join(self.repo_root, 'pkgsinfo',
+                                '%s-%s.plist' % (name, version)))
+
+    def makecatalogs(self, **options):
+        """Runs makecatalogs, checking it had no errors"""
+        self.assertEqual(
+            makecatalogslib.makecatalogs(self.repo, options), [])
+
+    def catalogs_path(self, *parts):
+        """Returns a path under the repo's catalogs directory"""
+        return os.path.join(self.repo_root, 'catalogs', *parts)
+
+    def published_files(self, subdir):
+        """Returns the files under a subdirectory of catalogs"""
+        return [name for (dummy_dir, dummy_dirs, names)
+                in os.walk(self.catalogs_path(subdir)) for name in names]
+
+    def delta_index(self):
+        """Returns the delta index of the testing catalog"""
+        return readPlist(self.catalogs_path(
+            catalogdeltas.DELTAS_DIR, 'testing', catalogdeltas.INDEX_NAME))
+
+    def test_flagless_run_keeps_deltas(self):
+        """A run that doesn't mention deltas keeps publishing them"""
+        self.makecatalogs(delta_history=2)
+        self.assertEqual(self.delta_index()['revision'], 1)
+        # as munkiimport and repoclean run it
+        self.add_pkginfo('Firefox', '120.0')
+        self.makecatalogs()
+        index = self.delta_index()
+        self.assertEqual(index['revision'], 2)
+        self.assertEqual([delta['name'] for delta in index['deltas']],
+                         [catalogdeltas.delta_name(1, 2)])
+
+    def test_flagless_run_publishes_nothing_new(self):
+        """Deltas are neither published nor removed unless asked for"""
+        self.makecatalogs()
+        self.assertFalse(os.path.exists(
+            self.catalogs_path(catalogdeltas.DELTAS_DIR)))
+        self.assertFalse(os.path.exists(
+            self.catalogs_path(makecatalogslib.SETTINGS_NAME)))
+
+    def test_turning_deltas_off(self):
+        """Deltas are removed when turned off, and stay off"""
+        self.makecatalogs(delta_history=2)
+        self.makecatalogs(delta_history=0)
+        self.assertEqual(self.published_files(catalogdeltas.DELTAS_DIR), [])
+        self.add_pkginfo('Firefox', '120.0')
+        self.makecatalogs()
+        self.assertEqual(self.published_files(catalogdeltas.DELTAS_DIR), [])
+
+    def test_unreadable_history(self):
+        """A damaged revision history is replaced with a new one"""
+        self.makecatalogs(delta_history=2)
+        with open(self.catalogs_path(catalogdeltas.DELTAS_DIR, 'testing',
+                                     catalogdeltas.HISTORY_NAME), 'w') as fref:
+            fref.write('not a plist')
+        self.add_pkginfo('Firefox', '120.0')
+        errors = makecatalogslib.makecatalogs(self.repo, {})
+        self.assertEqual(len(errors), 1)
+        self.assertIn('unreadable revision history', errors[0])
+        self.assertEqual(self.delta_index()['revision'], 1)
+        self.assertEqual(self.delta_index()['deltas'], [])
+
+    def test_flagless_run_keeps_compressed_catalogs(self):
+        """A run that doesn't mention gzip keeps compressed catalogs current,
+        with the hash of the catalog beside them"""
+        self.makecatalogs(gzip=True)
+        self.add_pkginfo('Firefox', '120.0')
+        self.makecatalogs()
+        with open(self.catalogs_path('testing'), 'rb') as fileref:
+            catalog_data = fileref.read()
+        with gzip.open(self.catalogs_path('testing.gz'), 'rb') as fileref:
+            self.assertEqual(fileref.read(), catalog_data)
+        with open(self.catalogs_path('testing.sha256'), 'rb') as fileref:
+            self.assertEqual(fileref.read().strip().decode('UTF-8'),
+                             hashlib.sha256(catalog_data).hexdigest())
+
+    def test_turning_gzip_off(self):
+        """Compressed catalogs are removed when turned off"""
+        self.makecatalogs(gzip=True)
+        self.makecatalogs(gzip=False)
+        self.makecatalogs()
+        self.assertEqual(
+            sorted(os.listdir(self.catalogs_path())),
+            [makecatalogslib.SETTINGS_NAME, 'all', 'testing'])
+
+    def test_flagless_run_keeps_shards(self):
+        """A run that doesn't mention shards keeps them current"""
+        self.makecatalogs(shards=True)
+        self.add_pkginfo('Thunderbird', '115.0')
+        self.makecatalogs()
+        index = readPlist(self.catalogs_path(
+            catalogshards.SHARDS_DIR, 'testing', catalogshards.INDEX_NAME))
+        self.assertEqual(sorted(index['shards']), ['Firefox', 'Thunderbird'])
+
+    def test_turning_shards_off(self):
+        """Shards are removed when turned off"""
+        self.makecatalogs(shards=True)
+        self.makecatalogs(shards=False)
+        self.makecatalogs()
+        self.assertEqual(self.published_files(catalogshards.SHARDS_DIR), [])
+
+    def test_catalog_artifacts(self):
+        """Everything published beside the catalogs is an artifact"""
+        self.makecatalogs(delta_history=2, gzip=True, shards=True)
+        self.add_pkginfo('Thunderbird', '115.0')
+        self.makecatalogs()
+        catalog_list = self.repo.itemlist('catalogs')
+        self.assertEqual(
+            sorted(name for name in catalog_list
+                   if not makecatalogslib.is_catalog_artifact(name)),
+            ['all', 'testing'])
+        # cleanup leaves compressed catalogs to be checked against the
+        # catalogs makecatalogs writes
+        self.assertEqual(
+            sorted(name for name in catalog_list
+                   if not makecatalogslib.is_catalog_artifact(
+                       name, compressed=False)),
+            ['all', 'all.gz', 'all.sha256',
+             'testing', 'testing.gz', 'testing.sha256'])
+
+
+if __name__ == '__main__':
+    unittest.main()
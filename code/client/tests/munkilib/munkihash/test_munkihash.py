@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_munkihash.py
+
+Unit tests for munkihash's single-pass and threaded hashing functions.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from munkilib import munkihash
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class TestMunkiHash(unittest.TestCase):
+    """Tests for munkihash"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.contents = {}
+        self.paths = []
+        # sizes either side of the read buffer sizes
+        for (index, size) in enumerate(
+                (0, 1, munkihash.MIN_READ_SIZE, munkihash.MIN_READ_SIZE + 1,
+                 munkihash.MIN_READ_SIZE * 64 + 3)):
+            path = os.path.join(self.tempdir, 'file%s.dmg' % index)
+            data = os.urandom(size)
+            with open(path, 'wb') as fileref:
+                fileref.write(data)
+            self.contents[path] = data
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def expected(self, path, algorithms=('sha256', )):
+        """The hashes hashlib gives for the file at path"""
+        return dict((name, hashlib.new(name, self.contents[path]).hexdigest())
+                    for name in algorithms)
+
+    def test_gethashes(self):
+        """All the requested hashes are computed, whatever the file size"""
+        algorithms = ('md5', 'sha1', 'sha256')
+        for path in self.paths:
+            self.assertEqual(munkihash.gethashes(path, algorithms),
+                             self.expected(path, algorithms), path)
+        self.assertEqual(munkihash.gethashes(self.paths[1]),
+                         self.expected(self.paths[1]))
+
+    def test_single_hash_functions(self):
+        """getsha256hash and getmd5hash agree with hashlib"""
+        path = self.paths[-1]
+        self.assertEqual(munkihash.getsha256hash(path),
+                         self.expected(path)['sha256'])
+        self.assertEqual(munkihash.getmd5hash(path),
+                         self.expected(path, ('md5', ))['md5'])
+
+    def test_not_a_file(self):
+        """Directories and missing files are 'NOT A FILE'"""
+        missing = os.path.join(self.tempdir, 'missing.dmg')
+        for path in (self.tempdir, missing):
+            self.assertEqual(munkihash.gethashes(path, ('md5', 'sha256')),
+                             {'md5': 'NOT A FILE', 'sha256': 'NOT A FILE'})
+            self.assertEqual(munkihash.getsha256hash(path), 'NOT A FILE')
+
+    def test_hash_error(self):
+        """Files that can't be read are 'HASH_ERROR'"""
+        path = self.paths[1]
+        with patch('munkilib.munkihash.open', create=True,
+                   side_effect=IOError(13, 'Permission denied')):
+            self.assertEqual(munkihash.gethashes(path, ('md5', 'sha256')),
+                             {'md5': 'HASH_ERROR', 'sha256': 'HASH_ERROR'})
+            self.assertEqual(munkihash.getsha256hash(path), 'HASH_ERROR')
+            self.assertEqual(munkihash.getsha256hashes([path], max_workers=2),
+                             {path: 'HASH_ERROR'})
+
+    def test_read_size_for(self):
+        """Read sizes grow with the file, within their bounds"""
+        self.assertEqual(munkihash.read_size_for(0), munkihash.MIN_READ_SIZE)
+        self.assertEqual(
+            munkihash.read_size_for(munkihash.MIN_READ_SIZE * 64 + 1),
+            munkihash.MIN_READ_SIZE * 2)
+        self.assertEqual(munkihash.read_size_for(2**40),
+                         munkihash.MAX_READ_SIZE)
+
+    def test_gethashes_for_files(self):
+        """Every file gets its own hashes, threaded or not"""
+        missing = os.path.join(self.tempdir, 'missing.dmg')
+        filenames = self.paths + [missing, self.paths[0]]
+        for max_workers in (1, 3, None):
+            results = munkihash.gethashes_for_files(
+                filenames, ('md5', 'sha256'), max_workers=max_workers)
+            # duplicates are hashed once; order is that of filenames
+            self.assertEqual(list(results), self.paths + [missing])
+            for path in self.paths:
+                self.assertEqual(results[path],
+                                 self.expected(path, ('md5', 'sha256')))
+            self.assertEqual(results[missing],
+                             {'md5': 'NOT A FILE', 'sha256': 'NOT A FILE'})
+        self.assertEqual(munkihash.gethashes_for_files([]), {})
+
+    def test_threaded_order(self):
+        """Results are in the order given, not the order files finish"""
+        gethashes = munkihash.gethashes
+        # the first files given take longest to hash
+        delays = dict((path, 0.05 * (len(self.paths) - index))
+                      for (index, path) in enumerate(self.paths))
+        finished = []
+        lock = threading.Lock()
+
+        def slow_gethashes(filename, algorithms):
+            """gethashes, after a delay"""
+            time.sleep(delays[filename])
+            with lock:
+                finished.append(filename)
+            return gethashes(filename, algorithms)
+
+        with patch('munkilib.munkihash.gethashes', slow_gethashes):
+            results = munkihash.getsha256hashes(
+                self.paths, max_workers=len(self.paths))
+        self.assertNotEqual(finished, self.paths)
+        self.assertEqual(list(results), self.paths)
+        for path in self.paths:
+            self.assertEqual(results[path], self.expected(path)['sha256'])
+
+
+if __name__ == '__main__':
+    unittest.main()
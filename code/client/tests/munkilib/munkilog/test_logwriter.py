@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_logwriter.py
+
+Unit tests for munkilog.LogWriter: buffering of main log lines, when they
+are flushed, and reopening log files that have been rotated or replaced.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from munkilib import munkilog
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class TestLogWriter(unittest.TestCase):
+    """Tests for munkilog.LogWriter"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.logpath = os.path.join(self.tempdir, 'ManagedSoftwareUpdate.log')
+        patcher = patch('munkilib.munkilog.prefs.pref',
+                        return_value=self.logpath)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = munkilog.LogWriter()
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tempdir)
+
+    def logged_lines(self, logname=''):
+        """Returns the messages in a log, without timestamps"""
+        path = self.writer.logpath(logname)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fileref:
+            # the timestamp is the first five words of each line
+            return [line.rstrip('\n').split(' ', 5)[5] for line in fileref]
+
+    def test_lines_are_buffered(self):
+        """Main log lines wait until FLUSH_LINES of them are waiting"""
+        for index in range(munkilog.FLUSH_LINES - 1):
+            self.writer.write('line %s' % index)
+        self.assertEqual(self.logged_lines(), [])
+        self.writer.write('last line')
+        lines = self.logged_lines()
+        self.assertEqual(len(lines), munkilog.FLUSH_LINES)
+        self.assertEqual(lines[0], 'line 0')
+        self.assertEqual(lines[-1], 'last line')
+
+    def test_important_lines_flush(self):
+        """A line at FLUSH_LEVEL or above is written at once, after the lines
+        before it"""
+        self.writer.write('info')
+        self.writer.write('debug', level=logging.DEBUG)
+        self.assertEqual(self.logged_lines(), [])
+        self.writer.write('warning', level=munkilog.FLUSH_LEVEL)
+        self.assertEqual(self.logged_lines(), ['info', 'debug', 'warning'])
+        self.writer.write('error', level=logging.ERROR)
+        self.assertEqual(self.logged_lines()[-1], 'error')
+
+    def test_other_logs_are_not_buffered(self):
+        """Lines for other logs are written at once, after buffered main log
+        lines"""
+        self.writer.write('main')
+        self.writer.write('other', logname='warnings.log')
+        self.assertEqual(self.logged_lines('warnings.log'), ['other'])
+        self.assertEqual(self.logged_lines(), ['main'])
+
+    @patch('munkilib.munkilog.FLUSH_INTERVAL', 0.05)
+    def test_timer_flush(self):
+        """Buffered lines are written FLUSH_INTERVAL after the first"""
+        self.writer.write('waiting')
+        self.assertEqual(self.logged_lines(), [])
+        deadline = time.time() + 5
+        while not self.logged_lines() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.logged_lines(), ['waiting'])
+
+    def test_reopen_after_rotatelog(self):
+        """A rotated log is reopened, rather than written to at its new
+        name"""
+        self.writer.write('before', level=logging.WARNING)
+        with patch('munkilib.munkilog._WRITER', self.writer):
+            munkilog.rotatelog()
+        self.writer.write('after', level=logging.WARNING)
+        self.assertEqual(self.logged_lines(), ['after'])
+        with open(self.logpath + '.0') as fileref:
+            self.assertTrue(fileref.read().rstrip('\n').endswith('before'))
+
+    def test_reopen_after_replace(self):
+        """A log moved or replaced behind our back is reopened"""
+        self.writer.write('first', level=logging.WARNING)
+        os.rename(self.logpath, self.logpath + '.moved')
+        self.writer.write('second', level=logging.WARNING)
+        self.assertEqual(self.logged_lines(), ['second'])
+        # a new file at the same path has a different inode
+        os.unlink(self.logpath)
+        with open(self.logpath, 'w') as fileref:
+            fileref.write('')
+        self.writer.write('third', level=logging.WARNING)
+        self.assertEqual(self.logged_lines(), ['third'])
+        with open(self.logpath + '.moved') as fileref:
+            self.assertEqual(len(fileref.readlines()), 1)
+
+    def test_reset_reads_logfile_again(self):
+        """After a reset, lines go to the log the LogFile preference now
+        names; buffered lines still go to the old one"""
+        new_logpath = os.path.join(self.tempdir, 'other', 'Munki.log')
+        os.mkdir(os.path.dirname(new_logpath))
+        self.writer.write('old')
+        with patch('munkilib.munkilog.prefs.pref', return_value=new_logpath):
+            self.assertEqual(self.writer.logpath(), self.logpath)
+            self.writer.reset()
+            self.assertEqual(self.logged_lines(), [])
+            self.writer.write('new', level=logging.WARNING)
+            self.writer.write('other', logname='warnings.log')
+            self.assertEqual(self.writer.logpath(), new_logpath)
+            self.assertEqual(self.logged_lines(), ['new'])
+            self.assertEqual(self.logged_lines('warnings.log'), ['other'])
+        with open(self.logpath) as fileref:
+            self.assertTrue(fileref.read().rstrip('\n').endswith('old'))
+
+
+
+class TestLoggingLevel(unittest.TestCase):
+    """Tests for munkilog.logging_level"""
+
+    def setUp(self):
+        munkilog.reset_logging_level()
+        self.addCleanup(munkilog.reset_logging_level)
+
+    def test_read_once_until_reset(self):
+        """The preference is read once, and again after a reset"""
+        with patch('munkilib.munkilog.prefs.pref',
+                   return_value=2) as pref_mock:
+            self.assertEqual(munkilog.logging_level(), 2)
+            pref_mock.return_value = 3
+            self.assertEqual(munkilog.logging_level(), 2)
+            self.assertEqual(pref_mock.call_count, 1)
+            munkilog.reset_logging_level()
+            self.assertEqual(munkilog.logging_level(), 3)
+
+    def test_bad_preference(self):
+        """A LoggingLevel that isn't a number means level 1"""
+        with patch('munkilib.munkilog.prefs.pref', return_value='loud'):
+            self.assertEqual(munkilog.logging_level(), 1)
+
+    def test_reset_prefs(self):
+        """reset_prefs resets the logging level and the log writer"""
+        with patch('munkilib.munkilog.prefs.pref', return_value=2):
+            self.assertEqual(munkilog.logging_level(), 2)
+        with patch('munkilib.munkilog._WRITER') as writer_mock:
+            with patch('munkilib.munkilog.prefs.pref', return_value=3):
+                munkilog.reset_prefs()
+                self.assertEqual(munkilog.logging_level(), 3)
+            writer_mock.reset.assert_called_once_with()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_pkgdedup.py
+
+Unit tests for finding and removing duplicate installer items with
+pkgdedup.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib.admin import pkgdedup
+from munkilib.wrappers import readPlistFromString, writePlistToString
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+FIREFOX = b'firefox installer' * 100
+SHA256 = hashlib.sha256(FIREFOX).hexdigest()
+
+
+class FakeRepo(object):
+    """Just enough of a file repo for pkgdedup"""
+
+    def __init__(self, root):
+        self.root = root
+        self.baseurl = 'file://' + root
+
+    def local_path(self, resource_identifier):
+        return os.path.join(self.root, resource_identifier)
+
+    def get(self, resource_identifier):
+        with open(self.local_path(resource_identifier), 'rb') as fileref:
+            return fileref.read()
+
+    def put(self, resource_identifier, content):
+        with open(self.local_path(resource_identifier), 'wb') as fileref:
+            fileref.write(content)
+
+    def delete(self, resource_identifier):
+        os.unlink(self.local_path(resource_identifier))
+
+
+class TestPkgDedup(unittest.TestCase):
+    """Tests for pkgdedup"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = FakeRepo(self.tempdir)
+        for subdir in ('pkgs/apps', 'pkgs/old', 'pkgsinfo'):
+            os.makedirs(os.path.join(self.tempdir, subdir))
+        self.write_pkg('apps/Firefox-120.0.dmg', FIREFOX)
+        self.write_pkg('old/Firefox-120.0.dmg', FIREFOX)
+        self.write_pkg('old/Firefox copy.dmg', FIREFOX)
+        # same size, different contents
+        self.write_pkg('apps/Other-1.0.dmg', FIREFOX.upper())
+        self.write_pkg('apps/Small-1.0.dmg', b'small')
+        self.pkgs_list = sorted(
+            os.path.relpath(os.path.join(dirpath, name),
+                            os.path.join(self.tempdir, 'pkgs'))
+            for (dirpath, dummy_dirs, names) in os.walk(
+                os.path.join(self.tempdir, 'pkgs'))
+            for name in names)
+        self.pkginfo_pkgs = {}
+        self.write_pkginfo('Firefox-120.0', 'apps/Firefox-120.0.dmg')
+        self.write_pkginfo('Firefox-120.0-testing', 'apps/Firefox-120.0.dmg')
+        self.write_pkginfo('Firefox-120.0__1', 'old/Firefox-120.0.dmg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_pkg(self, pkg, content):
+        """Adds a pkg to the repo"""
+        with open(os.path.join(self.tempdir, 'pkgs', pkg), 'wb') as fileref:
+            fileref.write(content)
+
+    def write_pkginfo(self, name, pkg):
+        """Adds a pkginfo referring to pkg"""
+        resource_identifier = os.path.join('pkgsinfo', name + '.plist')
+        self.repo.put(resource_identifier, writePlistToString(
+            {'name': 'Firefox', 'version': '120.0',
+             'installer_item_location': pkg,
+             'installer_item_hash': SHA256}))
+        self.pkginfo_pkgs.setdefault(
+            pkg, {'hash': SHA256, 'size': len(FIREFOX), 'references': []}
+        )['references'].append(
+            (resource_identifier, 'installer_item_location'))
+
+    def find_duplicates(self, **kwargs):
+        """Returns the duplicate sets in the repo"""
+        return pkgdedup.find_duplicates(
+            self.repo, self.pkgs_list, self.pkginfo_pkgs, **kwargs)
+
+    def test_find_duplicates(self):
+        """Identical pkgs are found; same-sized ones aren't confused"""
+        duplicates = self.find_duplicates()
+        self.assertEqual(len(duplicates), 1)
+        self.assertEqual(duplicates[0]['sha256'], SHA256)
+        # the most referenced pkg is canonical
+        self.assertEqual(duplicates[0]['pkgs'],
+                         ['apps/Firefox-120.0.dmg', 'old/Firefox-120.0.dmg',
+                          'old/Firefox copy.dmg'])
+        self.assertEqual(duplicates[0]['reclaimable'], 2 * len(FIREFOX))
+
+    @patch('munkilib.munkihash.getsha256hashes')
+    def test_pkginfo_hashes_and_cache(self, hashes_mock):
+        """Only pkgs without a pkginfo or cached hash are hashed"""
+        hashes_mock.side_effect = lambda paths, max_workers: dict(
+            (path, hashlib.sha256(open(path, 'rb').read()).hexdigest())
+            for path in paths)
+        hash_cache = pkgdedup.HashCache(os.path.join(self.tempdir, 'db'))
+        try:
+            self.find_duplicates(hash_cache=hash_cache)
+            self.assertEqual(
+                sorted(os.path.basename(path)
+                       for path in hashes_mock.call_args[0][0]),
+                ['Firefox copy.dmg', 'Other-1.0.dmg'])
+            self.find_duplicates(hash_cache=hash_cache)
+            self.assertEqual(hashes_mock.call_args[0][0], [])
+        finally:
+            hash_cache.close()
+
+    def test_hardlink_duplicates(self):
+        """Duplicates become hardlinks, and then aren't reported"""
+        duplicates = self.find_duplicates(verify=True)
+        self.assertEqual(
+            pkgdedup.hardlink_duplicates(self.repo, duplicates[0]), [])
+        inodes = set(
+            os.stat(self.repo.local_path(os.path.join('pkgs', pkg))).st_ino
+            for pkg in duplicates[0]['pkgs'])
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(self.find_duplicates(), [])
+
+    def test_consolidate_duplicates(self):
+        """pkginfo are pointed at the canonical pkg; the rest are deleted"""
+        duplicates = self.find_duplicates(verify=True)
+        self.assertEqual(pkgdedup.consolidate_duplicates(
+            self.repo, duplicates[0], self.pkginfo_pkgs), [])
+        pkginfo = readPlistFromString(
+            self.repo.get('pkgsinfo/Firefox-120.0__1.plist'))
+        self.assertEqual(pkginfo['installer_item_location'],
+                         'apps/Firefox-120.0.dmg')
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tempdir, 'pkgs', 'old'))),
+            [])
+
+
+    def test_cache_path(self):
+        """Caches are named for the plugin and URL, not the repo object"""
+        path = pkgdedup.cache_path(self.repo)
+        self.assertEqual(pkgdedup.cache_path(FakeRepo(self.tempdir)), path)
+
+        class OtherPlugin(FakeRepo):
+            """A different plugin for the same URL"""
+            pass
+
+        self.assertNotEqual(
+            pkgdedup.cache_path(OtherPlugin(self.tempdir)), path)
+
+    def test_no_cache_without_url(self):
+        """A repo without a URL gets no hash cache"""
+        del self.repo.baseurl
+        with patch.object(pkgdedup, 'CACHE_DIR',
+                          os.path.join(self.tempdir, 'cache')):
+            self.assertIsNone(pkgdedup.cache_path(self.repo))
+            self.assertIsNone(pkgdedup.open_hash_cache(self.repo))
+            self.assertFalse(
+                os.path.exists(os.path.join(self.tempdir, 'cache')))
+
+if __name__ == '__main__':
+    unittest.main()
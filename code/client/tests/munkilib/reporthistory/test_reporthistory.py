@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_reporthistory.py
+
+Unit tests for reporthistory, the compressed store of past
+ManagedInstallReport.plist files.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import reporthistory
+from munkilib.wrappers import writePlistToString
+
+
+DAY = 24 * 60 * 60
+# 2024-01-24 12:00:00 +0000
+NOW = 1706097600
+
+
+def timestamp(seconds):
+    """Formats seconds since the epoch the way reports do"""
+    return datetime.datetime.fromtimestamp(
+        seconds, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S +0000')
+
+
+def make_report(days_ago, run_type='auto', errors=0, padding=0):
+    """Returns the bytes of a report plist for a run days_ago days before
+    NOW"""
+    start = NOW - days_ago * DAY
+    return writePlistToString({
+        'StartTime': timestamp(start),
+        'EndTime': timestamp(start + 30),
+        'RunType': run_type,
+        'Errors': ['error %s' % count for count in range(errors)],
+        'InstalledItems': ['Firefox'],
+        # incompressible, so reports have a predictable size
+        'Padding': os.urandom(padding).hex()})
+
+
+class TestReportHistory(unittest.TestCase):
+    """Tests for reporthistory.ReportHistory"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tempdir, 'ReportHistory')
+        self.history = reporthistory.ReportHistory(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def reopened(self):
+        """Returns a new ReportHistory for the same directory, so nothing
+        is remembered from self.history"""
+        return reporthistory.ReportHistory(self.directory)
+
+    def test_append_and_get_report(self):
+        """Reports read back as appended, with summaries in the index"""
+        reports = [make_report(3), make_report(2, errors=2),
+                   make_report(1, run_type='manualcheck')]
+        for report_data in reports:
+            self.history.append(report_data)
+        history = self.reopened()
+        entries = history.entries()
+        self.assertEqual(len(entries), 3)
+        for (entry, report_data) in zip(entries, reports):
+            self.assertEqual(
+                writePlistToString(history.get_report(entry)), report_data)
+        self.assertEqual(entries[1]['errors'], 2)
+        self.assertEqual(entries[2]['run_type'], 'manualcheck')
+        self.assertEqual(entries[0]['timestamp'], NOW - 3 * DAY)
+        self.assertEqual(entries[0]['duration'], 30)
+        self.assertEqual(entries[0]['installed'], 1)
+
+    def test_invalid_report(self):
+        """A report that isn't a plist isn't stored"""
+        with self.assertRaises(reporthistory.ReportHistoryError):
+            self.history.append(b'not a plist')
+        self.assertEqual(self.reopened().entries(), [])
+
+    def test_entries_filters(self):
+        """entries() filters by time, run type and errors, and limits"""
+        for days_ago in range(10, 0, -1):
+            self.history.append(make_report(
+                days_ago, run_type='auto' if days_ago % 2 else 'manualcheck',
+                errors=1 if days_ago in (3, 6) else 0))
+        history = self.reopened()
+
+        def days_ago(entries):
+            """The ages of entries, in days"""
+            return [(NOW - entry['timestamp']) // DAY for entry in entries]
+
+        self.assertEqual(
+            days_ago(history.entries(since=NOW - 4 * DAY)), [4, 3, 2, 1])
+        self.assertEqual(
+            days_ago(history.entries(until=NOW - 8 * DAY)), [10, 9, 8])
+        self.assertEqual(
+            days_ago(history.entries(run_type='manualcheck')),
+            [10, 8, 6, 4, 2])
+        self.assertEqual(
+            days_ago(history.entries(with_errors=True)), [6, 3])
+        self.assertEqual(days_ago(history.entries(limit=2)), [2, 1])
+        self.assertEqual(
+            days_ago(history.entries(run_type='auto', since=NOW - 6 * DAY,
+                                     limit=2)), [3, 1])
+
+    def test_prune_by_age(self):
+        """Reports older than max_age_days are removed"""
+        for days_ago in (40, 20, 5, 1):
+            self.history.append(make_report(days_ago))
+        self.assertEqual(self.history.prune(max_age_days=30, now=NOW), 1)
+        self.assertEqual(self.history.prune(max_age_days=30, now=NOW), 0)
+        history = self.reopened()
+        entries = history.entries()
+        self.assertEqual([(NOW - entry['timestamp']) // DAY
+                          for entry in entries], [20, 5, 1])
+        # the data file was rewritten; reports are still where the index
+        # says they are
+        for entry in entries:
+            self.assertEqual(history.get_report(entry)['RunType'], 'auto')
+        self.assertEqual(os.path.getsize(history.data_path),
+                         history.total_size())
+
+    def test_prune_by_size(self):
+        """The oldest reports go until the history fits in max_bytes"""
+        for days_ago in (4, 3, 2, 1):
+            self.history.append(make_report(days_ago, padding=1000))
+        sizes = [entry['length'] for entry in self.history.entries()]
+        max_bytes = sum(sizes[2:]) + 1
+        self.assertEqual(self.history.prune(max_bytes=max_bytes), 2)
+        history = self.reopened()
+        self.assertEqual([(NOW - entry['timestamp']) // DAY
+                          for entry in history.entries()], [2, 1])
+        self.assertLessEqual(history.total_size(), max_bytes)
+        self.assertEqual(os.path.getsize(history.data_path),
+                         history.total_size())
+        for entry in history.entries():
+            self.assertEqual(history.get_report(entry)['RunType'], 'auto')
+
+    def test_prune_without_limits(self):
+        """Without limits, nothing is removed"""
+        self.history.append(make_report(1000))
+        self.assertEqual(self.history.prune(), 0)
+        self.assertEqual(len(self.reopened().entries()), 1)
+
+    def test_interrupted_append(self):
+        """Bytes left by an append that never reached the index are
+        ignored, and later appends still work"""
+        first = make_report(2)
+        self.history.append(first)
+        # an append that wrote half its report, then died before the index
+        # was saved
+        partial = gzip.compress(make_report(1, padding=500))
+        with open(self.history.data_path, 'ab') as fileref:
+            fileref.write(partial[:len(partial) // 2])
+        with open(self.history.index_path + '.tmp', 'wb') as fileref:
+            fileref.write(b'<?xml')
+
+        history = self.reopened()
+        self.assertEqual(len(history.entries()), 1)
+        last = make_report(0)
+        history.append(last)
+
+        history = self.reopened()
+        entries = history.entries()
+        self.assertEqual(
+            [writePlistToString(history.get_report(entry))
+             for entry in entries], [first, last])
+        # pruning drops the stray bytes
+        history.prune(max_age_days=1.5, now=NOW)
+        self.assertEqual(os.path.getsize(history.data_path),
+                         history.total_size())
+        self.assertEqual(
+            writePlistToString(history.get_report(history.entries()[0])),
+            last)
+
+    def test_corrupt_report(self):
+        """A report whose compressed data is damaged raises
+        ReportHistoryError"""
+        self.history.append(make_report(1, padding=500))
+        entry = self.history.entries()[0]
+        # give the first deflate block, just after the 10 byte gzip header,
+        # a reserved block type
+        with open(self.history.data_path, 'r+b') as fileref:
+            fileref.seek(entry['offset'] + 10)
+            fileref.write(b'\xff')
+        with self.assertRaises(reporthistory.ReportHistoryError):
+            self.reopened().get_report(entry)
+
+    def test_unreadable_index(self):
+        """A damaged index raises ReportHistoryError"""
+        os.makedirs(self.directory)
+        with open(self.history.index_path, 'wb') as fileref:
+            fileref.write(b'garbage')
+        with self.assertRaises(reporthistory.ReportHistoryError):
+            self.history.entries()
+
+
+if __name__ == '__main__':
+    unittest.main()
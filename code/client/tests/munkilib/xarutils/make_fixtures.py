@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+make_fixtures.py
+
+Writes the flat packages in fixtures/ along with the listing expected for
+each of them (fixtures/<name>.toc). Run it from this directory to
+regenerate them.
+
+The packages are built here, independently of munkilib.xarutils, following
+the layout xar and pkgbuild use: a zlib-compressed TOC with sha1
+checksums, followed by a heap whose first bytes are the TOC checksum.
+The .toc files are NOT captured from xar -tf or pkgutil: they are the
+member paths of the file lists below, in archive order. Comparison with
+the real xar is left to the test that runs it on macOS.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, print_function
+
+import bz2
+import hashlib
+import os
+import struct
+import zlib
+from xml.sax.saxutils import escape
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+GZIP = 'application/x-gzip'
+BZIP2 = 'application/x-bzip2'
+STORED = 'application/octet-stream'
+
+
+def encode(data, encoding):
+    '''Returns data encoded with a xar encoding style'''
+    if encoding == GZIP:
+        return zlib.compress(data)
+    if encoding == BZIP2:
+        return bz2.compress(data)
+    return data
+
+
+def make_xar(files):
+    '''Returns the bytes of a xar archive. files is a list of
+    (path, contents, encoding) tuples in TOC order; contents of None makes
+    a directory. Parent directories must come before their contents.'''
+    heap_parts = []
+    # the heap starts with the sha1 of the compressed TOC
+    offset = hashlib.sha1().digest_size
+    elements = {'': []}
+    for (file_id, (path, contents, encoding)) in enumerate(files, 1):
+        (parent, dummy_sep, name) = path.rpartition('/')
+        children = []
+        elements[path] = children
+        if contents is None:
+            elements[parent].append(
+                ('<file id="%s"><name>%s</name><type>directory</type>'
+                 % (file_id, escape(name)), children))
+            continue
+        archived = encode(contents, encoding)
+        heap_parts.append(archived)
+        data = (
+            '<data><length>%s</length><offset>%s</offset><size>%s</size>'
+            '<encoding style="%s"/>'
+            '<archived-checksum style="sha1">%s</archived-checksum>'
+            '<extracted-checksum style="sha1">%s</extracted-checksum>'
+            '</data>' % (len(archived), offset, len(contents), encoding,
+                         hashlib.sha1(archived).hexdigest(),
+                         hashlib.sha1(contents).hexdigest()))
+        offset += len(archived)
+        elements[parent].append(
+            ('<file id="%s">%s<name>%s</name><type>file</type>'
+             % (file_id, data, escape(name)), children))
+
+    def render(entries):
+        '''Returns the XML for a list of file elements'''
+        return ''.join(start + render(children) + '</file>'
+                       for (start, children) in entries)
+
+    toc = ('<?xml version="1.0" encoding="UTF-8"?>\n<xar><toc>'
+           '<checksum style="sha1"><offset>0</offset><size>20</size>'
+           '</checksum><creation-time>2024-01-01T00:00:00</creation-time>'
+           + render(elements['']) + '</toc></xar>').encode('UTF-8')
+    compressed_toc = zlib.compress(toc)
+    heap = hashlib.sha1(compressed_toc).digest() + b''.join(heap_parts)
+    header = struct.pack('>4sHHQQI', b'xar!', 28, 1, len(compressed_toc),
+                         len(toc), 1)
+    return header + compressed_toc + heap
+
+
+PACKAGE_INFO = '''<?xml version="1.0" encoding="utf-8"?>
+<pkg-info format-version="2" identifier="%s" version="%s"
+ install-location="/" auth="root">
+    <payload numberOfFiles="12" installKBytes="%s"/>
+</pkg-info>
+'''
+
+DISTRIBUTION = '''<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="1">
+    <title>Example Suite</title>
+    <pkg-ref id="com.example.suite.app"/>
+    <pkg-ref id="com.example.suite.tools"/>
+    <choices-outline>
+        <line choice="default"/>
+    </choices-outline>
+    <choice id="default"/>
+    <pkg-ref id="com.example.suite.app" version="2.1.0"
+     installKBytes="20480">#app.pkg</pkg-ref>
+    <pkg-ref id="com.example.suite.tools" version="2.1.0"
+     installKBytes="512">#tools.pkg</pkg-ref>
+    <product id="com.example.suite" version="2.1"/>
+</installer-gui-script>
+'''
+
+
+def package_info(identifier, version, kbytes):
+    '''Returns a PackageInfo file'''
+    return (PACKAGE_INFO % (identifier, version, kbytes)).encode('UTF-8')
+
+
+FIXTURES = {
+    # a component package, as pkgbuild makes them
+    'component': [
+        ('Bom', b'BOMStore' + b'\0' * 500, GZIP),
+        ('Payload', b'\x1f\x8b' + b'payload' * 4000, STORED),
+        ('Scripts', b'\x1f\x8b' + b'scripts' * 100, STORED),
+        ('PackageInfo', package_info('com.example.tool', '1.4.2', 2048), GZIP),
+    ],
+    # a product archive, as productbuild makes them
+    'product': [
+        ('Distribution', DISTRIBUTION.encode('UTF-8'), GZIP),
+        ('Resources', None, None),
+        ('Resources/en.lproj', None, None),
+        ('Resources/en.lproj/Welcome.rtf',
+         u'{\\rtf1 Welcome to Example Suite – café}'.encode('UTF-8'), BZIP2),
+        ('app.pkg', None, None),
+        ('app.pkg/Bom', b'BOMStore' + b'\0' * 500, GZIP),
+        ('app.pkg/Payload', b'\x1f\x8b' + b'app' * 20000, STORED),
+        ('app.pkg/PackageInfo',
+         package_info('com.example.suite.app', '2.1.0', 20480), GZIP),
+        ('tools.pkg', None, None),
+        ('tools.pkg/Bom', b'BOMStore' + b'\0' * 100, GZIP),
+        ('tools.pkg/Payload', b'\x1f\x8b' + b'tools' * 100, STORED),
+        ('tools.pkg/PackageInfo',
+         package_info('com.example.suite.tools', '2.1.0', 512), BZIP2),
+    ],
+}
+
+
+def main():
+    '''Writes the fixtures'''
+    if not os.path.isdir(FIXTURES_DIR):
+        os.makedirs(FIXTURES_DIR)
+    for (name, files) in sorted(FIXTURES.items()):
+        with open(os.path.join(FIXTURES_DIR, name + '.pkg'), 'wb') as fileref:
+            fileref.write(make_xar(files))
+        with open(os.path.join(FIXTURES_DIR, name + '.toc'), 'wb') as fileref:
+            fileref.write(''.join(
+                path + '\n' for (path, dummy_contents, dummy_encoding)
+                in files).encode('UTF-8'))
+
+
+if __name__ == '__main__':
+    main()
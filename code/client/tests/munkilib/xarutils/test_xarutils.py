@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_xarutils.py
+
+Unit tests for the pure-Python xar reader in xarutils, checked against the
+listings make_fixtures.py writes for the packages in fixtures/ (made from
+its file lists, not captured from xar) and, on macOS, against /usr/bin/xar
+itself.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from munkilib import xarutils
+
+from . import make_fixtures
+
+
+def fixture_path(name):
+    """Returns the path to a fixture package"""
+    return os.path.join(make_fixtures.FIXTURES_DIR, name + '.pkg')
+
+
+class TestXarArchive(unittest.TestCase):
+    """Tests for xarutils.XarArchive"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_xar(self, data):
+        """Writes data to a package file and returns its path"""
+        path = os.path.join(self.tempdir, 'test.pkg')
+        with open(path, 'wb') as fileref:
+            fileref.write(data)
+        return path
+
+    def test_names_match_expected_toc(self):
+        """Every fixture lists the files it was built from"""
+        for name in sorted(make_fixtures.FIXTURES):
+            with open(os.path.join(make_fixtures.FIXTURES_DIR,
+                                   name + '.toc'), 'rb') as fileref:
+                expected = fileref.read().decode('UTF-8').splitlines()
+            self.assertEqual(xarutils.list_archive(fixture_path(name)),
+                             expected, name)
+
+    def test_read_members(self):
+        """Files read back as archived, whatever their encoding"""
+        for name in sorted(make_fixtures.FIXTURES):
+            with xarutils.XarArchive(fixture_path(name)) as archive:
+                for (path, contents, dummy_encoding) in (
+                        make_fixtures.FIXTURES[name]):
+                    if contents is not None:
+                        self.assertEqual(archive.read(path), contents, path)
+
+    def test_read_directory_or_missing_file(self):
+        """Only files can be read"""
+        with xarutils.XarArchive(fixture_path('product')) as archive:
+            for path in ('Resources', 'nope.pkg/PackageInfo'):
+                with self.assertRaises(xarutils.XarError):
+                    archive.read(path)
+
+    def test_checksum_mismatch(self):
+        """A member that doesn't match its checksum raises XarError"""
+        data = make_fixtures.make_xar(
+            [('PackageInfo', b'<pkg-info/>', make_fixtures.STORED)])
+        path = self.write_xar(data.replace(b'<pkg-info/>', b'<pkg-infx/>'))
+        with xarutils.XarArchive(path) as archive:
+            with self.assertRaises(xarutils.XarError):
+                archive.read('PackageInfo')
+
+    def test_not_a_xar_archive(self):
+        """Files that aren't xar archives raise XarError"""
+        data = make_fixtures.make_xar(make_fixtures.FIXTURES['component'])
+        for bad_data in (b'', b'not a xar archive, not at all', data[:60]):
+            with self.assertRaises(xarutils.XarError):
+                xarutils.XarArchive(self.write_xar(bad_data))
+
+    @unittest.skipUnless(os.path.exists('/usr/bin/xar'), 'needs xar')
+    def test_matches_xar(self):
+        """The reader and xar agree on the fixtures"""
+        for name in sorted(make_fixtures.FIXTURES):
+            output = subprocess.check_output(
+                ['/usr/bin/xar', '-tf', fixture_path(name)])
+            self.assertEqual(xarutils.list_archive(fixture_path(name)),
+                             output.decode('UTF-8').splitlines(), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
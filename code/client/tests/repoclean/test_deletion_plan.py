@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_deletion_plan.py
+
+Unit tests for repoclean's deletion plans: what goes in them, reconciling
+pkginfo sizes with the repo, and saving them for a later --execute-plan.
+
+"""
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from importlib.machinery import SourceFileLoader
+
+from munkilib import munkirepo
+from munkilib.admin.common import AttributeDict
+
+
+REPOCLEAN = SourceFileLoader(
+    'repoclean',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 os.pardir, os.pardir, 'repoclean')).load_module()
+
+
+def pkginfo_item(name, version, pkg=None, pkg_size=0, uninstallpkg=None):
+    """Returns an item as RepoCleaner.analyze_pkgsinfo records it"""
+    return {'name': name,
+            'version': version,
+            'resource_identifier': 'pkgsinfo/%s-%s.plist' % (name, version),
+            'item_size': 2048,
+            'pkg_path': pkg,
+            'pkg_size': pkg_size,
+            'uninstallpkg_path': uninstallpkg,
+            'uninstallpkg_size': 0}
+
+
+class TestDeletionPlan(unittest.TestCase):
+    """Tests for RepoCleaner.get_deletion_plan, write_plan and read_plan"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.tempdir, 'repo')
+        self.pkg_sizes = {'apps/Firefox-119.0.dmg': 5000,
+                          'apps/Firefox-118.0.dmg': 4000,
+                          'apps/Shared-1.0.pkg': 3000,
+                          'apps/Orphan.dmg': 1000}
+        for (pkg, size) in self.pkg_sizes.items():
+            self.write_pkg(pkg, size)
+        os.makedirs(os.path.join(self.repo_root, 'pkgsinfo'))
+        self.repo_url = 'file://' + self.repo_root
+        self.cleaner = self.make_cleaner()
+        self.cleaner.items_to_delete = [
+            pkginfo_item('Firefox', '118.0', 'apps/Firefox-118.0.dmg',
+                         pkg_size=4000),
+            # its pkginfo is wrong about its size
+            pkginfo_item('Firefox', '119.0', 'apps/Firefox-119.0.dmg',
+                         pkg_size=9000),
+            # still used by an item we're keeping
+            pkginfo_item('Shared', '1.0', 'apps/Shared-1.0.pkg'),
+            # its pkg is already gone
+            pkginfo_item('Gone', '1.0', 'apps/Gone-1.0.dmg'),
+        ]
+        self.cleaner.pkgs_to_keep = set(['apps/Shared-1.0.pkg'])
+        self.cleaner.orphaned_pkgs = ['apps/Orphan.dmg']
+        self.cleaner.pkg_sizes = self.cleaner.repo.itemsizes('pkgs')
+        self.plan_path = os.path.join(self.tempdir, 'plan.plist')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_pkg(self, pkg, size):
+        """Writes a pkg of size bytes to the repo"""
+        path = os.path.join(self.repo_root, 'pkgs', pkg)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fileref:
+            fileref.write(b'x' * size)
+
+    def make_cleaner(self, repo_url=None, plugin='FileRepo'):
+        """Returns a RepoCleaner for the test repo"""
+        repo_url = repo_url or self.repo_url
+        return REPOCLEAN.RepoCleaner(
+            munkirepo.connect(self.repo_url, 'FileRepo'),
+            AttributeDict({'repo_url': repo_url, 'plugin': plugin}))
+
+    def test_get_deletion_plan(self):
+        """pkginfo items come first; kept and missing pkgs are left out;
+        sizes come from the repo"""
+        plan = self.cleaner.get_deletion_plan()
+        self.assertEqual(plan, [
+            {'resource_identifier': 'pkgsinfo/Firefox-118.0.plist',
+             'size': 2048},
+            {'resource_identifier': 'pkgsinfo/Firefox-119.0.plist',
+             'size': 2048},
+            {'resource_identifier': 'pkgsinfo/Shared-1.0.plist',
+             'size': 2048},
+            {'resource_identifier': 'pkgsinfo/Gone-1.0.plist',
+             'size': 2048},
+            {'resource_identifier': 'pkgs/apps/Firefox-118.0.dmg',
+             'size': 4000},
+            {'resource_identifier': 'pkgs/apps/Firefox-119.0.dmg',
+             'size': 5000},
+            {'resource_identifier': 'pkgs/apps/Orphan.dmg', 'size': 1000}])
+
+    def test_size_warnings(self):
+        """Mismatched and missing pkgs are warned about"""
+        self.cleaner.get_deletion_plan()
+        self.assertEqual(self.cleaner.warnings, [
+            'pkgsinfo/Firefox-119.0.plist gives the size of '
+            'apps/Firefox-119.0.dmg as 8 KB; it is 4 KB',
+            'pkgsinfo/Gone-1.0.plist refers to apps/Gone-1.0.dmg, which is '
+            'not in the repo'])
+
+    def test_without_repo_sizes(self):
+        """Without sizes from the repo, pkginfo sizes are used and unknown
+        orphan sizes are None"""
+        self.cleaner.pkg_sizes = None
+        plan = self.cleaner.get_deletion_plan()
+        self.assertEqual(self.cleaner.warnings, [])
+        self.assertIn({'resource_identifier': 'pkgs/apps/Firefox-119.0.dmg',
+                       'size': 9000}, plan)
+        self.assertIn({'resource_identifier': 'pkgs/apps/Gone-1.0.dmg',
+                       'size': 0}, plan)
+        self.assertEqual(plan[-1], {'resource_identifier':
+                                    'pkgs/apps/Orphan.dmg', 'size': None})
+
+    def test_plan_round_trip(self):
+        """A plan reads back as written, less the unknown sizes"""
+        plan = self.cleaner.get_deletion_plan()
+        # a pkg the repo couldn't give a size for
+        plan.append({'resource_identifier': 'pkgs/apps/Broken.dmg',
+                     'size': None})
+        self.assertTrue(self.cleaner.write_plan(plan, self.plan_path))
+        read_plan = self.make_cleaner().read_plan(self.plan_path)
+        self.assertEqual(read_plan[:-1], plan[:-1])
+        self.assertEqual(read_plan[-1],
+                         {'resource_identifier': 'pkgs/apps/Broken.dmg'})
+
+    def test_changed_pkgs_are_skipped(self):
+        """pkgs whose size changed since the plan was made are skipped"""
+        plan = self.cleaner.get_deletion_plan()
+        self.cleaner.write_plan(plan, self.plan_path)
+        self.write_pkg('apps/Firefox-118.0.dmg', 4100)
+        read_plan = self.make_cleaner().read_plan(self.plan_path)
+        self.assertEqual(
+            [item for item in plan if item['resource_identifier'] !=
+             'pkgs/apps/Firefox-118.0.dmg'], read_plan)
+
+    def test_plan_for_another_repo(self):
+        """Plans for a different repo URL or plugin are refused"""
+        self.cleaner.write_plan(
+            self.cleaner.get_deletion_plan(), self.plan_path)
+        self.assertIsNone(self.make_cleaner(
+            repo_url='file:///Users/Shared/munki_repo').read_plan(
+                self.plan_path))
+        self.assertIsNone(self.make_cleaner(
+            plugin='GitFileRepo').read_plan(self.plan_path))
+
+    def test_unreadable_plan(self):
+        """A plan that can't be read is refused"""
+        with open(self.plan_path, 'w') as fileref:
+            fileref.write('not a plist')
+        self.assertIsNone(self.cleaner.read_plan(self.plan_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
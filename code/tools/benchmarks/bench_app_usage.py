@@ -0,0 +1,142 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_app_usage.py
+
+Replays a synthetic stream of application usage events, like a login storm,
+into a scratch database. Compares the old way of recording them (a new
+connection, table detection and an UPDATE plus INSERT per event) against
+ApplicationUsageRecorder, which batches events over a long-lived WAL-mode
+connection. Both must end up with the same counts.
+
+munkilib.app_usage imports munkilib.prefs, so this runs on macOS only.
+"""
+from __future__ import absolute_import, print_function
+
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, os.pardir, 'client'))
+
+# pylint: disable=wrong-import-position
+from munkilib import app_usage
+
+
+LEGACY_UPDATE = (
+    'UPDATE application_usage SET app_version=?, app_path=?, last_time=?, '
+    'number_times=number_times+1 WHERE event=? and bundle_id=?')
+
+
+def make_events(count, app_count, seed=0):
+    '''Returns a list of (event, app_dict) tuples'''
+    generator = random.Random(seed)
+    apps = [{'bundle_id': 'com.example.app%04d' % index,
+             'version': '1.%d' % index,
+             'path': '/Applications/App%04d.app' % index}
+            for index in range(app_count)]
+    return [(generator.choice(('launch', 'activate', 'quit')),
+             generator.choice(apps))
+            for _ in range(count)]
+
+
+def legacy_replay(database, events):
+    '''Records events one at a time, the way ApplicationUsageRecorder used
+    to'''
+    for (event, app_dict) in events:
+        conn = sqlite3.connect(database)
+        try:
+            conn.execute(app_usage.APPLICATION_USAGE_TABLE_DETECT)
+        except sqlite3.OperationalError:
+            conn.execute(app_usage.APPLICATION_USAGE_TABLE_CREATE)
+        query = conn.execute(
+            LEGACY_UPDATE,
+            (app_dict['version'], app_dict['path'], int(time.time()),
+             event, app_dict['bundle_id']))
+        if query.rowcount == 0:
+            conn.execute(
+                app_usage.APPLICATION_USAGE_TABLE_INSERT,
+                (event, app_dict['bundle_id'], app_dict['version'],
+                 app_dict['path'], int(time.time()), 1))
+        conn.commit()
+        conn.close()
+
+
+def batched_replay(database, events):
+    '''Records events with ApplicationUsageRecorder'''
+    recorder = app_usage.ApplicationUsageRecorder(database_name=database)
+    for (event, app_dict) in events:
+        recorder.log_application_usage(event, app_dict)
+    recorder.close()
+
+
+def counts(database):
+    '''Returns {(event, bundle_id): number_times}'''
+    conn = sqlite3.connect(database)
+    rows = conn.execute(
+        'SELECT event, bundle_id, number_times FROM application_usage')
+    result = dict(((event, bundle_id), number_times)
+                  for (event, bundle_id, number_times) in rows)
+    conn.close()
+    return result
+
+
+def timed(label, count, function, *args):
+    '''Runs function and prints its event rate'''
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    print('%-32s %8.2fs %10.0f events/s' % (label, elapsed, count / elapsed))
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--events', type='int', default=5000,
+                      help='Number of events to replay. Defaults to 5000.')
+    parser.add_option('--apps', type='int', default=200,
+                      help='Number of distinct applications. '
+                      'Defaults to 200.')
+    options, _ = parser.parse_args()
+
+    events = make_events(options.events, options.apps)
+    tempdir = tempfile.mkdtemp()
+    try:
+        legacy_db = os.path.join(tempdir, 'legacy.sqlite')
+        batched_db = os.path.join(tempdir, 'batched.sqlite')
+        print('Replaying %s events for %s applications'
+              % (options.events, options.apps))
+        timed('connection per event', options.events,
+              legacy_replay, legacy_db, events)
+        timed('batched, WAL', options.events,
+              batched_replay, batched_db, events)
+        if counts(legacy_db) != counts(batched_db):
+            print('ERROR: recorded counts differ!', file=sys.stderr)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_appusaged.py
+
+Throughput benchmark for the appusaged request server. Starts the server on
+a scratch Unix socket and database, then has several client threads send
+app usage events the way app_usage_monitor does: one connection per event.
+
+Compares handling one connection at a time and writing each event as it
+arrives (how appusaged used to work) against concurrent connections feeding
+the batching writer.
+
+appusaged uses macOS-only peer credential calls, so this runs on macOS only.
+"""
+from __future__ import absolute_import, print_function
+
+import logging
+import optparse
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, os.pardir, 'client')
+sys.path.insert(0, CLIENT_DIR)
+
+# pylint: disable=wrong-import-position
+from munkilib import app_usage
+from munkilib.wrappers import writePlistToString
+
+try:
+    from importlib.machinery import SourceFileLoader
+    appusaged = SourceFileLoader(
+        'appusaged', os.path.join(CLIENT_DIR, 'appusaged')).load_module()
+except ImportError:
+    import imp
+    appusaged = imp.load_source(
+        'appusaged', os.path.join(CLIENT_DIR, 'appusaged'))
+
+
+def start_server(socket_path, database, max_connections, flush_interval):
+    '''Starts appusaged on socket_path, serving in a background thread'''
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    usage = app_usage.ApplicationUsageRecorder(
+        database_name=database, flush_interval=flush_interval)
+    daemon = appusaged.AppUsageDaemon(
+        listener.fileno(), appusaged.RunHandler, usage=usage,
+        max_connections=max_connections)
+    # the daemon works on its own copy of the socket
+    listener.close()
+    daemon.log.setLevel(logging.WARNING)
+    thread = threading.Thread(
+        target=daemon.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.start()
+    return daemon, thread
+
+
+def send_event(socket_path, request_data):
+    '''Sends one request and returns the reply'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.send(request_data)
+        return client.recv(8192).decode('UTF-8')
+    finally:
+        client.close()
+
+
+def run_clients(socket_path, client_count, events_per_client, errors):
+    '''Runs client_count threads that each send events_per_client events'''
+    def client(index):
+        for event_number in range(events_per_client):
+            request = {'event': 'activate',
+                       'app_dict': {
+                           'bundle_id': 'com.example.app%03d'
+                                        % ((index + event_number) % 100),
+                           'version': '1.0',
+                           'path': '/Applications/Example.app'}}
+            reply = send_event(socket_path, writePlistToString(request))
+            if not reply.startswith('OK'):
+                errors.append(reply)
+
+    threads = [threading.Thread(target=client, args=(index,))
+               for index in range(client_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def total_events(database):
+    '''Returns the sum of number_times in database'''
+    conn = sqlite3.connect(database)
+    total = conn.execute(
+        'SELECT SUM(number_times) FROM application_usage').fetchone()[0]
+    conn.close()
+    return total or 0
+
+
+def bench(label, tempdir, options, max_connections, flush_interval):
+    '''Runs one configuration and prints its event rate'''
+    socket_path = os.path.join(tempdir, label.split()[0] + '.socket')
+    database = os.path.join(tempdir, label.split()[0] + '.sqlite')
+    daemon, thread = start_server(
+        socket_path, database, max_connections, flush_interval)
+    errors = []
+    count = options.clients * options.events
+    start = time.time()
+    try:
+        run_clients(socket_path, options.clients, options.events, errors)
+    finally:
+        daemon.shutdown()
+        thread.join()
+        daemon.stop()
+    elapsed = time.time() - start
+    print('%-32s %8.2fs %10.0f events/s' % (label, elapsed, count / elapsed))
+    if errors or total_events(database) != count:
+        print('ERROR: %s of %s events were not recorded'
+              % (count - total_events(database), count), file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--clients', type='int', default=8,
+                      help='Number of client threads. Defaults to 8.')
+    parser.add_option('--events', type='int', default=250,
+                      help='Number of events each client sends. '
+                      'Defaults to 250.')
+    options, _ = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        print('%s clients sending %s events each'
+              % (options.clients, options.events))
+        bench('serial, write per event', tempdir, options,
+              max_connections=1, flush_interval=0)
+        bench('concurrent, batched', tempdir, options,
+              max_connections=appusaged.MAX_CONNECTIONS,
+              flush_interval=app_usage.FLUSH_INTERVAL)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
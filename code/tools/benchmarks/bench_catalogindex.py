@@ -0,0 +1,154 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_catalogindex.py
+
+Compares loading a whole catalog, as managedsoftwareupdate used to, with
+opening its munkilib.catalogindex index and decoding only the items a
+typical check looks at. Reports time and the memory held afterwards.
+
+Runs on macOS or Linux; catalogindex has no platform dependencies.
+"""
+from __future__ import absolute_import, print_function
+
+import gc
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, os.pardir, 'client'))
+
+# pylint: disable=wrong-import-position
+from munkilib import catalogindex
+from munkilib.wrappers import readPlist, writePlist
+# pylint: enable=wrong-import-position
+
+
+def make_items(count):
+    '''Returns count catalog items about the size of real ones'''
+    script = '#!/bin/sh\n' + 'echo "configuring things"\n' * 40
+    items = []
+    for index in range(count):
+        name = 'Item%s' % (index // 5)
+        items.append({
+            'name': name,
+            'version': '%s.0' % (index % 5),
+            'catalogs': ['production'],
+            'description': 'Description of %s. ' % name * 10,
+            'installer_item_hash': '%064x' % index,
+            'installer_item_location': 'apps/%s-%s.pkg' % (name, index),
+            'installs': [{'path': '/Applications/%s.app' % name,
+                          'type': 'application',
+                          'CFBundleShortVersionString': '%s.0' % index}],
+            'receipts': [{'packageid': 'com.example.%s.%s' % (name, part),
+                          'version': '%s.0' % index,
+                          'installed_size': 1024}
+                         for part in range(3)],
+            'localized_strings': {'de': {'display_name': name},
+                                  'fr': {'display_name': name}},
+            'postinstall_script': script})
+    return items
+
+
+def make_tables(items):
+    '''Returns a name table like updatecheck.catalogs makes'''
+    named = {}
+    for (index, item) in enumerate(items):
+        named.setdefault(item['name'], {}).setdefault(
+            item['version'], []).append(index)
+    return {'named': named}
+
+
+def timed(label, function, *args, **kwargs):
+    '''Runs function and prints how long it took, then runs it again while
+    tracing allocations and prints how much memory its result holds'''
+    start = time.time()
+    result = function(*args, **kwargs)
+    elapsed = time.time() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    gc.collect()
+    (current, dummy_peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-28s %8.3fs %10.1f MiB held' % (label, elapsed, current / 2.0**20))
+    return result
+
+
+def load_whole(catalogpath, lookups):
+    '''Reads every item, then looks some up'''
+    items = readPlist(catalogpath)
+    tables = make_tables(items)
+    found = [items[tables['named'][name]['0.0'][0]] for name in lookups]
+    return (items, tables, found)
+
+
+def load_indexed(catalogpath, lookups):
+    '''Opens the index, then looks some items up'''
+    (tables, items, dummy_lists) = catalogindex.open_index(
+        catalogindex.index_path(catalogpath), catalogpath)
+    found = [items[tables['named'][name]['0.0'][0]] for name in lookups]
+    return (items, tables, found)
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=20000,
+                      help='Number of items in the catalog. Defaults to '
+                      '20000.')
+    parser.add_option('--lookups', type='int', default=300,
+                      help='Number of items a check looks at. Defaults to '
+                      '300.')
+    options, _ = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        catalogpath = os.path.join(tempdir, 'production')
+        items = make_items(options.items)
+        writePlist(items, catalogpath)
+        print('Catalog of %s items, %.1f MiB'
+              % (len(items), os.path.getsize(catalogpath) / 2.0**20))
+        lookups = random.sample(
+            sorted(set(item['name'] for item in items)),
+            min(options.lookups, len(items) // 5))
+        start = time.time()
+        catalogindex.write_index(
+            catalogindex.index_path(catalogpath), catalogpath, items,
+            make_tables(items), {})
+        print('%-28s %8.3fs' % ('indexing', time.time() - start))
+        del items
+        whole = timed('whole catalog', load_whole, catalogpath, lookups)
+        indexed = timed('index, %s lookups' % len(lookups),
+                        load_indexed, catalogpath, lookups)
+        if whole[2] != indexed[2]:
+            print('ERROR: looked up items differ!', file=sys.stderr)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_display_debug.py
+
+Measures what display_debug1/display_debug2 calls cost during a synthetic
+updatecheck analysis when they aren't printed or logged (LoggingLevel 1,
+default verbosity). The analysis loads a generated catalog and, for every
+item, looks up its details, all versions and its updates, and compares
+its installs items against the (missing) files on disk.
+
+Runs the analysis with debug functions that format every message and
+re-read LoggingLevel each time, as they used to, then with the current
+ones.
+
+munkilib.updatecheck needs PyObjC, so this runs on macOS only.
+"""
+from __future__ import absolute_import, print_function
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, os.pardir, 'client'))
+
+# pylint: disable=wrong-import-position,protected-access
+from munkilib import display
+from munkilib import munkilog
+from munkilib import prefs
+from munkilib.updatecheck import catalogs
+from munkilib.updatecheck import compare
+
+
+CATALOG_NAME = 'bench_display_debug'
+
+
+def make_catalog(name_count, version_count):
+    '''Returns a list of pkginfo items'''
+    items = []
+    for name_index in range(name_count):
+        name = 'Item%04d' % name_index
+        for version_index in range(version_count):
+            version = '%d.%d' % (version_index + 1, name_index % 10)
+            items.append({
+                'name': name,
+                'version': version,
+                'catalogs': [CATALOG_NAME],
+                'minimum_os_version': '10.%d' % (version_index + 9),
+                'supported_architectures': ['x86_64', 'arm64'],
+                'update_for': ['Item%04d' % ((name_index + 1) % name_count)],
+                'installs': [{
+                    'type': 'bundle',
+                    'path': '/Applications/Bench/%s.app' % name,
+                    'CFBundleShortVersionString': version,
+                    'version_comparison_key': 'CFBundleShortVersionString'}],
+                'receipts': [{
+                    'packageid': 'com.example.bench.%s' % name.lower(),
+                    'version': version}],
+            })
+    return items
+
+
+def analyze(names):
+    '''Runs the lookups updatecheck does for each item'''
+    cataloglist = [CATALOG_NAME]
+    for name in names:
+        item = catalogs.get_item_detail(
+            name, cataloglist, suppress_warnings=True)
+        catalogs.get_all_items_with_name(name, cataloglist)
+        catalogs.look_for_updates(name, cataloglist)
+        if item:
+            for install_item in item.get('installs', []):
+                compare.compare_item_version(install_item)
+
+
+def legacy_debug1(msg, *args):
+    '''display_debug1 as it used to be'''
+    msg = display._concat_message(msg, *args)
+    if display.verbose > 2:
+        print('    %s' % msg)
+        sys.stdout.flush()
+    if int(prefs.pref('LoggingLevel')) > 1:
+        munkilog.log('DEBUG1: %s' % msg)
+
+
+def legacy_debug2(msg, *args):
+    '''display_debug2 as it used to be'''
+    msg = display._concat_message(msg, *args)
+    if display.verbose > 3:
+        print('    %s' % msg)
+    if int(prefs.pref('LoggingLevel')) > 2:
+        munkilog.log('DEBUG2: %s' % msg)
+
+
+def timed(label, function, *args):
+    '''Runs function and prints how long it took'''
+    start = time.time()
+    function(*args)
+    print('%-32s %8.2fs' % (label, time.time() - start))
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=1000,
+                      help='Number of distinct item names. Defaults to 1000.')
+    parser.add_option('--versions', type='int', default=5,
+                      help='Number of versions of each item. Defaults to 5.')
+    options, _ = parser.parse_args()
+
+    if munkilog.logging_level() != 1:
+        print('WARNING: LoggingLevel is %s, not 1'
+              % munkilog.logging_level(), file=sys.stderr)
+    display.verbose = 1
+    display.munkistatusoutput = False
+
+    items = make_catalog(options.items, options.versions)
+    catalogs._CATALOG[CATALOG_NAME] = catalogs.make_catalog_db(items)
+    names = ['Item%04d' % index for index in range(options.items)]
+    print('Analyzing %s items, %s pkginfo items in all'
+          % (len(names), len(items)))
+
+    current_debug1 = display.display_debug1
+    current_debug2 = display.display_debug2
+    display.display_debug1 = legacy_debug1
+    display.display_debug2 = legacy_debug2
+    try:
+        timed('format every debug message', analyze, names)
+    finally:
+        display.display_debug1 = current_debug1
+        display.display_debug2 = current_debug2
+    timed('skip unused debug messages', analyze, names)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_filecopy.py
+
+Benchmark for copying installer items into a file repo. Makes a large
+sparse file (mostly holes, with some data scattered through it) and copies
+it, then a same-sized file full of data:
+
+  - with a plain read/write loop, as shutil.copyfileobj does
+  - with filecopy.copy_file
+  - with a read/write loop followed by a separate sha256 pass, as
+    munkiimport hashes an uploaded uninstaller item
+  - with filecopy.copy_file hashing as it copies
+
+Use --dir to benchmark a particular filesystem, e.g. a Btrfs or XFS volume
+where copies can be reflinks. Sparse files and kernel copies need Linux or
+macOS.
+"""
+from __future__ import absolute_import, print_function
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, os.pardir, 'client')
+sys.path.insert(0, CLIENT_DIR)
+
+# pylint: disable=wrong-import-position
+from munkilib import filecopy
+from munkilib import munkihash
+
+
+def make_file(path, size, sparse):
+    '''Makes a file of size bytes. A sparse one has 1MB of data every
+    64MB; otherwise it's data throughout.'''
+    chunk = os.urandom(2**20)
+    with open(path, 'wb') as fileref:
+        if sparse:
+            for offset in range(0, size, 64 * 2**20):
+                fileref.seek(offset)
+                fileref.write(chunk[:size - offset])
+            fileref.truncate(size)
+        else:
+            for offset in range(0, size, len(chunk)):
+                fileref.write(chunk[:size - offset])
+
+
+def userspace_copy(src, dst):
+    '''Copies src to dst through a buffer, without any fast paths'''
+    with open(src, 'rb') as src_ref:
+        with open(dst, 'wb') as dst_ref:
+            shutil.copyfileobj(src_ref, dst_ref, 2**20)
+    return {}
+
+
+def userspace_copy_then_hash(src, dst):
+    '''Copies src to dst through a buffer, then reads it again to hash it'''
+    userspace_copy(src, dst)
+    return {'sha256': munkihash.getsha256hash(src)}
+
+
+def filecopy_copy(src, dst):
+    '''Copies src to dst with filecopy'''
+    return filecopy.copy_file(src, dst)
+
+
+def filecopy_copy_and_hash(src, dst):
+    '''Copies src to dst with filecopy, hashing as it goes'''
+    return filecopy.copy_file(src, dst, ('sha256', ))
+
+
+def timed(label, function, src, dst, iterations):
+    '''Copies src to dst iterations times with function, prints the
+    throughput and disk usage of the copy, and returns the last result'''
+    elapsed = 0
+    for dummy_iteration in range(iterations):
+        if os.path.exists(dst):
+            os.unlink(dst)
+        # don't charge this copy for writing back the last one
+        if hasattr(os, 'sync'):
+            os.sync()
+        start = time.time()
+        result = function(src, dst)
+        elapsed += time.time() - start
+    size = os.path.getsize(src) * iterations
+    print('%-24s %8.2fs %10.1f MB/s %10.1f MB allocated'
+          % (label, elapsed, size / elapsed / 2**20,
+             os.stat(dst).st_blocks * 512.0 / 2**20))
+    return result
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--dir', default=None,
+                      help='Directory to make test files in. Defaults to a '
+                      'temporary directory.')
+    parser.add_option('--size', type='int', default=2048,
+                      help='Size of the test files in MB. Defaults to 2048.')
+    parser.add_option('--iterations', type='int', default=3,
+                      help='Times to copy each file. Defaults to 3.')
+    options, dummy_arguments = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=options.dir)
+    try:
+        src = os.path.join(workdir, 'item.dmg')
+        dst = os.path.join(workdir, 'copy.dmg')
+        for sparse in (True, False):
+            make_file(src, options.size * 2**20, sparse)
+            print('%s file, %d MB:' % ('Sparse' if sparse else 'Dense',
+                                       options.size))
+            timed('read/write', userspace_copy, src, dst, options.iterations)
+            timed('filecopy', filecopy_copy, src, dst, options.iterations)
+            expected = timed('read/write, then hash',
+                             userspace_copy_then_hash, src, dst,
+                             options.iterations)
+            result = timed('filecopy with hash', filecopy_copy_and_hash,
+                           src, dst, options.iterations)
+            if result != expected:
+                print('ERROR: hashes differ!', file=sys.stderr)
+                sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_munkihash.py
+
+Throughput benchmark for munkilib.munkihash. Compares hashing a set of files
+one at a time with the old fixed 64 KiB reads against the single-pass,
+multi-threaded gethashes_for_files() API.
+
+Runs on macOS or Linux; munkihash has no platform dependencies.
+"""
+from __future__ import absolute_import, print_function
+
+import hashlib
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, os.pardir, 'client'))
+
+from munkilib import munkihash  # pylint: disable=wrong-import-position
+
+
+def make_files(directory, count, size_mb):
+    '''Creates count files of size_mb MiB of random-ish data'''
+    block = os.urandom(2**20)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, 'item%03d.pkg' % index)
+        with open(path, 'wb') as fileref:
+            for _ in range(size_mb):
+                fileref.write(block)
+            # make each file unique
+            fileref.write(str(index).encode('UTF-8'))
+        paths.append(path)
+    return paths
+
+
+def legacy_hashes(paths):
+    '''Hashes each file twice with 64 KiB reads, as makepkginfo used to when
+    it needed both an MD5 and a SHA-256'''
+    results = {}
+    for path in paths:
+        results[path] = {}
+        for name in ('md5', 'sha256'):
+            hash_function = hashlib.new(name)
+            with open(path, 'rb') as fileref:
+                while True:
+                    chunk = fileref.read(2**16)
+                    if not chunk:
+                        break
+                    hash_function.update(chunk)
+            results[path][name] = hash_function.hexdigest()
+    return results
+
+
+def timed(label, total_bytes, function, *args, **kwargs):
+    '''Runs function and prints its throughput'''
+    start = time.time()
+    result = function(*args, **kwargs)
+    elapsed = time.time() - start
+    print('%-32s %8.2fs %10.1f MiB/s'
+          % (label, elapsed, total_bytes / 2.0**20 / elapsed))
+    return result
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--count', type='int', default=16,
+                      help='Number of files to hash. Defaults to 16.')
+    parser.add_option('--size', type='int', default=64,
+                      help='Size of each file in MiB. Defaults to 64.')
+    parser.add_option('--workers', type='int', default=None,
+                      help='Number of hashing threads. Defaults to the '
+                      'number of CPUs.')
+    options, _ = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        paths = make_files(tempdir, options.count, options.size)
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        print('Hashing %s files, %s MiB total'
+              % (len(paths), total_bytes // 2**20))
+        expected = timed('serial, two passes, 64 KiB', total_bytes,
+                         legacy_hashes, paths)
+        serial = timed('serial, single pass', total_bytes,
+                       munkihash.gethashes_for_files, paths,
+                       algorithms=('md5', 'sha256'), max_workers=1)
+        parallel = timed('threaded, single pass', total_bytes,
+                         munkihash.gethashes_for_files, paths,
+                         algorithms=('md5', 'sha256'),
+                         max_workers=options.workers)
+        if not expected == serial == parallel:
+            print('ERROR: hash results differ!', file=sys.stderr)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
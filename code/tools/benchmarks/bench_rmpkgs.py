@@ -0,0 +1,167 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_rmpkgs.py
+
+Benchmark for removepackages path resolution. Builds a synthetic receipt
+database (5 million pkgs_paths rows by default) where packages share their
+top-level directories and some files, then finds the paths to remove for a
+few packages. It does this with the old NOT IN query on an unindexed
+database, and with rmpkgs.getpathstoremove() on an indexed one. Both must
+return the same paths.
+
+munkilib.installer needs PyObjC, so this runs on macOS only.
+"""
+from __future__ import absolute_import, print_function
+
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, os.pardir, 'client'))
+
+# pylint: disable=wrong-import-position
+from munkilib.installer import rmpkgs
+
+
+def build_database(path, package_count, paths_per_package, seed=0):
+    '''Creates a synthetic receipt database at path'''
+    generator = random.Random(seed)
+    conn = sqlite3.connect(path)
+    curs = conn.cursor()
+    rmpkgs.create_tables(curs)
+    shared_dirs = ['Applications', 'Library', 'Library/Application Support',
+                   'Library/Frameworks', 'usr', 'usr/local', 'usr/local/bin']
+    path_keys = {}
+
+    def path_key(item):
+        '''Returns the key for item, adding it to paths if needed'''
+        key = path_keys.get(item)
+        if key is None:
+            key = len(path_keys) + 1
+            path_keys[item] = key
+        return key
+
+    for pkg_key in range(1, package_count + 1):
+        curs.execute(
+            'INSERT INTO pkgs (pkg_key, timestamp, owner, pkgid, vers, ppath, '
+            'pkgname) values (?, 0, 0, ?, "1.0", "", ?)',
+            (pkg_key, 'com.example.pkg%05d' % pkg_key,
+             'pkg%05d.bom' % pkg_key))
+        rows = [(pkg_key, path_key(item), 0, 0, '0755')
+                for item in shared_dirs]
+        for index in range(paths_per_package - len(shared_dirs)):
+            if generator.random() < 0.05:
+                # a file some other packages install too
+                item = 'Library/Shared/file%05d' % generator.randrange(10000)
+            else:
+                item = 'Applications/Pkg%05d.app/Contents/file%05d' % (
+                    pkg_key, index)
+            rows.append((pkg_key, path_key(item), 0, 0, '0644'))
+        curs.executemany(
+            'INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms) '
+            'values (?, ?, ?, ?, ?)', rows)
+    curs.executemany(
+        'INSERT INTO paths (path_key, path) values (?, ?)',
+        [(key, item) for (item, key) in path_keys.items()])
+    conn.commit()
+    curs.close()
+    conn.close()
+
+
+def legacy_getpathstoremove(database, pkgkeys):
+    '''The query getpathstoremove() used to run'''
+    conn = sqlite3.connect(database)
+    pkgkeys = '(%s)' % ','.join(str(key) for key in pkgkeys)
+    results = conn.execute(
+        'select path from paths where '
+        '(path_key in (select distinct path_key from pkgs_paths '
+        'where pkg_key in %s) and path_key not in '
+        '(select distinct path_key from pkgs_paths where pkg_key not in %s))'
+        % (pkgkeys, pkgkeys)).fetchall()
+    conn.close()
+    return sorted(row[0] for row in results)
+
+
+def current_getpathstoremove(database, pkgkeys):
+    '''Runs rmpkgs.getpathstoremove() against database'''
+    rmpkgs.PACKAGEDB = database
+    return sorted(rmpkgs.getpathstoremove(pkgkeys))
+
+
+def add_indexes(database):
+    '''Indexes database as rmpkgs.init_database() does'''
+    conn = sqlite3.connect(database)
+    curs = conn.cursor()
+    rmpkgs.create_indexes(curs)
+    conn.commit()
+    conn.close()
+
+
+def timed(label, function, *args):
+    '''Runs function, prints how long it took and returns its result'''
+    start = time.time()
+    result = function(*args)
+    print('%-32s %8.2fs' % (label, time.time() - start))
+    return result
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser()
+    parser.add_option('--packages', type='int', default=2000,
+                      help='Number of packages. Defaults to 2000.')
+    parser.add_option('--paths', type='int', default=5000000,
+                      help='Total number of pkgs_paths rows. '
+                      'Defaults to 5000000.')
+    parser.add_option('--remove', type='int', default=3,
+                      help='Number of packages to resolve paths for. '
+                      'Defaults to 3.')
+    options, _ = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        legacy_db = os.path.join(tempdir, 'legacy.receiptdb')
+        current_db = os.path.join(tempdir, 'current.receiptdb')
+        timed('build database', build_database, legacy_db,
+              options.packages, options.paths // options.packages)
+        shutil.copyfile(legacy_db, current_db)
+        timed('create indexes', add_indexes, current_db)
+        pkgkeys = random.Random(1).sample(
+            range(1, options.packages + 1), options.remove)
+        print('Resolving paths for packages %s' % pkgkeys)
+        expected = timed('NOT IN subquery, no indexes',
+                         legacy_getpathstoremove, legacy_db, pkgkeys)
+        result = timed('reference counts, indexed',
+                       current_getpathstoremove, current_db, pkgkeys)
+        print('%s paths to remove' % len(result))
+        if result != expected:
+            print('ERROR: path lists differ!', file=sys.stderr)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
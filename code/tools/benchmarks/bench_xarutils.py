@@ -0,0 +1,118 @@
+#!/usr/local/munki/munki-python
+# encoding: utf-8
+#
+# Copyright 2024 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench_xarutils.py
+
+Benchmark for flat package inspection. For each package given (by default,
+the test fixtures), reads the TOC and every PackageInfo and Distribution
+file the way pkgutils.getFlatPackageInfo() does: with xarutils, and, where
+/usr/bin/xar exists, by running xar -tf and xar -xf as it used to. Both
+must find the same files with the same contents.
+
+Runs anywhere; the xar comparison needs macOS.
+"""
+from __future__ import absolute_import, print_function
+
+import glob
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, os.pardir, 'client')
+sys.path.insert(0, CLIENT_DIR)
+
+# pylint: disable=wrong-import-position
+from munkilib import xarutils
+
+XAR = '/usr/bin/xar'
+
+
+def wanted(toc_entry):
+    '''Returns True for the TOC entries getFlatPackageInfo reads'''
+    return (toc_entry.startswith('PackageInfo') or
+            toc_entry.endswith('.pkg/PackageInfo') or
+            toc_entry.startswith('Distribution'))
+
+
+def read_with_xarutils(pkgpath):
+    '''Returns {toc_entry: contents} for the entries we want'''
+    with xarutils.XarArchive(pkgpath) as archive:
+        return dict((toc_entry, archive.read(toc_entry))
+                    for toc_entry in archive.names() if wanted(toc_entry))
+
+
+def read_with_xar(pkgpath):
+    '''Returns {toc_entry: contents} for the entries we want, using xar'''
+    pkgtmp = tempfile.mkdtemp()
+    try:
+        toc = subprocess.check_output([XAR, '-tf', pkgpath])
+        contents = {}
+        for toc_entry in toc.decode('UTF-8').splitlines():
+            if wanted(toc_entry):
+                subprocess.check_call([XAR, '-xf', pkgpath, toc_entry],
+                                      cwd=pkgtmp)
+                with open(os.path.join(pkgtmp, toc_entry), 'rb') as fileref:
+                    contents[toc_entry] = fileref.read()
+        return contents
+    finally:
+        shutil.rmtree(pkgtmp)
+
+
+def timed(label, function, pkgpaths, iterations):
+    '''Reads all of pkgpaths iterations times with function, prints the
+    throughput and returns the last results'''
+    start = time.time()
+    for dummy_iteration in range(iterations):
+        results = [function(pkgpath) for pkgpath in pkgpaths]
+    elapsed = time.time() - start
+    count = len(pkgpaths) * iterations
+    print('%-16s %6d packages %8.2fs %10.1f packages/s'
+          % (label, count, elapsed, count / elapsed))
+    return results
+
+
+def main():
+    '''Main'''
+    parser = optparse.OptionParser(usage='%prog [options] [pkg ...]')
+    parser.add_option('--iterations', type='int', default=200,
+                      help='Times to read each package. Defaults to 200.')
+    options, arguments = parser.parse_args()
+    pkgpaths = [os.path.abspath(path) for path in arguments] or sorted(
+        glob.glob(os.path.join(CLIENT_DIR, 'tests', 'munkilib', 'xarutils',
+                               'fixtures', '*.pkg')))
+    if not pkgpaths:
+        parser.error('No packages to read')
+
+    results = timed('xarutils', read_with_xarutils, pkgpaths,
+                    options.iterations)
+    if not os.path.exists(XAR):
+        print('%s not found; skipping comparison' % XAR)
+        return
+    expected = timed('xar', read_with_xar, pkgpaths,
+                     max(1, options.iterations // 20))
+    if results != expected:
+        print('ERROR: contents differ!', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
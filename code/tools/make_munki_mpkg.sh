@@ -440,7 +440,7 @@ mkdir -m 755 "$COREROOT/usr/local/munki"
 mkdir -m 755 "$COREROOT/usr/local/munki/munkilib"
 # Copy command line utilities.
 # edit this if list of tools changes!
-for TOOL in authrestartd launchapp logouthelper precache_agent ptyexec removepackages supervisor
+for TOOL in authrestartd launchapp logouthelper precache_agent ptyexec removepackages reporthistory supervisor
 do
     cp -X "$MUNKIROOT/code/client/$TOOL" "$COREROOT/usr/local/munki/" 2>&1
 done
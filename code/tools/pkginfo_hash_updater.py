@@ -21,6 +21,12 @@ This script will recursively update the '(un)installer_item_hash' key in all
 pkginfo plists in the pkgsinfo directory of a Munki repo with a SHA-256 hash of
 the corresponding package.
 
+Package hashes are remembered in a cache file keyed by package path, size and
+modification time, so later runs only hash packages that are new or have
+changed. Packages that do need hashing are hashed in parallel by a pool of
+worker processes. Use --dry_run to see which pkginfo plists would change
+without writing anything.
+
 This script will run from OS X or Linux alike, and it is safe to run more than
 once on any pkginfo plist(s). However, it is recommended that you backup your
 plists before running this script!
@@ -32,7 +38,9 @@ Dependencies:
 
 Created on 2010-09-02.
 """
+from __future__ import print_function
 
+import multiprocessing
 import optparse
 import os
 import hashlib
@@ -48,6 +56,28 @@ except ImportError:
 MUNKI_ROOT_PATH = '/var/www/munki/repo'
 MUNKI_PKGS_DIR_NAME = 'pkgs'
 MUNKI_PKGSINFO_DIR_NAME = 'pkgsinfo'
+HASH_CACHE_FILE_NAME = '.pkginfo_hash_cache.plist'
+
+# pkginfo keys holding a package location, and the key holding its hash
+HASH_KEYS = (('installer_item_location', 'installer_item_hash'),
+             ('uninstaller_item_location', 'uninstaller_item_hash'))
+
+
+def ReadPlist(path):
+  """Reads a plist with either the Python 2 or Python 3 plistlib API."""
+  if hasattr(plistlib, 'load'):
+    with open(path, 'rb') as f:
+      return plistlib.load(f)
+  return plistlib.readPlist(path)
+
+
+def WritePlist(plist, path):
+  """Writes a plist with either the Python 2 or Python 3 plistlib API."""
+  if hasattr(plistlib, 'dump'):
+    with open(path, 'wb') as f:
+      plistlib.dump(plist, f)
+  else:
+    plistlib.writePlist(plist, path)
 
 
 def GetHash(filename, hash_function):
@@ -66,7 +96,7 @@ def GetHash(filename, hash_function):
   
   f = open(filename, 'rb')
   while 1:
-    chunk = f.read(2**16)
+    chunk = f.read(2**20)
     if not chunk:
       break
     hash_function.update(chunk)
@@ -80,67 +110,197 @@ def GetSHA256Hash(filename):
   return GetHash(filename, hash_function)
 
 
-def AddHashesToPkginfoPlists(pkgsinfo_path, pkgs_path, update_existing=False):
-  """Recursively updates plists' '(un)installer_item_hash' kay with pkg hash.
+def _HashWorker(pkg_path):
+  """multiprocessing worker; returns (pkg_path, SHA-256 hex digest)."""
+  try:
+    return pkg_path, GetSHA256Hash(pkg_path)
+  except (IOError, OSError) as e:
+    print('WARNING: could not hash %s: %s' % (pkg_path, e), file=sys.stderr)
+    return pkg_path, None
+
+
+class HashCache(object):
+  """Sidecar cache mapping package paths to their SHA-256 hash.
+
+  Entries are keyed by the package path relative to the pkgs dir, and are
+  only trusted while the package's size and modification time are unchanged.
+  """
+
+  def __init__(self, cache_path, pkgs_path):
+    self.cache_path = cache_path
+    self.pkgs_path = pkgs_path
+    self.entries = {}
+    if cache_path and os.path.isfile(cache_path):
+      try:
+        self.entries = ReadPlist(cache_path).get('packages', {})
+      except Exception as e:  # pylint: disable=broad-except
+        print('WARNING: ignoring unreadable hash cache %s: %s'
+              % (cache_path, e), file=sys.stderr)
+
+  def _Key(self, pkg_path):
+    return os.path.relpath(pkg_path, self.pkgs_path)
+
+  @staticmethod
+  def _Fingerprint(pkg_path):
+    st = os.stat(pkg_path)
+    # plist integers are limited to 64 bits; store mtime as a string so
+    # sub-second precision survives a round trip.
+    return st.st_size, repr(st.st_mtime)
+
+  def Lookup(self, pkg_path):
+    """Returns the cached hash for pkg_path if it is still valid, or None."""
+    entry = self.entries.get(self._Key(pkg_path))
+    if not entry:
+      return None
+    size, mtime = self._Fingerprint(pkg_path)
+    if entry.get('size') != size or entry.get('mtime') != mtime:
+      return None
+    return entry.get('sha256')
+
+  def Store(self, pkg_path, sha256):
+    """Records the hash of pkg_path along with its current size and mtime."""
+    size, mtime = self._Fingerprint(pkg_path)
+    self.entries[self._Key(pkg_path)] = {
+        'size': size, 'mtime': mtime, 'sha256': sha256}
+
+  def Prune(self):
+    """Drops cache entries for packages that no longer exist."""
+    for key in list(self.entries):
+      if not os.path.isfile(os.path.join(self.pkgs_path, key)):
+        del self.entries[key]
+
+  def Save(self):
+    if self.cache_path:
+      WritePlist({'packages': self.entries}, self.cache_path)
+
+
+def ReadPkginfoPlists(pkgsinfo_path):
+  """Recursively reads all pkginfo plists under pkgsinfo_path.
+
+  Returns:
+    A list of (path, plist dict) tuples.
+  """
+  pkginfos = []
+  for dirpath, dirnames, filenames in os.walk(pkgsinfo_path):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      if filename.startswith("._") or filename == ".DS_Store":
+        # don't process these
+        continue
+      f_path = os.path.join(dirpath, filename)
+      if os.path.islink(f_path):
+        print('WARNING: symlinks not supported; skipping: %s' % f_path)
+        continue
+      # read plist
+      try:
+        plist = ReadPlist(f_path)
+      except Exception as e:  # pylint: disable=broad-except
+        print('WARNING: pkginfo plist failed to open: %s\n%s' % (f_path,
+                                                                 str(e)))
+        continue
+      pkginfos.append((f_path, plist))
+  return pkginfos
+
+
+def HashPackages(pkg_paths, cache, workers=None):
+  """Returns a dict of pkg path -> SHA-256 for pkg_paths.
+
+  Packages with a valid cache entry are not re-read. The rest are hashed by
+  a pool of worker processes and the cache is updated with the results.
+  """
+  hashes = {}
+  to_hash = []
+  for pkg_path in pkg_paths:
+    cached = cache.Lookup(pkg_path)
+    if cached:
+      hashes[pkg_path] = cached
+    else:
+      to_hash.append(pkg_path)
+
+  print('%d package(s) unchanged, %d package(s) to hash'
+        % (len(hashes), len(to_hash)))
+  if not to_hash:
+    return hashes
+
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  workers = max(1, min(workers, len(to_hash)))
+  if workers == 1:
+    results = map(_HashWorker, to_hash)
+  else:
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+      results = pool.map(_HashWorker, to_hash)
+    finally:
+      pool.close()
+      pool.join()
+
+  for pkg_path, sha256 in results:
+    if sha256:
+      hashes[pkg_path] = sha256
+      cache.Store(pkg_path, sha256)
+  return hashes
+
+
+def AddHashesToPkginfoPlists(pkgsinfo_path, pkgs_path, update_existing=False,
+                             cache_path=None, workers=None, dry_run=False):
+  """Recursively updates plists' '(un)installer_item_hash' key with pkg hash.
   
   Args:
     pkgsinfo_path: root dir to start updating from.
     pkgs_path: root dir where Munki pkgs live.
+    update_existing: if True, replace hashes already present in pkginfo.
+    cache_path: path of the hash cache file, or None to disable caching.
+    workers: number of hashing processes; defaults to the number of CPUs.
+    dry_run: if True, report the pkginfo plists that would change, but
+        don't write them.
+
+  Returns:
+    A list of the pkginfo plist paths that were (or would be) changed.
   """
-  for f_path in os.listdir(pkgsinfo_path):
-    if f_path.startswith("._") or f_path == ".DS_Store":
-      # don't process these
-      continue
-    f_path = os.path.join(pkgsinfo_path, f_path)
-    # if a directory is found, recursively call this function on that dir.
-    if os.path.isdir(f_path):
-      AddHashesToPkginfoPlists(f_path, pkgs_path)
-    elif os.path.islink(f_path):
-      print 'WARNING: symlinks not supported; skipping: %s' % f_path
-      continue
-    elif os.path.isfile(f_path):
-      # read plist
-      try:
-        plist = plistlib.readPlist(f_path)
-      except IOError as e:
-        print 'WARNING: pkginfo plist failed to open: %s\n%s' % (f_path,
-                                                                 str(e))
+  pkginfos = ReadPkginfoPlists(pkgsinfo_path)
+
+  # work out which packages we need hashes for
+  wanted = {}
+  for f_path, plist in pkginfos:
+    for location_key, hash_key in HASH_KEYS:
+      if location_key not in plist:
+        continue
+      if hash_key in plist and not update_existing:
         continue
-      
-      updated_hash = False
-      # generate the package path from the pkginfo plist
-      # installer_item_location.
-      if not 'installer_item_hash' in plist or update_existing:
-          pkg_path = os.path.join(pkgs_path, plist['installer_item_location'])
-          # display warning for items that cannot be found.
-          if not os.path.isfile(pkg_path):
-            print >> sys.stderr, ('WARNING: Installer item (%s) not found '
-                                  'as specified in %s') % (pkg_path, f_path)
-            continue
-          # generate the package hash
-          plist['installer_item_hash'] = GetSHA256Hash(pkg_path)
-          updated_hash = True
-      
-      # check for and update uninstaller_item_hash if needed
-      if 'uninstaller_item_location' in plist:
-        if not 'uninstaller_item_hash' in plist or update_existing:
-          pkg_path = os.path.join(pkgs_path,
-                                  plist['uninstaller_item_location'])
-          # display warning for items that cannot be found.
-          if not os.path.isfile(pkg_path):
-              print >> sys.stderr, ('WARNING: Uninstaller item (%s) not '
-                                    'found as specified in %s') % (pkg_path,
-                                                                   f_path)
-              continue
-          
-          # generate the package hash
-          plist['uninstaller_item_hash'] = GetSHA256Hash(pkg_path)
-          updated_hash = True
-          
-      # write the plist file.
-      if updated_hash:
-        plistlib.writePlist(plist, f_path)
-        print '- Wrote hash to plist: %s' % f_path
+      pkg_path = os.path.join(pkgs_path, plist[location_key])
+      # display warning for items that cannot be found.
+      if not os.path.isfile(pkg_path):
+        print(('WARNING: %s (%s) not found as specified in %s')
+              % (location_key, pkg_path, f_path), file=sys.stderr)
+        continue
+      wanted.setdefault(f_path, []).append((hash_key, pkg_path))
+
+  all_pkg_paths = sorted(set(
+      pkg_path for items in wanted.values() for _, pkg_path in items))
+  cache = HashCache(cache_path, pkgs_path)
+  hashes = HashPackages(all_pkg_paths, cache, workers=workers)
+  if not dry_run:
+    cache.Prune()
+    cache.Save()
+
+  changed = []
+  for f_path, plist in pkginfos:
+    updated_hash = False
+    for hash_key, pkg_path in wanted.get(f_path, []):
+      sha256 = hashes.get(pkg_path)
+      if sha256 and plist.get(hash_key) != sha256:
+        plist[hash_key] = sha256
+        updated_hash = True
+    # write the plist file.
+    if updated_hash:
+      changed.append(f_path)
+      if dry_run:
+        print('- Would write hash to plist: %s' % f_path)
+      else:
+        WritePlist(plist, f_path)
+        print('- Wrote hash to plist: %s' % f_path)
+  return changed
 
 
 def main():
@@ -155,18 +315,39 @@ def main():
                help='Munki packages dir name; default "pkgs".')
   p.add_option('-u', "--update_existing", action='store_true',
                 help='Update existing hashes.')
+  p.add_option('-c', '--cache_file', default=None,
+               help='Path to the package hash cache; default '
+               '"<munki_root>/%s".' % HASH_CACHE_FILE_NAME)
+  p.add_option('--no_cache', action='store_true',
+               help='Ignore and don\'t write the package hash cache.')
+  p.add_option('-j', '--workers', type='int', default=None,
+               help='Number of hashing processes; default is the number of '
+               'CPUs.')
+  p.add_option('-n', '--dry_run', action='store_true',
+               help='Report which pkginfo plists would change without '
+               'writing them.')
   options, dummy_arguments = p.parse_args()
   
   pkgsinfo_path = os.path.join(options.munki_root, options.pkgsinfo_dir_name)
   pkgs_path = os.path.join(options.munki_root, options.pkgs_dir_name)
+  cache_path = None
+  if not options.no_cache:
+    cache_path = options.cache_file or os.path.join(options.munki_root,
+                                                    HASH_CACHE_FILE_NAME)
   if not os.path.isdir(pkgsinfo_path) or not os.listdir(pkgsinfo_path):
-    print 'Pkgsinfo directory not found or is empty: %s' % pkgsinfo_path
+    print('Pkgsinfo directory not found or is empty: %s' % pkgsinfo_path)
   elif not os.path.isdir(pkgs_path) or not os.listdir(pkgs_path):
-    print 'Pkgs directory not found or is empty: %s' % pkgs_path
+    print('Pkgs directory not found or is empty: %s' % pkgs_path)
   else:
-    AddHashesToPkginfoPlists(pkgsinfo_path, pkgs_path,
-                             options.update_existing)
-    print '\nYou must run makecatalogs to update catalogs with pkginfo changes.'
+    changed = AddHashesToPkginfoPlists(
+        pkgsinfo_path, pkgs_path, update_existing=options.update_existing,
+        cache_path=cache_path, workers=options.workers,
+        dry_run=options.dry_run)
+    if options.dry_run:
+      print('\n%d pkginfo plist(s) would be changed.' % len(changed))
+    elif changed:
+      print('\nYou must run makecatalogs to update catalogs with pkginfo '
+            'changes.')
 
 
 if __name__ == '__main__':